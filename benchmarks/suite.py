@@ -0,0 +1,216 @@
+"""
+benchmark suite - spawn latency, pipe throughput, pipeline scaling, status polling and parent RSS sensitivity
+
+Runs every benchmark with standard coreutils, prints a summary, and optionally
+writes the results as JSON and compares them against a saved baseline:
+
+    python benchmarks/suite.py --output baseline.json
+    python benchmarks/suite.py --baseline baseline.json --output current.json
+
+Metrics ending in _mb_per_s are better when higher, all others when lower.
+With --baseline, the exit status is 1 if any metric regressed by more than
+the threshold (10% by default), so the suite can gate changes.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from childprocess import ChildProcessBuilder as CPB
+from childprocess import ChildProcessIO
+from childprocess import PipelineBuilder as PB
+from childprocess import SpawnEngine
+
+MIB = 1024 * 1024
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def latency_metrics(samples):
+    return {"p50_us": percentile(samples, 0.5) * 1e6, "p99_us": percentile(samples, 0.99) * 1e6}
+
+def spawn_latency(scale):
+    """Time from spawning `true` until its exit has been observed."""
+    count = 500 * scale
+    builder = CPB("true", stdout=ChildProcessIO.NULL)
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        builder.spawn().wait_for_finish()
+        samples.append(time.perf_counter() - start)
+    template = builder.freeze()
+    template_samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        template.spawn().wait_for_finish()
+        template_samples.append(time.perf_counter() - start)
+    popen_samples = []
+    with open(os.devnull, "w") as null:
+        for _ in range(count):
+            start = time.perf_counter()
+            subprocess.Popen(["true"], stdout=null).wait()
+            popen_samples.append(time.perf_counter() - start)
+    return {"builder": latency_metrics(samples), "template": latency_metrics(template_samples),
+            "popen": latency_metrics(popen_samples)}
+
+def read_all(process, buffer):
+    total = 0
+    while True:
+        read = process.readinto(buffer)
+        if not read:
+            return total
+        total += read
+
+def pipe_throughput(scale):
+    """Read a stream of zeros from one child through its stdout pipe."""
+    size = 256 * MIB * scale
+    buffer = bytearray(MIB)
+    start = time.perf_counter()
+    process = CPB(["head", "-c", str(size), "/dev/zero"], stdout=ChildProcessIO.PIPE).spawn()
+    total = read_all(process, buffer)
+    process.wait_for_finish()
+    elapsed = time.perf_counter() - start
+    assert total == size
+    return {"single_pipe": {"throughput_mb_per_s": size / MIB / elapsed}}
+
+def pipeline_scaling(scale):
+    """Push a stream of zeros through a growing number of `cat` stages."""
+    size = 128 * MIB * scale
+    buffer = bytearray(MIB)
+    results = {}
+    for stages in (1, 2, 4, 8):
+        commands = [["head", "-c", str(size), "/dev/zero"]] + [["cat"]] * stages
+        start = time.perf_counter()
+        pipeline = PB(commands, stdout=ChildProcessIO.PIPE).spawn_all()
+        total = read_all(pipeline[-1], buffer)
+        pipeline.wait_for_finish()
+        elapsed = time.perf_counter() - start
+        assert total == size
+        results["cat_x{}".format(stages)] = {"throughput_mb_per_s": size / MIB / elapsed}
+    return results
+
+def status_polling(scale):
+    """Check the status of many running children, as a supervisor loop would."""
+    count = 200
+    rounds = 50 * scale
+    processes = [CPB(["sleep", "60"], stdout=ChildProcessIO.NULL).spawn() for _ in range(count)]
+    try:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for process in processes:
+                process.is_finished()
+        elapsed = time.perf_counter() - start
+    finally:
+        for process in processes:
+            process.terminate(force=True)
+        for process in processes:
+            process.wait_for_finish()
+    return {"is_finished_x{}".format(count): {"per_call_us": elapsed / (rounds * count) * 1e6}}
+
+def parent_rss(scale):
+    """Spawn latency of each engine as the parent's resident memory grows."""
+    count = 50 * scale
+    results = {}
+    ballast = []
+    page = os.sysconf("SC_PAGE_SIZE")
+    for size_mb in (0, 256, 1024):
+        added = size_mb * MIB - sum(len(block) for block in ballast)
+        if added:
+            block = bytearray(added)
+            # Fresh allocations are mapped lazily, so every page is written to make it resident
+            block[::page] = b"\1" * len(range(0, added, page))
+            ballast.append(block)
+        for engine in (SpawnEngine.POSIX_SPAWN, SpawnEngine.POPEN):
+            builder = CPB("true", stdout=ChildProcessIO.NULL, engine=engine)
+            samples = []
+            for _ in range(count):
+                start = time.perf_counter()
+                builder.spawn().wait_for_finish()
+                samples.append(time.perf_counter() - start)
+            results["{}_{}mb".format(engine.name.lower(), size_mb)] = latency_metrics(samples)
+    return results
+
+BENCHMARKS = {
+    "spawn_latency": spawn_latency,
+    "pipe_throughput": pipe_throughput,
+    "pipeline_scaling": pipeline_scaling,
+    "status_polling": status_polling,
+    "parent_rss": parent_rss,
+}
+
+def flatten(results):
+    """Map "benchmark.case.metric" names to values."""
+    return {".".join((benchmark, case, metric)): value
+            for benchmark, cases in results.items()
+            for case, metrics in cases.items()
+            for metric, value in metrics.items()}
+
+def compare(current, baseline, threshold):
+    """Print the change of every metric against the baseline, returning the names of the regressed metrics."""
+    regressions = []
+    current, baseline = flatten(current), flatten(baseline)
+    for name in sorted(current.keys() & baseline.keys()):
+        old, new = baseline[name], current[name]
+        if not old:
+            continue
+        change = (new - old) / old
+        worse = -change if name.endswith("_mb_per_s") else change
+        flag = "REGRESSED" if worse > threshold else ""
+        if flag:
+            regressions.append(name)
+        print("{:50} {:12.2f} -> {:12.2f} {:+7.1%} {}".format(name, old, new, change, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="benchmarks to run, of: {} (default: all)".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--scale", type=int, default=1, help="multiplier for the amount of work per benchmark")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare the results against this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change beyond which a metric counts as regressed (default: 0.1)")
+    arguments = parser.parse_args()
+    unknown = set(arguments.benchmarks) - BENCHMARKS.keys()
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(", ".join(sorted(unknown))))
+
+    results = {}
+    for name in arguments.benchmarks or BENCHMARKS:
+        results[name] = BENCHMARKS[name](arguments.scale)
+    for name, value in sorted(flatten(results).items()):
+        print("{:50} {:12.2f}".format(name, value))
+
+    report = {
+        "metadata": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "scale": arguments.scale,
+        },
+        "results": results,
+    }
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+        print()
+        regressions = compare(results, baseline["results"], arguments.threshold)
+        if regressions:
+            print("\n{} metric(s) regressed beyond {:.0%}".format(len(regressions), arguments.threshold))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
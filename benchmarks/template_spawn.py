@@ -0,0 +1,44 @@
+"""
+microbenchmark - per-spawn overhead of a ChildProcessBuilder versus a frozen ChildProcessTemplate
+
+Spawns the same short-lived command many times with one argument changing,
+first by building a new ChildProcessBuilder for every spawn (as one would
+without templates), then by reusing one template from ChildProcessBuilder.freeze().
+The difference between the two is the per-spawn overhead saved by the template.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from childprocess import ChildProcessBuilder as CPB
+from childprocess import ChildProcessIO
+
+SPAWNS = 2000
+COMMAND = "true --value={value}"
+
+def spawn_with_builders(count):
+    for i in range(count):
+        CPB(COMMAND.format(value=i), stdout=ChildProcessIO.NULL).spawn().wait_for_finish()
+
+def spawn_with_template(count):
+    template = CPB(COMMAND, stdout=ChildProcessIO.NULL).freeze("value")
+    for i in range(count):
+        template.spawn(value=i).wait_for_finish()
+
+def time_per_spawn(function, count):
+    start = time.perf_counter()
+    function(count)
+    return (time.perf_counter() - start) / count
+
+def main():
+    builder = time_per_spawn(spawn_with_builders, SPAWNS)
+    template = time_per_spawn(spawn_with_template, SPAWNS)
+    print("builder:  {:8.1f} us per spawn".format(builder * 1e6))
+    print("template: {:8.1f} us per spawn".format(template * 1e6))
+    print("saved:    {:8.1f} us per spawn".format((builder - template) * 1e6))
+
+if __name__ == "__main__":
+    main()
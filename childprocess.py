@@ -1,12 +1,51 @@
+import argparse
+import array
+import asyncio
+import bisect
+import codecs
+import concurrent.futures
+import copy
+import ctypes
+import errno
+import fcntl
+import hashlib
+import hmac
 import io
+import ipaddress
+import itertools
+import json
+import mmap
 import os
+import platform
+import re
+import resource
+import select
+import selectors
 import shlex
+import shutil
 import signal
+import socket
+import socketserver
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import termios
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from collections.abc import Sequence
 from enum import Enum
+from types import MappingProxyType
 from typing import Dict, List, Tuple, Union
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class ChildProcessIO(Enum):
     """The desired creation behavior for a ChildProcess's standard input/output/error file descriptors.
 
@@ -16,35 +55,1405 @@ class ChildProcessIO(Enum):
     PIPE - Open a pipe to the I/O stream, and make it accessible via ChildProcess.stdin/stdout/stderr
     INHERIT - Upon creation, inherit the corresponding I/O stream from the parent process
     NULL - Provide empty input, or ignore output
-    STDOUT - Redirect STDERR to the same file descriptor as STDOUT. Only valid for ChildProcessBuilder.stderr"""
+    STDOUT - Redirect STDERR to the same file descriptor as STDOUT. Only valid for ChildProcessBuilder.stderr
+    CAPTURE_TAIL - Keep the output drained in the background, retaining only its last 64 KiB, accessible via
+        ChildProcess.stdout_tail/stderr_tail. Only valid for output. See TailCapture for other limits
+    CAPTURE_SPILL - Keep the output drained in the background, in memory up to 1 MiB and in an anonymous file
+        beyond that, accessible via ChildProcess.stdout_capture/stderr_capture. Only valid for output. See
+        SpillCapture for other limits"""
     PIPE = 1
     INHERIT = 2
     NULL = 3
     STDOUT = 4
+    CAPTURE_TAIL = 5
+    CAPTURE_SPILL = 6
+
+class TailCapture():
+    """Output creation behavior which keeps the output drained in the background, retaining only its tail.
+
+    Can be supplied to ChildProcessBuilder.stdout or ChildProcessBuilder.stderr, as a configurable form of
+    ChildProcessIO.CAPTURE_TAIL. All pipes are drained by one shared background thread, so the child never blocks
+    on output which nobody reads, and memory use stays bounded. The retained tail is accessible via
+    ChildProcess.stdout_tail/stderr_tail."""
+    def __init__(self, max_bytes=65536, max_lines=None):
+        """
+        Parameters
+        ----------
+        max_bytes: int, optional
+            The maximum number of trailing bytes of output to retain. Defaults to 64 KiB.
+        max_lines: int, optional
+            If provided, retain at most this many trailing complete lines (along with any incomplete last line)."""
+        if max_bytes < 1 or (max_lines is not None and max_lines < 0):
+            raise ValueError("Tail capture limits must be positive")
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+
+class SpillCapture():
+    """Output creation behavior which keeps the output drained in the background, retaining all of it in memory up
+    to a threshold, and in an anonymous file beyond it.
+
+    Can be supplied to ChildProcessBuilder.stdout or ChildProcessBuilder.stderr, as a configurable form of
+    ChildProcessIO.CAPTURE_SPILL. Once spilled, the output is moved from the pipe to the file without passing
+    through user space where the kernel supports it, so memory use stays flat however much the child writes. The
+    output is accessible via ChildProcess.stdout_capture/stderr_capture as a memory-mapped CapturedOutput."""
+    def __init__(self, memory_limit=1024 * 1024, directory=None):
+        """
+        Parameters
+        ----------
+        memory_limit: int, optional
+            The maximum number of bytes of output to keep in memory before spilling it to a file. Defaults to 1 MiB.
+        directory: str, optional
+            The directory in which to create the file. By default, a memfd is used where available, and a file in
+            the default temporary directory otherwise."""
+        if memory_limit < 0:
+            raise ValueError("The memory limit must not be negative")
+        self.memory_limit = memory_limit
+        self.directory = directory
+
+class CapturedOutput():
+    """The complete output of a child process, captured by a SpillCapture.
+
+    Behaves as a read-only sequence of bytes, whose slices are memoryviews of the captured output rather than
+    copies. Output which was spilled to a file is memory-mapped, so it is paged in by the kernel as it is accessed.
+
+    May be used with Python's `with` statement - upon the exit of the block, the mapping is released."""
+    def __init__(self, data, mapping=None):
+        self._data = mapping if mapping is not None else data
+        self._mapping = mapping
+        self._view = memoryview(self._data).toreadonly()
+
+    @property
+    def buffer(self):
+        """A read-only memoryview of the whole output. Read-only."""
+        return self._view
+
+    @property
+    def spilled(self):
+        """Whether the output exceeded the memory limit and was spilled to a file. Read-only."""
+        return self._mapping is not None
+
+    def __len__(self):
+        return len(self._view)
+
+    def __getitem__(self, index):
+        return self._view[index]
+
+    def find(self, sub, start=0, end=None):
+        """Return the lowest index at which `sub` is found within `[start, end)`, or -1."""
+        return self._data.find(sub, start, len(self._view) if end is None else end)
+
+    def iter_lines(self, keepends=False):
+        """Iterate over the lines of the output as bytes, split on newlines, copying only one line at a time.
+
+        Parameters
+        ----------
+        keepends: bool, optional
+            Whether to include the trailing newline of each line.
+        """
+        view = self._view
+        begin = 0
+        end = self._data.find(b"\n")
+        while end >= 0:
+            yield view[begin:end + 1 if keepends else end].tobytes()
+            begin = end + 1
+            end = self._data.find(b"\n", begin)
+        if begin < len(view):
+            yield view[begin:].tobytes()
+
+    def tobytes(self):
+        """Return a copy of the whole output as bytes."""
+        return self._view.tobytes()
+
+    def close(self):
+        """Release the output. Slices taken from it must have been released beforehand."""
+        self._view.release()
+        if self._mapping is not None:
+            self._mapping.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+class SharedInput():
+    """An input payload written once into a sealed memfd, which any number of child processes can read as their
+    standard input without the parent copying it again for each of them.
+
+    Can be supplied to ChildProcessBuilder.stdin. Every process is given its own file description of the payload,
+    reading from its start, which it may also seek in or memory-map. Where memfd is unavailable, an unlinked-on-close
+    temporary file is used instead, without the seals.
+
+    May be used with Python's `with` statement - upon the exit of the block, the payload is closed. Processes which
+    have already been created keep reading it."""
+    def __init__(self, data, name="childprocess-input"):
+        """
+        Parameters
+        ----------
+        data: str or bytes-like
+            The payload. Strings are encoded as UTF-8.
+        name: str, optional
+            The name of the memfd, as shown in /proc/<pid>/fd."""
+        if isinstance(data, str):
+            data = data.encode()
+        view = memoryview(data).cast("B")
+        self._size = len(view)
+        # Set before anything can fail, for close()
+        self._fd = None
+        self._path = None
+        self._unlink = False
+        if hasattr(os, "memfd_create"):
+            self._fd = os.memfd_create(name, os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+        else:
+            self._fd, self._path = tempfile.mkstemp(prefix=name)
+            self._unlink = True
+        try:
+            while view:
+                view = view[os.write(self._fd, view):]
+            if not self._unlink:
+                fcntl.fcntl(self._fd, fcntl.F_ADD_SEALS,
+                            fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW | fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SEAL)
+                self._path = "/proc/self/fd/{}".format(self._fd)
+        except BaseException:
+            self.close()
+            raise
+
+    @property
+    def size(self):
+        """The size of the payload in bytes. Read-only."""
+        return self._size
+
+    def fileno(self):
+        """Return the file descriptor holding the payload."""
+        return self._fd
+
+    def open(self):
+        """Return a new read-only file object for the payload, positioned at its start."""
+        if self._fd is None:
+            raise ValueError("The shared input is closed")
+        return open(self._path, "rb", buffering=0)
+
+    def mmap(self):
+        """Return a read-only memory mapping of the payload."""
+        if self._size == 0:
+            raise ValueError("An empty payload cannot be memory-mapped")
+        return mmap.mmap(self._fd, self._size, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """Release the payload."""
+        if self._fd is not None:
+            os.close(self._fd)
+            if self._unlink:
+                os.unlink(self._path)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+class SpawnEngine(Enum):
+    """The mechanism used to create a ChildProcess.
+
+    Can be supplied to ChildProcessBuilder.engine.
+
+    Values:
+    AUTO - Use POSIX_SPAWN whenever the requested setup can be expressed with it, and POPEN otherwise
+    POPEN - Create the process with `subprocess.Popen`
+    POSIX_SPAWN - Create the process with `os.posix_spawn`, which avoids copying the page tables of a large parent.
+        Only possible if the platform supports it, the working directory is the parent's, and each standard
+        stream is a pipe or has a file descriptor"""
+    AUTO = 1
+    POPEN = 2
+    POSIX_SPAWN = 3
+
+class IOPriorityClass(Enum):
+    """The I/O scheduling class of a child process, as used by ChildProcessBuilder.ionice.
+
+    Values:
+    REALTIME - Always served first. Usually requires privileges
+    BEST_EFFORT - The default class, served according to a priority level
+    IDLE - Only served when no other process needs the disk"""
+    REALTIME = 1
+    BEST_EFFORT = 2
+    IDLE = 3
+
+class ControlGroup():
+    """A cgroup v2 directory into which child processes are placed, optionally limiting their combined CPU and memory.
+
+    Can be supplied to ChildProcessBuilder.cgroup. The directory is created (along with its limits) when the first
+    process is spawned into it, which requires write access to its parent in the cgroup hierarchy."""
+    def __init__(self, path, cpu_max=None, memory_max=None):
+        """
+        Parameters
+        ----------
+        path: str
+            The path of the cgroup directory. Relative paths are taken relative to /sys/fs/cgroup.
+        cpu_max: optional
+            The CPU bandwidth limit of the cgroup, as a number of CPUs (such as 1.5), or as the raw contents of
+            cpu.max (such as "150000 100000").
+        memory_max: optional
+            The memory limit of the cgroup, in bytes or as the raw contents of memory.max (such as "1G")."""
+        self.path = os.path.join("/sys/fs/cgroup", path)
+        if isinstance(cpu_max, (int, float)):
+            cpu_max = "{} 100000".format(int(cpu_max * 100000))
+        self.cpu_max = cpu_max
+        self.memory_max = None if memory_max is None else str(memory_max)
+        self._prepared = False
+
+    def prepare(self):
+        """Create the cgroup directory and apply its limits, if not done already."""
+        if self._prepared:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        for name, value in (("cpu.max", self.cpu_max), ("memory.max", self.memory_max)):
+            if value is not None:
+                with open(os.path.join(self.path, name), "w") as f:
+                    f.write(value)
+        self._prepared = True
+
+# ioprio_set has no wrapper in libc or in the os module
+_IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "riscv64": 30, "armv7l": 314,
+                        "ppc64le": 273, "ppc64": 273, "s390x": 282}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+class _ProcessControls():
+    """Resource limits, scheduling, and cgroup placement applied in a child process before it executes."""
+    def __init__(self, rlimits, cpu_affinity, nice, ionice, cgroup):
+        self.rlimits = rlimits
+        self.cpu_affinity = cpu_affinity
+        self.nice = nice
+        self.ionice = ionice
+        self.cgroup = cgroup
+        self._syscall = None
+        if ionice is not None:
+            number = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+            if number is None:
+                raise OSError("No platform support for setting I/O priority")
+            # Looked up before forking, as the child must not take locks another thread may hold
+            libc = ctypes.CDLL(None, use_errno=True)
+            priority = (ionice[0].value << _IOPRIO_CLASS_SHIFT) | ionice[1]
+            self._syscall = (libc.syscall, number, priority)
+
+    def prepare(self):
+        """Perform the setup which happens in the parent process before spawning."""
+        if self.cgroup is not None:
+            self.cgroup.prepare()
+            self._procs_path = os.path.join(self.cgroup.path, "cgroup.procs")
+
+    def apply(self):
+        """Apply the controls to the current process. Runs in the child, between fork and exec, so that the
+        controls hold from the first instruction of the executed program."""
+        if self.cgroup is not None:
+            fd = os.open(self._procs_path, os.O_WRONLY)
+            try:
+                # cgroup v2 reads 0 as the writing process
+                os.write(fd, b"0")
+            finally:
+                os.close(fd)
+        for limit, value in self.rlimits.items():
+            resource.setrlimit(limit, value)
+        if self.cpu_affinity is not None:
+            os.sched_setaffinity(0, self.cpu_affinity)
+        if self.nice is not None:
+            os.nice(self.nice)
+        if self._syscall is not None:
+            syscall, number, priority = self._syscall
+            if syscall(number, _IOPRIO_WHO_PROCESS, 0, priority) != 0:
+                raise OSError(ctypes.get_errno(), "Failed to set I/O priority")
+
+class _PosixSpawnProcess():
+    """The subset of the `subprocess.Popen` interface used by ChildProcess, for a process created by `os.posix_spawn`.
+
+    Accepts the same stdin/stdout/stderr values as Popen."""
+    def __init__(self, executable, args, env, stdin, stdout, stderr):
+        self.args = args
+        self.returncode = None
+        self.stdin = self.stdout = self.stderr = None
+        self._waitpid_lock = threading.Lock()
+
+        file_actions = []
+        child_fds = []
+        parent_fds = {}
+        try:
+            for target, source in enumerate((stdin, stdout, stderr)):
+                if source == subprocess.PIPE:
+                    read_fd, write_fd = os.pipe()
+                    child_fd, parent_fds[target] = (read_fd, write_fd) if target == 0 else (write_fd, read_fd)
+                    child_fds.append(child_fd)
+                elif source == subprocess.STDOUT:
+                    child_fd = 1
+                elif source is None:
+                    continue
+                else:
+                    child_fd = source.fileno()
+                    if child_fd < 3 and child_fd != target:
+                        # Avoid clobbering a standard descriptor which a later action still needs
+                        child_fd = os.dup(child_fd)
+                        child_fds.append(child_fd)
+                if child_fd != target:
+                    file_actions.append((os.POSIX_SPAWN_DUP2, child_fd, target))
+
+            # Like Popen's restore_signals, so the child is not left ignoring the signals Python ignores
+            self.pid = os.posix_spawn(executable, args, env, file_actions=file_actions,
+                                      setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        except:
+            for fd in parent_fds.values():
+                os.close(fd)
+            raise
+        finally:
+            for fd in child_fds:
+                os.close(fd)
+
+        if 0 in parent_fds:
+            self.stdin = io.open(parent_fds[0], "wb")
+        if 1 in parent_fds:
+            self.stdout = io.open(parent_fds[1], "rb")
+        if 2 in parent_fds:
+            self.stderr = io.open(parent_fds[2], "rb")
+
+    @staticmethod
+    def resolve(args, env, cwd, stdio, executable=None):
+        """Return the path of the executable to spawn, or None if the setup cannot be expressed with posix_spawn.
+
+        `executable`, if provided, is a path which has already been resolved. If the executable cannot be found on
+        the PATH, raise a FileNotFoundError."""
+        if not hasattr(os, "posix_spawn") or not args:
+            return None
+        if cwd is not None and os.path.abspath(cwd) != os.getcwd():
+            return None
+        for source in stdio:
+            if source in (subprocess.PIPE, subprocess.STDOUT, None):
+                continue
+            try:
+                source.fileno()
+            except (AttributeError, OSError, ValueError):
+                return None
+        if executable is not None:
+            return executable
+        if os.sep in args[0]:
+            return args[0]
+        path = shutil.which(args[0], path=(env if env is not None else os.environ).get("PATH", os.defpath))
+        if path is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), args[0])
+        return path
+
+    def _set_status(self, status):
+        self.returncode = os.waitstatus_to_exitcode(status)
+
+    def poll(self):
+        if self.returncode is None and self._waitpid_lock.acquire(False):
+            try:
+                if self.returncode is None:
+                    pid, status = os.waitpid(self.pid, os.WNOHANG)
+                    if pid == self.pid:
+                        self._set_status(status)
+            except ChildProcessError:
+                self.returncode = 0
+            finally:
+                self._waitpid_lock.release()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            with self._waitpid_lock:
+                if self.returncode is None:
+                    try:
+                        self._set_status(os.waitpid(self.pid, 0)[1])
+                    except ChildProcessError:
+                        self.returncode = 0
+            return self.returncode
+
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while self.poll() is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class _Reactor():
+    """A single background thread which dispatches file descriptor readiness callbacks for the whole process.
+
+    Callbacks are invoked as `callback(fd, mask)` on the reactor thread, and must not block."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._thread = None
+
+    def _reset(self):
+        """Forget the reactor thread, which does not survive into a forked child."""
+        self._lock = threading.Lock()
+        self._pending.clear()
+        self._thread = None
+
+    def _start(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._run, name="childprocess-reactor", daemon=True)
+        self._thread.start()
+
+    def call_soon(self, function, *args):
+        """Run `function(*args)` on the reactor thread, starting it if necessary."""
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            self._pending.append((function, args))
+        try:
+            os.write(self._wakeup_write, b"\0")
+        except BlockingIOError:
+            pass
+
+    def _call(self, function, *args):
+        if threading.current_thread() is self._thread:
+            function(*args)
+        else:
+            self.call_soon(function, *args)
+
+    def register(self, fd, events, callback):
+        """Invoke `callback` whenever `fd` is ready for any of `events`."""
+        self._call(self._selector_register, fd, events, callback)
+
+    def modify(self, fd, events, callback):
+        """Change the events and callback registered for `fd`."""
+        self._call(self._selector_modify, fd, events, callback)
+
+    def unregister(self, fd):
+        """Stop watching `fd`. Must be called before `fd` is closed."""
+        self._call(self._selector_unregister, fd)
+
+    def _selector_register(self, fd, events, callback):
+        self._selector.register(fd, events, callback)
+
+    def _selector_modify(self, fd, events, callback):
+        self._selector.modify(fd, events, callback)
+
+    def _selector_unregister(self, fd):
+        try:
+            self._selector.unregister(fd)
+        except KeyError:
+            pass
+
+    def _run(self):
+        fd_map = self._selector.get_map()
+        while True:
+            for key, mask in self._selector.select():
+                if key.data is None:
+                    try:
+                        while os.read(self._wakeup_read, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif fd_map.get(key.fd) is key:
+                    self._invoke(key.data, key.fd, mask)
+
+            with self._lock:
+                pending, self._pending = self._pending, deque()
+            for function, args in pending:
+                self._invoke(function, *args)
+
+    def _invoke(self, function, *args):
+        try:
+            function(*args)
+        except Exception:
+            traceback.print_exc()
+
+_reactor = _Reactor()
+os.register_at_fork(after_in_child=_reactor._reset)
+
+class _TailBuffer():
+    """Drains a pipe on the reactor thread, retaining a bounded tail of its contents."""
+    def __init__(self, capture, stream):
+        self._max_bytes = capture.max_bytes
+        self._max_lines = capture.max_lines
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._stream = stream
+        self._fd = stream.fileno()
+        os.set_blocking(self._fd, False)
+        _reactor.register(self._fd, selectors.EVENT_READ, self._on_readable)
+
+    def _on_readable(self, fd, mask):
+        with self._lock:
+            self._read()
+
+    def drain(self):
+        """Read everything which is currently buffered in the pipe, such as once the process has exited."""
+        with self._lock:
+            while self._read():
+                pass
+
+    def _read(self):
+        """Read one chunk of output, returning false if nothing remains to be read for now."""
+        if self._stream.closed:
+            return False
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return False
+        if not data:
+            _reactor.unregister(self._fd)
+            self._stream.close()
+            return False
+
+        buf = self._buffer
+        buf += data[-self._max_bytes:]
+        if len(buf) > self._max_bytes:
+            # Deleting from the front of a bytearray does not move its contents
+            del buf[:len(buf) - self._max_bytes]
+        if self._max_lines is not None:
+            excess = buf.count(b"\n") - self._max_lines
+            end = -1
+            for _ in range(excess):
+                end = buf.find(b"\n", end + 1)
+            if end >= 0:
+                del buf[:end + 1]
+        return True
+
+    def contents(self):
+        """Return a snapshot of the retained tail."""
+        with self._lock:
+            return bytes(self._buffer)
+
+class _SpillBuffer():
+    """Drains a pipe on the reactor thread, keeping its contents in memory up to a limit and in an anonymous file
+    beyond it."""
+    def __init__(self, capture, stream):
+        self._memory_limit = capture.memory_limit
+        self._directory = capture.directory
+        self._buffer = bytearray()
+        self._file = None
+        self._copier = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stream = stream
+        self._fd = stream.fileno()
+        os.set_blocking(self._fd, False)
+        _reactor.register(self._fd, selectors.EVENT_READ, self._on_readable)
+
+    def _on_readable(self, fd, mask):
+        with self._lock:
+            self._read()
+
+    def drain(self):
+        """Read everything which is currently buffered in the pipe, such as once the process has exited."""
+        with self._lock:
+            while self._read():
+                pass
+
+    def _read(self):
+        """Move one chunk of output, returning false if nothing remains to be read for now."""
+        if self._stream.closed:
+            return False
+        try:
+            if self._copier is not None:
+                data = None
+                moved = self._copier.step(1024 * 1024)
+            else:
+                data = os.read(self._fd, 65536)
+                moved = len(data)
+        except BlockingIOError:
+            return False
+        if not moved:
+            _reactor.unregister(self._fd)
+            self._stream.close()
+            return False
+
+        self._size += moved
+        if data is not None:
+            self._buffer += data
+            if len(self._buffer) > self._memory_limit:
+                self._spill()
+        return True
+
+    def _spill(self):
+        if self._directory is None and hasattr(os, "memfd_create"):
+            self._file = open(os.memfd_create("childprocess-capture", os.MFD_CLOEXEC), "w+b", buffering=0)
+        else:
+            self._file = tempfile.TemporaryFile(dir=self._directory, buffering=0)
+        view = memoryview(self._buffer)
+        while view:
+            view = view[self._file.write(view):]
+        view.release()
+        self._buffer = bytearray()
+        self._copier = _Copier(self._fd, self._file.fileno())
+
+    def contents(self):
+        """Return the output captured so far, as a CapturedOutput."""
+        with self._lock:
+            if self._file is None:
+                return CapturedOutput(bytes(self._buffer))
+            return CapturedOutput(None, mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ))
+
+# Notified whenever the reaper records the exit of any ChildProcess
+_exit_condition = threading.Condition()
+
+def _watch_exit(process):
+    """Have the reactor reap `process` as soon as it exits. Returns false if pidfds are unsupported."""
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        return False
+
+    def on_exit(fd, mask):
+        _reactor.unregister(fd)
+        os.close(fd)
+        process._reap()
+
+    _reactor.register(pidfd, selectors.EVENT_READ, on_exit)
+    return True
+
+def wait_for_any(processes, timeout=None):
+    """Block until at least one of `processes` has finished. May optionally wait up to a maximum length of time
+
+    Parameters
+    ----------
+    processes: iterable of ChildProcess
+        The processes to wait on.
+    timeout: int, optional
+        Amount of time in seconds to wait for a process to finish.
+
+    Returns
+    -------
+    list
+        The processes which have finished, in the order given. Empty if the timeout expired first.
+    """
+    processes = list(processes)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    if _wait_until(lambda: not processes or any(process.is_finished() for process in processes), processes, deadline):
+        return [process for process in processes if process.is_finished()]
+    return []
+
+def _wait_until(condition, processes, deadline):
+    """Block until `condition()` holds, re-evaluating it whenever one of `processes` exits.
+
+    Returns false if the monotonic `deadline` passed first."""
+    with _exit_condition:
+        while not condition():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            if not all(process._watched for process in processes):
+                # Processes without a pidfd can only be polled
+                remaining = 0.01 if remaining is None else min(remaining, 0.01)
+            _exit_condition.wait(remaining)
+    return True
+
+def _read_io_counters(pid):
+    """Return the I/O accounting of a process from /proc/<pid>/io as a dictionary, or None if unavailable.
+
+    Remains readable until the process is reaped."""
+    try:
+        with open("/proc/{}/io".format(pid), "rb") as f:
+            return {key.decode(): int(value) for key, value in (line.split(b": ") for line in f)}
+    except (OSError, ValueError):
+        return None
+
+def _read_process_state(pid):
+    """Return the scheduler state letter of a process from /proc/<pid>/stat, such as "T" if it is stopped, or None
+    if unavailable."""
+    try:
+        with open("/proc/{}/stat".format(pid), "rb") as f:
+            stat_line = f.read()
+    except OSError:
+        return None
+    # The command name is parenthesized and may itself contain parentheses and spaces
+    fields = stat_line[stat_line.rfind(b")") + 2:].split(b" ", 1)
+    return fields[0].decode() if fields[0] else None
+
+def read_pressure(resource="cpu", window="avg10"):
+    """Return the share of time, in percent, in which some tasks were stalled on a resource, from Linux pressure
+    stall information, or None if unavailable.
+
+    Parameters
+    ----------
+    resource: str, optional
+        "cpu", "memory", or "io".
+    window: str, optional
+        The averaging window - "avg10", "avg60", or "avg300".
+    """
+    try:
+        with open("/proc/pressure/{}".format(resource)) as f:
+            for line in f:
+                if line.startswith("some "):
+                    fields = dict(field.split("=") for field in line.split()[1:])
+                    return float(fields[window])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+def _set_pipe_size(fd, size):
+    """Resize the kernel buffer of the pipe `fd`, returning its resulting size, or None if unsupported."""
+    if not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return None
+    try:
+        return fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except OSError:
+        return fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+
+def _pipe_bytes_available(fd):
+    """Return the number of bytes waiting to be read from the pipe `fd`."""
+    count = array.array("i", [0])
+    fcntl.ioctl(fd, termios.FIONREAD, count, True)
+    return count[0]
+
+def _pipe_free_space(fd):
+    """Return how many bytes can be written to the writeable pipe `fd` without blocking."""
+    if not hasattr(fcntl, "F_GETPIPE_SZ"):
+        return select.PIPE_BUF
+    return max(fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ) - _pipe_bytes_available(fd), select.PIPE_BUF)
+
+def _fd_of(obj):
+    if isinstance(obj, int):
+        return obj
+    if hasattr(obj, "flush"):
+        obj.flush()
+    return obj.fileno()
+
+class Counter():
+    """A monotonically increasing metric. Obtain instances from MetricsRegistry.counter()."""
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increase the counter by `amount`."""
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        """The current value of the counter. Read-only."""
+        return self._value
+
+    def _samples(self):
+        return [(self.name, {}, self._value)]
+
+class Histogram():
+    """A metric counting observations into cumulative buckets. Obtain instances from MetricsRegistry.histogram()."""
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self._bounds = sorted(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one observation of `value`."""
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @property
+    def count(self):
+        """The number of observations. Read-only."""
+        return sum(self._counts)
+
+    @property
+    def sum(self):
+        """The sum of all observations. Read-only."""
+        return self._sum
+
+    def buckets(self):
+        """Return a list of `(upper bound, cumulative count)` pairs, ending with an infinite bound."""
+        with self._lock:
+            counts = list(self._counts)
+        cumulative = 0
+        result = []
+        for bound, count in zip(self._bounds + [float("inf")], counts):
+            cumulative += count
+            result.append((bound, cumulative))
+        return result
+
+    def _samples(self):
+        samples = [(self.name + "_bucket", {"le": "+Inf" if bound == float("inf") else repr(bound)}, count)
+                   for bound, count in self.buckets()]
+        samples.append((self.name + "_sum", {}, self._sum))
+        samples.append((self.name + "_count", {}, samples[-2][2]))
+        return samples
+
+class MetricsRegistry():
+    """A set of named counters and histograms which can be dumped as a dictionary or scraped in the Prometheus
+    text exposition format.
+
+    The module-level `metrics` registry records the spawn latency, lifetime, CPU time and peak memory of every
+    ChildProcess."""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help=""):
+        """Return the counter called `name`, creating it if necessary."""
+        return self._get(name, lambda: Counter(name, help), Counter)
+
+    def histogram(self, name, help="", buckets=None):
+        """Return the histogram called `name`, creating it with the given bucket upper bounds if necessary.
+
+        The default buckets are powers of 4 from 1e-4 to roughly 1e5."""
+        if buckets is None:
+            buckets = [1e-4 * 4 ** i for i in range(16)]
+        return self._get(name, lambda: Histogram(name, help, buckets), Histogram)
+
+    def _get(self, name, create, kind):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = create()
+        if not isinstance(metric, kind):
+            raise TypeError("Metric {} is not a {}".format(name, kind.__name__))
+        return metric
+
+    def snapshot(self):
+        """Return the current value of every metric, as a dictionary from metric name to either a counter value,
+        or a dictionary with the `count`, `sum`, and cumulative `buckets` of a histogram."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        result = {}
+        for metric in metrics:
+            if isinstance(metric, Counter):
+                result[metric.name] = metric.value
+            else:
+                result[metric.name] = {"count": metric.count, "sum": metric.sum, "buckets": metric.buckets()}
+        return result
+
+    def to_prometheus(self):
+        """Return every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            if metric.help:
+                lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, "counter" if isinstance(metric, Counter) else "histogram"))
+            for name, labels, value in metric._samples():
+                label_text = ",".join('{}="{}"'.format(k, v) for k, v in labels.items())
+                lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+_spawns = metrics.counter("childprocess_spawns_total", "Child processes created")
+_exits = metrics.counter("childprocess_exits_total", "Child processes which have exited")
+_spawn_latency = metrics.histogram("childprocess_spawn_latency_seconds", "Time taken to create a child process")
+_lifetime = metrics.histogram("childprocess_lifetime_seconds", "Time from creation to exit of a child process")
+_cpu_time = metrics.histogram("childprocess_cpu_seconds", "User and system CPU time consumed by a child process")
+_max_rss = metrics.histogram("childprocess_max_rss_bytes", "Peak resident set size of a child process",
+                             [2 ** i for i in range(16, 40, 2)])
+
+class _Copier():
+    """Moves data from one file descriptor to another, without copying it through user space where the kernel
+    supports it.
+
+    splice is used if either end is a pipe, then copy_file_range between regular files, then sendfile from a
+    regular file, and finally a read/write loop through a reusable buffer. A mechanism which the kernel rejects for
+    a particular pair of files is abandoned in favor of the next one."""
+    _ZERO_COPY_ERRORS = (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EBADF)
+
+    def __init__(self, src_fd, dst_fd, buffer_size=65536):
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        self.transferred = 0
+        src_mode = os.fstat(src_fd).st_mode
+        dst_mode = os.fstat(dst_fd).st_mode
+
+        self._methods = []
+        if hasattr(os, "splice") and (stat.S_ISFIFO(src_mode) or stat.S_ISFIFO(dst_mode)):
+            self._methods.append(self._splice)
+        if hasattr(os, "copy_file_range") and stat.S_ISREG(src_mode) and stat.S_ISREG(dst_mode):
+            self._methods.append(self._copy_file_range)
+        if hasattr(os, "sendfile") and stat.S_ISREG(src_mode):
+            self._methods.append(self._sendfile)
+        self._methods.append(self._copy)
+        self._buffer = None
+        self._buffer_size = buffer_size
+
+    def _splice(self, count):
+        return os.splice(self.src_fd, self.dst_fd, count, flags=os.SPLICE_F_MOVE)
+
+    def _copy_file_range(self, count):
+        return os.copy_file_range(self.src_fd, self.dst_fd, count)
+
+    def _sendfile(self, count):
+        return os.sendfile(self.dst_fd, self.src_fd, None, count)
+
+    def _copy(self, count):
+        if self._buffer is None:
+            self._buffer = memoryview(bytearray(self._buffer_size))
+        read = os.readv(self.src_fd, [self._buffer[:min(count, self._buffer_size)]])
+        written = 0
+        while written < read:
+            written += os.write(self.dst_fd, self._buffer[written:read])
+        return read
+
+    def step(self, count):
+        """Move up to `count` bytes, returning the number moved, which is 0 only at the end of the source."""
+        while True:
+            try:
+                moved = self._methods[0](count)
+            except OSError as e:
+                if e.errno not in self._ZERO_COPY_ERRORS or len(self._methods) == 1 or self.transferred:
+                    raise
+                self._methods.pop(0)
+                continue
+            self.transferred += moved
+            return moved
+
+def _transfer(feeds, drains, deadline):
+    """Move data until every source is exhausted and every pipe has reached EOF, returning the bytes moved by each.
+
+    `feeds` is a list of `(source, stdin)` and `drains` a list of `(stdout, destination)` pairs, where stdin and
+    stdout are the parent's ends of pipes to child processes, which are closed once done. Each operation on such a
+    pipe is sized to what it can accept or provide without blocking, so only the other side (an external file,
+    socket, or pipe) can block."""
+    feed_copiers = [_Copier(_fd_of(source), _fd_of(stdin)) for source, stdin in feeds]
+    drain_copiers = [_Copier(stdout.fileno(), _fd_of(destination)) for stdout, destination in drains]
+    with selectors.DefaultSelector() as selector:
+        for copier, (_, stdin) in zip(feed_copiers, feeds):
+            selector.register(copier.dst_fd, selectors.EVENT_WRITE, (copier, stdin))
+        for copier, (stdout, _) in zip(drain_copiers, drains):
+            selector.register(copier.src_fd, selectors.EVENT_READ, (copier, stdout))
+
+        while selector.get_map():
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                raise subprocess.TimeoutExpired(None, None)
+            for key, mask in selector.select(timeout):
+                copier, pipe = key.data
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        done = copier.step(_pipe_free_space(key.fd)) == 0
+                    else:
+                        done = copier.step(max(_pipe_bytes_available(key.fd), 1)) == 0
+                except BrokenPipeError:
+                    done = True
+                if done:
+                    selector.unregister(key.fd)
+                    pipe.close()
+    return [c.transferred for c in feed_copiers], [c.transferred for c in drain_copiers]
+
+class _Communication():
+    """The progress of ChildProcess.communicate, kept so that it can be resumed after a timeout."""
+    def __init__(self, process, input):
+        popen = process._popen
+        self._chunks = {}
+        self._streams = {}
+        self._input = iter(())
+        self._current = process._pending_input or memoryview(b"")
+        process._pending_input = None
+
+        self._names = {}
+        self._stdin_fd = None
+        if process._stdin_writeable and not popen.stdin.closed:
+            popen.stdin.flush()
+            self._input = self._input_chunks(input)
+            self._stdin_fd = popen.stdin.fileno()
+            self._streams[self._stdin_fd] = popen.stdin
+        for name, readable in (("stdout", process._stdout_readable), ("stderr", process._stderr_readable)):
+            stream = getattr(popen, name)
+            if readable and not stream.closed:
+                self._chunks[name] = []
+                self._names[stream.fileno()] = name
+                self._streams[stream.fileno()] = stream
+
+    @staticmethod
+    def _input_chunks(input):
+        if input is None:
+            return
+        if isinstance(input, str):
+            input = input.encode()
+        if isinstance(input, (bytes, bytearray, memoryview)):
+            yield memoryview(input)
+        elif hasattr(input, "read"):
+            while True:
+                chunk = input.read(65536)
+                if not chunk:
+                    return
+                yield memoryview(chunk.encode() if isinstance(chunk, str) else chunk)
+        else:
+            for chunk in input:
+                yield memoryview(chunk.encode() if isinstance(chunk, str) else chunk)
+
+    def _next_chunk(self):
+        for chunk in self._input:
+            if chunk:
+                return chunk
+        return None
+
+    def _close(self, fd):
+        self._streams.pop(fd).close()
+
+    def run(self, deadline):
+        """Exchange data with the process until all of its pipes are closed, or the deadline passes."""
+        if not self._streams:
+            return
+        with selectors.DefaultSelector() as selector:
+            for fd in self._streams:
+                os.set_blocking(fd, False)
+                selector.register(fd, selectors.EVENT_WRITE if fd == self._stdin_fd else selectors.EVENT_READ)
+
+            try:
+                while self._streams:
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        raise subprocess.TimeoutExpired(None, None)
+                    for key, _ in selector.select(timeout):
+                        if key.fd == self._stdin_fd:
+                            self._write(key.fd, selector)
+                        else:
+                            data = os.read(key.fd, 65536)
+                            if data:
+                                self._chunks[self._names[key.fd]].append(data)
+                            else:
+                                selector.unregister(key.fd)
+                                self._close(key.fd)
+            finally:
+                # The streams remain usable directly after a timeout
+                for fd in self._streams:
+                    os.set_blocking(fd, True)
+
+    def _write(self, fd, selector):
+        try:
+            while True:
+                if not self._current:
+                    self._current = self._next_chunk()
+                    if self._current is None:
+                        break
+                written = os.write(fd, self._current)
+                self._current = self._current[written:]
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            pass
+        selector.unregister(fd)
+        self._close(fd)
+
+    def output(self):
+        """Return the `(stdout, stderr)` bytes read so far."""
+        return tuple(b"".join(self._chunks[name]) if name in self._chunks else None for name in ("stdout", "stderr"))
+
+_TABLE_TYPES = (int, float, str, bytes)
+_TABLE_TYPECODES = {int: "q", float: "d"}
+
+class Table():
+    """Columns of tabular output parsed by ChildProcess.read_table() or ChildProcess.iter_tables().
+
+    Each column is a NumPy array if NumPy is installed. Otherwise, integer and float columns are `array.array`s
+    of typecode "q" and "d", and string and bytes columns are lists."""
+    def __init__(self, columns):
+        self._columns = dict(columns)
+
+    @property
+    def names(self):
+        """The names of the columns, in schema order. Read-only."""
+        return list(self._columns)
+
+    @property
+    def columns(self):
+        """A read-only mapping of column names to columns."""
+        return MappingProxyType(self._columns)
+
+    def __getitem__(self, name):
+        return self._columns[name]
+
+    def __len__(self):
+        return len(next(iter(self._columns.values()), ()))
+
+    def rows(self):
+        """Iterate over the rows of the table as tuples, in schema order."""
+        return zip(*self._columns.values())
+
+    def _slice(self, start, end=None):
+        return Table((name, column[start:end]) for name, column in self._columns.items())
+
+    @staticmethod
+    def _concatenate(tables):
+        if len(tables) == 1:
+            return tables[0]
+        columns = {}
+        for name, first in tables[0]._columns.items():
+            if numpy is not None:
+                columns[name] = numpy.concatenate([table._columns[name] for table in tables])
+            else:
+                columns[name] = first[:0]
+                for table in tables:
+                    columns[name].extend(table._columns[name])
+        return Table(columns)
+
+def _table_schema(schema, widths):
+    """Validate a table schema and column widths, returning the schema as a list of (name, type) pairs."""
+    schema = list(schema.items() if isinstance(schema, dict) else schema)
+    if not schema:
+        raise ValueError("The schema must name at least one column")
+    for name, kind in schema:
+        if kind not in _TABLE_TYPES:
+            raise TypeError("The type of column {!r} must be one of int, float, str or bytes".format(name))
+    if widths is not None and (len(widths) != len(schema) or any(width <= 0 for width in widths)):
+        raise ValueError("There must be one positive width per column")
+    return schema
+
+def _convert_column(values, kind, encoding):
+    """Convert a list of bytes fields to a column of the given type, without NumPy."""
+    if kind in _TABLE_TYPECODES:
+        return array.array(_TABLE_TYPECODES[kind], map(kind, values))
+    values = [value.strip() for value in values]
+    return [value.decode(encoding) for value in values] if kind is str else values
+
+def _parse_table(data, schema, delimiter, widths, encoding):
+    """Parse complete, newline-terminated rows of delimited or fixed-width fields into a Table.
+
+    Rows are parsed a block at a time, either by NumPy's C parsers or, without NumPy, by splitting the whole block
+    at once and converting each column with a single `map`, rather than splitting and converting row by row."""
+    count = len(schema)
+    if numpy is not None:
+        dtypes = {int: numpy.int64, float: numpy.float64, str: object, bytes: object}
+        if not data:
+            return Table((name, numpy.empty(0, dtypes[kind])) for name, kind in schema)
+    if widths is not None:
+        row_size = sum(widths) + 1
+        if len(data) % row_size or data.count(b"\n") != len(data) // row_size:
+            raise ValueError("Every row must be exactly {} bytes wide".format(row_size - 1))
+        offsets = list(itertools.accumulate(widths, initial=0))
+        if numpy is not None:
+            fields = [("f{}".format(index), "S{}".format(width)) for index, width in enumerate(widths)]
+            records = numpy.frombuffer(data, dtype=fields + [("newline", "S1")])
+            columns = {}
+            for index, (name, kind) in enumerate(schema):
+                field = records["f{}".format(index)]
+                if kind in _TABLE_TYPECODES:
+                    columns[name] = field.astype(numpy.int64 if kind is int else numpy.float64)
+                else:
+                    field = numpy.char.strip(field)
+                    columns[name] = numpy.char.decode(field, encoding) if kind is str else field
+            return Table(columns)
+        return Table((name, _convert_column([data[row + offsets[index]:row + offsets[index + 1]]
+                                             for row in range(0, len(data), row_size)], kind, encoding))
+                     for index, (name, kind) in enumerate(schema))
+
+    if numpy is not None:
+        records = numpy.loadtxt(io.BytesIO(data), dtype=[(name, dtypes[kind]) for name, kind in schema],
+                                delimiter=delimiter.decode(encoding) if delimiter else None, comments=None,
+                                encoding=encoding, ndmin=1)
+        columns = {}
+        for name, kind in schema:
+            column = records[name]
+            if kind is bytes:
+                column = numpy.char.encode(column.astype(str), encoding)
+            columns[name] = numpy.ascontiguousarray(column)
+        return Table(columns)
+
+    # Splitting the whole block loses the row boundaries, so the columns of each row are counted beforehand - a
+    # ragged row would otherwise shift the fields of every row after it
+    lines = data.split(b"\n")[:-1]
+    if delimiter:
+        if b"\n\n" in data or data.startswith(b"\n"):
+            # Empty rows are skipped, as NumPy does
+            lines = list(filter(None, lines))
+        separators = list(map(bytes.count, lines, itertools.repeat(delimiter)))
+        if separators.count(count - 1) != len(lines):
+            index = next(index for index, length in enumerate(separators) if length != count - 1)
+            raise ValueError("Every row must have {} columns, but {!r} has {}".format(count, lines[index],
+                                                                                     separators[index] + 1))
+    else:
+        # Blank lines hold no fields, and are skipped
+        lengths = list(map(len, map(bytes.split, lines)))
+        if lengths.count(count) + lengths.count(0) != len(lines):
+            index = next(index for index, length in enumerate(lengths) if length not in (0, count))
+            raise ValueError("Every row must have {} columns, but {!r} has {}".format(count, lines[index],
+                                                                                     lengths[index]))
+    if not delimiter:
+        fields = data.split()
+    else:
+        fields = delimiter.join(lines).split(delimiter) if lines else []
+    return Table((name, _convert_column(fields[index::count], kind, encoding))
+                 for index, (name, kind) in enumerate(schema))
 
 class ChildProcess():
     """A child process.
 
     Should not be instantiated directly - instead, use ChildProcessBuilder.spawn() to get an instance.
 
+    Where the platform supports pidfds, the exit of the process is recorded by a process-wide reaper as soon as it
+    happens, so querying its status does not require any system calls.
+
     May be used with Python's `with` statement - upon the exit of the block, the process will be terminated non-forcefully.
     See `ChildProcess.terminate`"""
-    def __init__(self, args, env, cwd, stdin, stdout, stderr):
+    def __init__(self, args, env, cwd, stdin, stdout, stderr, engine=SpawnEngine.POPEN, executable=None,
+                 controls=None):
         self._args = args
         self._env = env
         self._cwd = cwd
+        self._exit_time = None
+        self._exit_callbacks = []
+        self._exited = threading.Event()
+        self._rusage = None
+        self._io_counters = None
+        self._spawn_monotonic = time.monotonic()
 
+        self._drained = {}
         popen_stdin, deferred_input = self._make_stdin(stdin)
         popen_stdout = self._make_stdout(stdout)
         popen_stderr = self._make_stderr(stderr)
 
         self._is_stopped = False
-        self._popen = subprocess.Popen(
-            args, cwd=cwd, env=env,
-            stdin=popen_stdin, stdout=popen_stdout, stderr=popen_stderr)
+        self._stopped_at = None
+        self._suspended_time = 0.0
+        self._popen = self._create(engine, executable, controls, popen_stdin, popen_stdout, popen_stderr)
+        if isinstance(stdin, SharedInput):
+            popen_stdin.close()
+        self._spawn_time = time.time()
+        self._spawn_latency = time.monotonic() - self._spawn_monotonic
+        _spawns.inc()
+        _spawn_latency.observe(self._spawn_latency)
+
+        self._tails = {}
+        for name, capture in self._drained.items():
+            buffer_class = _SpillBuffer if isinstance(capture, SpillCapture) else _TailBuffer
+            self._tails[name] = buffer_class(capture, getattr(self._popen, name))
+        self._communication = None
+        self._write_deferred_input(deferred_input)
+        self._watched = self._watch()
+
+    def _create(self, engine, executable, controls, stdin, stdout, stderr):
+        if controls is not None:
+            # The controls are applied between fork and exec, which posix_spawn cannot express
+            if engine == SpawnEngine.POSIX_SPAWN:
+                raise ValueError("The process's setup cannot be expressed with posix_spawn")
+            controls.prepare()
+            engine = SpawnEngine.POPEN
+        if engine != SpawnEngine.POPEN:
+            try:
+                resolved = _PosixSpawnProcess.resolve(self._args, self._env, self._cwd, (stdin, stdout, stderr),
+                                                      executable)
+            except FileNotFoundError:
+                if engine == SpawnEngine.POSIX_SPAWN:
+                    raise
+                # Popen reports the missing executable in its own way
+                resolved = None
+            if resolved is not None:
+                self._spawn_engine = SpawnEngine.POSIX_SPAWN
+                return _PosixSpawnProcess(resolved, self._args, self._env, stdin, stdout, stderr)
+            if engine == SpawnEngine.POSIX_SPAWN:
+                raise ValueError("The process's setup cannot be expressed with posix_spawn")
+
+        self._spawn_engine = SpawnEngine.POPEN
+        return subprocess.Popen(
+            self._args, executable=executable, cwd=self._cwd, env=self._env,
+            stdin=stdin, stdout=stdout, stderr=stderr, preexec_fn=controls.apply if controls else None)
+
+    def _watch(self):
+        return _watch_exit(self)
+
+    def _reap(self):
+        # The process has already exited, so this does not block for long
+        self._io_counters = _read_io_counters(self.pid)
+        popen = self._popen
+        with popen._waitpid_lock:
+            if popen.returncode is None:
+                try:
+                    _, status, self._rusage = os.wait4(popen.pid, 0)
+                    popen.returncode = os.waitstatus_to_exitcode(status)
+                except ChildProcessError:
+                    popen.returncode = 0
+        self._record_exit()
+
+    def _record_exit(self):
+        # Output written just before exiting must be captured once the process is finished
+        for tail in self._tails.values():
+            tail.drain()
+        with _exit_condition:
+            if self._exited.is_set():
+                return
+            self._exit_time = time.time()
+            self._exit_monotonic = time.monotonic()
+            self._exited.set()
+            callbacks, self._exit_callbacks = self._exit_callbacks, None
+            _exit_condition.notify_all()
+        _exits.inc()
+        _lifetime.observe(self._exit_monotonic - self._spawn_monotonic)
+        if self._rusage is not None:
+            _cpu_time.observe(self._rusage.ru_utime + self._rusage.ru_stime)
+            _max_rss.observe(self._rusage.ru_maxrss * 1024)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                traceback.print_exc()
+
+    def add_exit_callback(self, callback):
+        """Register `callback` to be called with this process as its argument once the process has exited.
+
+        Callbacks run on the reaper's background thread, and must not block. If the process has already exited,
+        `callback` is called immediately."""
+        with _exit_condition:
+            if not self._exited.is_set():
+                self._exit_callbacks.append(callback)
+                return
+        callback(self)
+
+    def _write_deferred_input(self, deferred_input):
+        # Write only as much as the pipe accepts without blocking - the rest is fed by communicate(), or before
+        # anything else is written to stdin
+        self._pending_input = memoryview(deferred_input) if deferred_input else None
+        if self._pending_input:
+            fd = self._popen.stdin.fileno()
+            os.set_blocking(fd, False)
+            try:
+                self._feed_pending_input(fd)
+            finally:
+                os.set_blocking(fd, True)
+
+    def _feed_pending_input(self, fd):
+        """Write pending input to `fd` until it is exhausted, or until a non-blocking `fd` is full."""
+        try:
+            while self._pending_input:
+                written = os.write(fd, self._pending_input)
+                self._pending_input = self._pending_input[written:]
+        except BlockingIOError:
+            pass
+
+    def _feed_input_in_background(self):
+        """Write any pending input on the reactor thread, then close stdin so that the process sees its end."""
+        stream = self._popen.stdin
 
-        if deferred_input:
-            self._popen.stdin.write(deferred_input)
+        def feed(fd, mask=None):
+            try:
+                self._feed_pending_input(fd)
+            except BrokenPipeError:
+                self._pending_input = None
+            if self._pending_input:
+                if mask is None:
+                    _reactor.register(fd, selectors.EVENT_WRITE, feed)
+                return
+            if mask is not None:
+                _reactor.unregister(fd)
+            stream.close()
+
+        fd = stream.fileno()
+        os.set_blocking(fd, False)
+        _reactor.call_soon(feed, fd)
 
     @property
     def args(self):
@@ -66,14 +1475,58 @@ class ChildProcess():
         """The system's pid for the child process. Read-only."""
         return self._popen.pid
 
+    @property
+    def spawn_engine(self):
+        """The SpawnEngine which was used to create the child process, either POPEN or POSIX_SPAWN. Read-only."""
+        return self._spawn_engine
+
     @property
     def exit_code(self):
         """Either the integer exit code of the child process, or None if it is still running. Read-only.
 
-        One can spin-wait for a child process to exit with `while process.exit_code is None`."""
-        self._popen.poll()
+        Rather than spin-waiting with `while process.exit_code is None`, prefer `wait_for_finish`, `wait_for_any`,
+        or `add_exit_callback`."""
+        if not self._watched:
+            self._popen.poll()
+            if self._popen.returncode is not None:
+                self._record_exit()
         return self._popen.returncode
 
+    @property
+    def spawn_time(self):
+        """The time (as given by `time.time()`) at which the process was created. Read-only."""
+        return self._spawn_time
+
+    @property
+    def spawn_latency(self):
+        """The number of seconds it took to create the process. Read-only."""
+        return self._spawn_latency
+
+    @property
+    def lifetime(self):
+        """The number of seconds from the creation of the process until its exit was recorded, or None if it is
+        still running. Read-only."""
+        if self.exit_time is None:
+            return None
+        return self._exit_monotonic - self._spawn_monotonic
+
+    @property
+    def rusage(self):
+        """The resource usage of the process, as a `resource.struct_rusage` collected when it was reaped, or None.
+        Read-only.
+
+        Includes user and system CPU time (ru_utime, ru_stime), peak resident set size (ru_maxrss, in KiB on
+        Linux), and context switches (ru_nvcsw, ru_nivcsw). Only available for processes reaped by the pidfd
+        reaper."""
+        return self._rusage
+
+    @property
+    def exit_time(self):
+        """The time (as given by `time.time()`) at which the process was found to have exited, or None. Read-only."""
+        if not self._watched:
+            self.exit_code
+        return self._exit_time
+
     @property
     def stdin(self):
         """The input stream for the child process, if it was created by ChildProcessIO.PIPE.
@@ -83,6 +1536,8 @@ class ChildProcess():
         Attempts to access an inaccessible child process file descriptor result in a RuntimeError."""
         if not self._stdin_writeable:
             raise RuntimeError("The process's stdin pipe is inaccessible")
+        if self._pending_input:
+            self._feed_pending_input(self._popen.stdin.fileno())
         return self._popen.stdin
 
     @property
@@ -103,25 +1558,91 @@ class ChildProcess():
             raise RuntimeError("The process's stderr pipe is inaccessible")
         return self._popen.stderr
 
-    def _make_stdin(self, stdin):
-        if stdin == ChildProcessIO.PIPE:
-            self._stdin_writeable = True
-            return subprocess.PIPE, None
-        elif stdin == ChildProcessIO.INHERIT:
-            self._stdin_writeable = False
-            return sys.stdin, None
-        elif stdin == ChildProcessIO.NULL:
-            self._stdin_writeable = False
-            return open(os.devnull, 'r'), None
-        elif isinstance(stdin, io.IOBase):
-            self._stdin_writeable = False
-            return stdin, None
+    @property
+    def stdout_tail(self):
+        """The retained tail of the child process's output, as bytes, if stdout was created by
+        ChildProcessIO.CAPTURE_TAIL or a TailCapture.
+
+        Attempts to access the tail of an output which is not captured result in a RuntimeError."""
+        return self._tail("stdout")
+
+    @property
+    def stderr_tail(self):
+        """The retained tail of the child process's error output, as bytes, if stderr was created by
+        ChildProcessIO.CAPTURE_TAIL or a TailCapture.
+
+        Attempts to access the tail of an output which is not captured result in a RuntimeError."""
+        return self._tail("stderr")
+
+    @property
+    def stdout_capture(self):
+        """The complete output of the child process, as a CapturedOutput, if stdout was created by
+        ChildProcessIO.CAPTURE_SPILL or a SpillCapture.
+
+        Attempts to access the capture of an output which is not captured, or before the process has finished,
+        result in a RuntimeError."""
+        return self._capture("stdout")
+
+    @property
+    def stderr_capture(self):
+        """The complete error output of the child process, as a CapturedOutput, if stderr was created by
+        ChildProcessIO.CAPTURE_SPILL or a SpillCapture.
+
+        Attempts to access the capture of an output which is not captured, or before the process has finished,
+        result in a RuntimeError."""
+        return self._capture("stderr")
+
+    def _tail(self, name):
+        if not isinstance(self._tails.get(name), _TailBuffer):
+            raise RuntimeError("The process's {} is not captured".format(name))
+        return self._tails[name].contents()
+
+    def _capture(self, name):
+        if not isinstance(self._tails.get(name), _SpillBuffer):
+            raise RuntimeError("The process's {} is not captured".format(name))
+        if not self.is_finished():
+            raise RuntimeError("The process has not finished")
+        self._tails[name].drain()
+        return self._tails[name].contents()
+
+    def _make_stdin(self, stdin):
+        if stdin == ChildProcessIO.PIPE:
+            self._stdin_writeable = True
+            return subprocess.PIPE, None
+        elif stdin == ChildProcessIO.INHERIT:
+            self._stdin_writeable = False
+            return sys.stdin, None
+        elif stdin == ChildProcessIO.NULL:
+            self._stdin_writeable = False
+            return open(os.devnull, 'r'), None
+        elif isinstance(stdin, io.IOBase):
+            self._stdin_writeable = False
+            return stdin, None
+        elif isinstance(stdin, SharedInput):
+            self._stdin_writeable = False
+            return stdin.open(), None
         else:
             self._stdin_writeable = True
-            return subprocess.PIPE, stdin
+            return subprocess.PIPE, stdin.encode() if isinstance(stdin, str) else stdin
+
+    def _make_drained(self, name, value):
+        if value == ChildProcessIO.CAPTURE_TAIL:
+            value = TailCapture()
+        elif value == ChildProcessIO.CAPTURE_SPILL:
+            value = SpillCapture()
+        self._drained[name] = value
+        return subprocess.PIPE
+
+    @staticmethod
+    def _is_drained(value):
+        return value in (ChildProcessIO.CAPTURE_TAIL, ChildProcessIO.CAPTURE_SPILL) \
+            or isinstance(value, (TailCapture, SpillCapture))
 
     def _make_stdout(self, stdout):
-        if stdout == ChildProcessIO.PIPE or stdout == ChildProcessIO.STDOUT:
+        if self._is_drained(stdout):
+            self._stdout_readable = False
+            return self._make_drained("stdout", stdout)
+        elif stdout == ChildProcessIO.PIPE or stdout == ChildProcessIO.STDOUT:
             self._stdout_readable = True
             return subprocess.PIPE
         elif stdout == ChildProcessIO.INHERIT:
@@ -135,7 +1656,10 @@ class ChildProcess():
             return stdout
 
     def _make_stderr(self, stderr):
-        if stderr == ChildProcessIO.PIPE:
+        if self._is_drained(stderr):
+            self._stderr_readable = False
+            return self._make_drained("stderr", stderr)
+        elif stderr == ChildProcessIO.PIPE:
             self._stderr_readable = True
             return subprocess.PIPE
         elif stderr == ChildProcessIO.STDOUT:
@@ -151,24 +1675,357 @@ class ChildProcess():
             self._stderr_readable = False
             return stderr
 
+    def communicate(self, input=None, timeout=None):
+        """Feed input to the process, read all of its output, and wait for it to finish.
+
+        Input is written incrementally while stdout and stderr are drained, all from a single selector loop, so
+        arbitrarily large inputs and outputs cannot deadlock against the pipe buffers. Once the input is exhausted,
+        the process's stdin is closed.
+
+        If the process does not finish after `timeout` seconds, raise a `subprocess.TimeoutExpired` exception.
+        It is safe to catch this exception and call `communicate` again, without `input`, to continue.
+
+        Parameters
+        ----------
+        input: optional
+            Input for the process: a string, a bytes-like object, a file-like object, or an iterable of strings or
+            bytes-like objects. Requires stdin to be writeable, unless no input is given.
+        timeout: int, optional
+            Amount of time in seconds to wait for the process to finish.
+
+        Returns
+        -------
+        tuple
+            The `(stdout, stderr)` bytes of the process. Either is None if that stream was not created by
+            ChildProcessIO.PIPE.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        state = self._communication
+        if state is None:
+            if input is not None and not self._stdin_writeable:
+                raise RuntimeError("The process's stdin pipe is inaccessible")
+            state = self._communication = _Communication(self, input)
+        elif input is not None:
+            raise ValueError("Input can only be provided to the first call to communicate")
+
+        try:
+            state.run(deadline)
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            self.wait_for_finish(remaining)
+        except subprocess.TimeoutExpired:
+            raise subprocess.TimeoutExpired(self._args, timeout, *state.output()) from None
+        return state.output()
+
+    def _output_stream(self, stream):
+        if stream == "stdout":
+            return self.stdout
+        elif stream == "stderr":
+            return self.stderr
+        raise ValueError("The stream must be 'stdout' or 'stderr'")
+
+    def readinto(self, buffer, stream="stdout"):
+        """Read output from the process directly into a writeable bytes-like object, such as a bytearray.
+
+        Performs at most one system call, so returns as soon as any output is available.
+
+        Parameters
+        ----------
+        buffer: bytes-like object
+            The buffer to read into.
+        stream: str, optional
+            Either "stdout" (default) or "stderr".
+
+        Returns
+        -------
+        int
+            The number of bytes read, which is 0 only once the output has been exhausted
+        """
+        return self._output_stream(stream).readinto1(buffer)
+
+    def iter_chunks(self, size=65536, stream="stdout", encoding=None, errors="strict"):
+        """Iterate over the output of the process in chunks of up to `size` bytes, as soon as they are available.
+
+        Every chunk is read into the same reusable buffer, and yielded as a memoryview of it which is only valid
+        until the next iteration - copy it with `bytes()` if it must be kept. If `encoding` is provided, chunks are
+        instead decoded incrementally, and yielded as strings (characters split between chunks are never broken).
+
+        Parameters
+        ----------
+        size: int, optional
+            The maximum size of a chunk. Defaults to 64 KiB.
+        stream: str, optional
+            Either "stdout" (default) or "stderr".
+        encoding: str, optional
+            The encoding with which to decode the output.
+        errors: str, optional
+            The error handling scheme of the decoder (see `codecs`).
+        """
+        source = self._output_stream(stream)
+        view = memoryview(bytearray(size))
+        decoder = codecs.getincrementaldecoder(encoding)(errors) if encoding else None
+        while True:
+            count = source.readinto1(view)
+            if not count:
+                break
+            yield decoder.decode(view[:count]) if decoder else view[:count]
+        if decoder:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+
+    def iter_records(self, delimiter=b"\n", stream="stdout", encoding=None, errors="strict", copy=True,
+                     block_size=65536):
+        """Iterate over the delimited records output by the process, without their delimiter.
+
+        Output is read in large blocks into a reusable buffer, from which records are sliced. By default, each
+        record is yielded as bytes. With `copy=False`, records are yielded as memoryviews of the buffer instead,
+        avoiding any allocation, but are only valid until the next iteration. If `encoding` is provided, records
+        are decoded straight from the buffer and yielded as strings.
+
+        A final record which is not followed by a delimiter is yielded as well.
+
+        Parameters
+        ----------
+        delimiter: bytes, optional
+            The sequence which terminates each record. Defaults to a newline.
+        stream: str, optional
+            Either "stdout" (default) or "stderr".
+        encoding: str, optional
+            The encoding with which to decode each record.
+        errors: str, optional
+            The error handling scheme of the decoder (see `codecs`).
+        copy: bool, optional
+            Whether to copy each record out of the buffer. Ignored if `encoding` is provided.
+        block_size: int, optional
+            The size of the reusable buffer, which grows as needed to hold a single record.
+        """
+        if not delimiter:
+            raise ValueError("The record delimiter must be a non-empty bytes object")
+        source = self._output_stream(stream)
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        start = end = 0
+        if encoding:
+            text_delimiter = delimiter.decode(encoding)
+
+        while True:
+            if end == len(buf):
+                remaining = end - start
+                if start == 0:
+                    # A single record fills the buffer. Yielded views may still refer to the old buffer, so a new
+                    # one is allocated rather than resizing it
+                    buf = bytearray(len(buf) * 2)
+                    buf[:remaining] = view[start:end]
+                    view = memoryview(buf)
+                else:
+                    view[:remaining] = view[start:end]
+                start, end = 0, remaining
+
+            count = source.readinto1(view[end:])
+            if not count:
+                break
+            scan_from = max(start, end - len(delimiter) + 1)
+            end += count
+            last = buf.rfind(delimiter, scan_from, end)
+            if last < 0:
+                continue
+
+            # Split every complete record in the block at once, rather than searching for each one in Python
+            if encoding:
+                yield from str(view[start:last], encoding, errors).split(text_delimiter)
+            elif copy:
+                yield from bytes(view[start:last]).split(delimiter)
+            else:
+                found = buf.find(delimiter, start, last + 1)
+                while found >= 0:
+                    yield view[start:found]
+                    start = found + len(delimiter)
+                    found = buf.find(delimiter, start, last + 1)
+            start = last + len(delimiter)
+            if start == end:
+                start = end = 0
+
+        if start < end:
+            record = view[start:end]
+            yield str(record, encoding, errors) if encoding else bytes(record) if copy else record
+
+    def iter_lines(self, stream="stdout", encoding=None, errors="strict", copy=True):
+        """Iterate over the lines output by the process, without their trailing newline.
+
+        See ChildProcess.iter_records for the meaning of the parameters."""
+        return self.iter_records(b"\n", stream, encoding, errors, copy)
+
+    def iter_tables(self, schema, delimiter=None, widths=None, batch_rows=65536, skip_rows=0, stream="stdout",
+                    encoding="utf-8", block_size=1048576):
+        """Iterate over the tabular output of the process in batches of `batch_rows` rows, each a Table.
+
+        Output is read in large blocks, and all the complete rows of a block are parsed at once - by NumPy if it
+        is installed - so memory use is bounded by the batch and block sizes. Fields are either separated by
+        `delimiter`, or runs of whitespace by default, or of fixed `widths`. Empty rows are skipped, unless the
+        fields are of fixed widths. The final batch may be smaller, and a final row without a trailing newline is
+        parsed as well. A row which does not match the schema raises a ValueError.
+
+        Parameters
+        ----------
+        schema: dict or list of tuple
+            The name and type of each column, in order. Types may be int (64-bit), float, str, or bytes; strings
+            and bytes are stripped of surrounding whitespace.
+        delimiter: bytes, optional
+            The sequence which separates the fields of a row. Defaults to any whitespace.
+        widths: list of int, optional
+            The width in bytes of each column, for fixed-width rows. Not compatible with `delimiter`.
+        batch_rows: int, optional
+            The number of rows per batch.
+        skip_rows: int, optional
+            The number of leading rows to skip, such as headers.
+        stream: str, optional
+            Either "stdout" (default) or "stderr".
+        encoding: str, optional
+            The encoding of string columns.
+        block_size: int, optional
+            The amount of output to read and parse at once.
+        """
+        schema = _table_schema(schema, widths)
+        if delimiter is not None and widths is not None:
+            raise ValueError("Rows may be delimited or fixed-width, not both")
+        if batch_rows <= 0:
+            raise ValueError("The batch size must be positive")
+        source = self._output_stream(stream)
+        pending = bytearray()
+        parsed = []
+        parsed_rows = 0
+        exhausted = False
+        while not exhausted:
+            chunk = source.read1(block_size)
+            if chunk:
+                # Rows longer than a block accumulate in place, rather than being copied again for every block
+                last = chunk.rfind(b"\n")
+                if last < 0:
+                    pending += chunk
+                    continue
+                pending += chunk[:last + 1]
+                data = bytes(pending)
+                pending = bytearray(chunk[last + 1:])
+            else:
+                # The final row is complete even without a trailing newline
+                exhausted = True
+                data = bytes(pending) + b"\n" if pending else b""
+
+            start = 0
+            while skip_rows and start < len(data):
+                start = data.find(b"\n", start) + 1
+                skip_rows -= 1
+            data = data[start:] if start else data
+            if data.strip() if widths is None else data:
+                table = _parse_table(data, schema, delimiter, widths, encoding)
+                parsed.append(table)
+                parsed_rows += len(table)
+
+            while parsed_rows >= batch_rows:
+                table = Table._concatenate(parsed)
+                yield table._slice(0, batch_rows)
+                parsed = [table._slice(batch_rows)]
+                parsed_rows -= batch_rows
+        if parsed_rows:
+            yield Table._concatenate(parsed)
+
+    def read_table(self, schema, delimiter=None, widths=None, skip_rows=0, stream="stdout", encoding="utf-8",
+                   block_size=1048576):
+        """Read the whole tabular output of the process into a single Table.
+
+        See ChildProcess.iter_tables for the meaning of the parameters."""
+        for table in self.iter_tables(schema, delimiter, widths, sys.maxsize, skip_rows, stream, encoding,
+                                      block_size):
+            return table
+        return _parse_table(b"", _table_schema(schema, widths), delimiter, widths, encoding)
+
+    def set_pipe_size(self, size):
+        """Resize the kernel buffers of the pipes to the process's stdin, stdout, and stderr, where they exist.
+
+        Larger pipes mean fewer context switches when moving large volumes of data. Requests beyond the system limit
+        (/proc/sys/fs/pipe-max-size) for unprivileged processes leave the size unchanged.
+
+        Parameters
+        ----------
+        size: int
+            The desired size of each pipe buffer in bytes.
+        """
+        for stream in (self._popen.stdin, self._popen.stdout, self._popen.stderr):
+            if stream is not None and not stream.closed:
+                _set_pipe_size(stream.fileno(), size)
+
+    def transfer(self, source=None, destination=None, timeout=None):
+        """Feed the process's stdin from `source`, and/or copy its stdout to `destination`, without copying the
+        data through user space where the kernel supports it (see `os.splice`, `os.sendfile`, and
+        `os.copy_file_range`).
+
+        Both transfers proceed concurrently. Once `source` is exhausted, the process's stdin is closed; once the
+        process's stdout reaches EOF, it is closed. Should not be combined with reads or writes through the
+        ChildProcess.stdin/stdout streams.
+
+        If the transfer does not finish after `timeout` seconds, raise a `subprocess.TimeoutExpired` exception.
+
+        Parameters
+        ----------
+        source: file-like object or int, optional
+            The file, socket, or pipe (or its file descriptor) from which to read input. Requires a writeable stdin.
+        destination: file-like object or int, optional
+            The file, socket, or pipe (or its file descriptor) to which output is written. Requires a readable stdout.
+        timeout: int, optional
+            Amount of time in seconds to allow for the transfer.
+
+        Returns
+        -------
+        tuple
+            The number of bytes `(written to stdin, read from stdout)`
+        """
+        feeds = [(source, self.stdin)] if source is not None else []
+        drains = [(self.stdout, destination)] if destination is not None else []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            fed, drained = _transfer(feeds, drains, deadline)
+        except subprocess.TimeoutExpired:
+            raise subprocess.TimeoutExpired(self._args, timeout) from None
+        return (fed[0] if fed else 0), (drained[0] if drained else 0)
+
     def start(self):
         """Resume execution of a process which has previously been stopped.
 
         Requires platform support - if unsupported on this platform, raises an OSError."""
         if not hasattr(signal, "SIGCONT"):
             raise OSError("No platform support for stopping/starting processes")
+        if self._stopped_at is not None:
+            self._suspended_time += time.monotonic() - self._stopped_at
+            self._stopped_at = None
         self._is_stopped = False
         self.kill(signal.SIGCONT)
 
-    def stop(self):
+    def stop(self, force=False):
         """Suspend execution of a running process.
 
-        Requires platform support - if unsupported on this platform, raises an OSError."""
+        Requires platform support - if unsupported on this platform, raises an OSError.
+
+        Parameters
+        ----------
+        force: bool, optional
+            Stop the process with SIGSTOP, which cannot be caught or ignored, rather than SIGTSTP.
+        """
         if not hasattr(signal, "SIGTSTP"):
             raise OSError("No platform support for stopping/starting processes")
-        self.kill(signal.SIGTSTP)
+        self.kill(signal.SIGSTOP if force else signal.SIGTSTP)
+        if self._stopped_at is None:
+            self._stopped_at = time.monotonic()
         self._is_stopped = True
 
+    @property
+    def suspended_time(self):
+        """The total number of seconds for which the process has been stopped by stop(), until start() or until now.
+        Read-only."""
+        if self._stopped_at is None:
+            return self._suspended_time
+        end = self._exit_monotonic if self.is_finished() else time.monotonic()
+        return self._suspended_time + max(0.0, end - self._stopped_at)
+
     def terminate(self, force=False):
         """Request that a process terminate execution.
 
@@ -191,9 +2048,19 @@ class ChildProcess():
         """Return true if the process is executing, and false otherwise"""
         return not (self.is_finished() or self.is_stopped())
 
-    def is_stopped(self):
-        """Return true if the process is suspended but not yet finished, and false otherwise"""
-        return not self.is_finished() and self._is_stopped
+    def is_stopped(self, verify=False):
+        """Return true if the process is suspended but not yet finished, and false otherwise
+
+        By default, this reflects the calls to stop() and start(). If `verify` is true, the kernel's view of the
+        process is checked instead, where /proc is available - a process which catches or ignores SIGTSTP, or
+        which has not yet acted on it, is not stopped."""
+        if self.is_finished():
+            return False
+        if verify:
+            state = _read_process_state(self.pid)
+            if state is not None:
+                return state in ("T", "t")
+        return self._is_stopped
 
     def is_finished(self):
         """Return true if the process has exited, and false otherwise"""
@@ -218,7 +2085,12 @@ class ChildProcess():
             The process on which it was called, in order to enable 'fluent programming'
         """
 
-        self._popen.wait(timeout)
+        if self._watched:
+            if not self._exited.wait(timeout):
+                raise subprocess.TimeoutExpired(self._args, timeout)
+        else:
+            self._popen.wait(timeout)
+            self._record_exit()
         return self
 
     def kill(self, signal):
@@ -235,11 +2107,166 @@ class ChildProcess():
             self._popen.kill()
 
 
+class AsyncChildProcess(ChildProcess):
+    """A child process managed by an asyncio event loop.
+
+    Should not be instantiated directly - instead, use ChildProcessBuilder.spawn_async() to get an instance.
+
+    Exit is detected by registering a pidfd for the process with the event loop, so any number of children may be
+    supervised by one loop without dedicating a thread to each. On platforms without pidfd support, a thread from
+    the loop's default executor waits for the process instead.
+
+    stdin is an asyncio.StreamWriter, and stdout and stderr are asyncio.StreamReader instances.
+
+    May be used with Python's `async with` statement - upon the exit of the block, the process will be killed."""
+    def __init__(self, args, env, cwd, stdin, stdout, stderr, engine=SpawnEngine.POPEN, executable=None,
+                 controls=None):
+        self._streams = {}
+        self._exit_future = None
+        super().__init__(args, env, cwd, stdin, stdout, stderr, engine, executable, controls)
+
+    def _write_deferred_input(self, deferred_input):
+        self._deferred_input = deferred_input
+
+    def _watch(self):
+        # Exit is watched by the event loop instead, once attached
+        return False
+
+    async def _attach(self, stdout=True):
+        """Connect the pipes of the process to the running event loop, and start watching for its exit."""
+        loop = asyncio.get_running_loop()
+        self._exit_future = loop.create_future()
+
+        if self._stdin_writeable:
+            transport, protocol = await loop.connect_write_pipe(
+                lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()), self._popen.stdin)
+            self._streams["stdin"] = asyncio.StreamWriter(transport, protocol, None, loop)
+            if self._deferred_input:
+                self._streams["stdin"].write(self._deferred_input)
+        for name, readable in (("stdout", stdout and self._stdout_readable), ("stderr", self._stderr_readable)):
+            if readable:
+                reader = asyncio.StreamReader()
+                await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), getattr(self._popen, name))
+                self._streams[name] = reader
+
+        try:
+            pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            waiter = loop.run_in_executor(None, self._popen.wait)
+            waiter.add_done_callback(lambda _: self._on_exit())
+        else:
+            loop.add_reader(pidfd, self._on_pidfd_ready, loop, pidfd)
+
+    def _on_pidfd_ready(self, loop, pidfd):
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+        self._reap()
+        self._on_exit()
+
+    def _on_exit(self):
+        self._record_exit()
+        if not self._exit_future.done():
+            self._exit_future.set_result(None)
+
+    def _stream(self, name, accessible):
+        if not accessible or name not in self._streams:
+            raise RuntimeError("The process's {} pipe is inaccessible".format(name))
+        return self._streams[name]
+
+    @property
+    def stdin(self):
+        """The asyncio.StreamWriter for the child process's input, if it was created by ChildProcessIO.PIPE.
+
+        Also accessible if input was provided in string format.
+
+        Attempts to access an inaccessible child process file descriptor result in a RuntimeError."""
+        return self._stream("stdin", self._stdin_writeable)
+
+    @property
+    def stdout(self):
+        """The asyncio.StreamReader for the child process's output, if it was created by ChildProcessIO.PIPE.
+
+        Inaccessible for all but the last process of a pipeline.
+
+        Attempts to access an inaccessible child process file descriptor result in a RuntimeError."""
+        return self._stream("stdout", self._stdout_readable)
+
+    @property
+    def stderr(self):
+        """The asyncio.StreamReader for the child process's error output, if it was created by ChildProcessIO.PIPE.
+
+        Attempts to access an inaccessible child process file descriptor result in a RuntimeError."""
+        return self._stream("stderr", self._stderr_readable)
+
+    async def wait_for_finish(self, timeout=None):
+        """Wait until the process finishes, without blocking the event loop. May optionally wait up to a maximum
+        length of time
+
+        If the process does not terminate after `timeout` seconds, raise a
+        `subprocess.TimeoutExpired` exception. It is safe to catch this exception and retry.
+
+        Parameters
+        ----------
+        timeout: int, optional
+            Amount of time in seconds to wait for the process to finish.
+
+        Returns
+        -------
+        AsyncChildProcess
+            The process on which it was awaited, in order to enable 'fluent programming'
+        """
+        try:
+            await asyncio.wait_for(asyncio.shield(self._exit_future), timeout)
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(self._args, timeout) from None
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        if not self.is_finished():
+            self._popen.kill()
+            await self.wait_for_finish()
+
+
+class CompletedChildProcess():
+    """The outcome of a child process which has finished, as returned by ChildProcessBuilder.run()."""
+    def __init__(self, args, exit_code, stdout, stderr):
+        self._args = args
+        self._exit_code = exit_code
+        self._stdout = stdout
+        self._stderr = stderr
+
+    @property
+    def args(self):
+        """The argument array with which the process was created. Read-only."""
+        return self._args
+
+    @property
+    def exit_code(self):
+        """The integer exit code of the process. Read-only."""
+        return self._exit_code
+
+    @property
+    def stdout(self):
+        """The bytes output by the process, or None if its stdout was not created by ChildProcessIO.PIPE. Read-only."""
+        return self._stdout
+
+    @property
+    def stderr(self):
+        """The bytes output by the process to stderr, or None if its stderr was not created by ChildProcessIO.PIPE.
+        Read-only."""
+        return self._stderr
+
+    def __repr__(self):
+        return "CompletedChildProcess(args={!r}, exit_code={!r})".format(self._args, self._exit_code)
+
 class ChildProcessBuilder():
     """Builder to obtain instances of ChildProcess.
 
     One ChildProcessBuilder may be used to obtain any number of ChildProcess instances."""
-    def __init__(self, args, env=None, cwd=None, stdin=None, stdout=None, stderr=None):
+    def __init__(self, args, env=None, cwd=None, stdin=None, stdout=None, stderr=None, engine=None, pipe_size=None):
         """Initialize the attributes of the builder.
 
         Refer to documentation for each attribute for their default behavior and the particulars of their usage.
@@ -257,13 +2284,27 @@ class ChildProcessBuilder():
         stdout
             The desired standard output (see ChildProcessBuilder.stdout). Optional.
         stderr
-            The desired standard error output (see ChildProcessBuilder.stderr). Optional."""
+            The desired standard error output (see ChildProcessBuilder.stderr). Optional.
+        engine
+            The desired process creation mechanism (see ChildProcessBuilder.engine). Optional.
+        pipe_size
+            The desired size of the process's pipe buffers (see ChildProcessBuilder.pipe_size). Optional.
+
+        Resource limits, CPU affinity, niceness, I/O priority, and cgroup placement may be set after construction
+        (see ChildProcessBuilder.rlimits, cpu_affinity, nice, ionice, and cgroup)."""
         self.args = args
         self.env = env
         self.cwd = cwd
         self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
+        self.engine = engine
+        self.pipe_size = pipe_size
+        self.rlimits = None
+        self.cpu_affinity = None
+        self.nice = None
+        self.ionice = None
+        self.cgroup = None
 
     def spawn(self):
         """Create a child process from the current ChildProcessBuilder attributes.
@@ -273,7 +2314,229 @@ class ChildProcessBuilder():
         ChildProcess
             The spawned ChildProcess
         """
-        return ChildProcess(self.args, self.env, self.cwd, self.stdin, self.stdout, self.stderr)
+        return self._spawn(ChildProcess)
+
+    def run(self, input=None, timeout=None):
+        """Create a child process from the current ChildProcessBuilder attributes, feed it input, capture its output,
+        and wait for it to finish.
+
+        See ChildProcess.communicate for details. If the process does not finish after `timeout` seconds, it is
+        killed and `subprocess.TimeoutExpired` is raised.
+
+        Parameters
+        ----------
+        input: optional
+            Input for the process: a string, a bytes-like object, a file-like object, or an iterable of strings or
+            bytes-like objects.
+        timeout: int, optional
+            Amount of time in seconds to wait for the process to finish.
+
+        Returns
+        -------
+        CompletedChildProcess
+            The exit code and captured output of the process
+        """
+        with self.spawn() as process:
+            try:
+                stdout, stderr = process.communicate(input, timeout)
+            except subprocess.TimeoutExpired:
+                process.terminate(force=True)
+                process.wait_for_finish()
+                raise
+        return CompletedChildProcess(process.args, process.exit_code, stdout, stderr)
+
+    def map(self, inputs, concurrency=None, ordered=True, stdin=False, retries=0, timeout=None, reorder_window=None):
+        """Run the command once per input, with at most `concurrency` child processes at a time, like `xargs -P`.
+
+        Each input is substituted for `{input}` placeholders in the arguments, or, if there are none, appended as the
+        last argument - unless `stdin` is true, in which case the input is instead written to the process's stdin.
+        A new process is started whenever one exits, as notified by the reaper, and the output of the processes is
+        collected if stdout and/or stderr are ChildProcessIO.PIPE.
+
+        Parameters
+        ----------
+        inputs: iterable
+            The inputs, consumed lazily. Strings, or any values for substitution into the arguments; strings or
+            bytes-like objects for stdin.
+        concurrency: int, optional
+            The maximum number of processes running at once. Defaults to the number of CPUs.
+        ordered: bool, optional
+            If true, results are yielded in the order of the inputs, otherwise in order of completion.
+        stdin: bool, optional
+            Whether each input is written to the process's stdin, rather than substituted into its arguments.
+            Otherwise, a piped stdin is replaced by ChildProcessIO.NULL.
+        retries: int, optional
+            The number of times the command is run again for an input after it exits with a non-zero code.
+        timeout: float, optional
+            The maximum number of seconds each process may run, after which it is killed. This counts as a failure,
+            which is retried like any other.
+        reorder_window: int, optional
+            When results are ordered, the maximum number of inputs which may be started ahead of the oldest one
+            still running, which bounds the results held back for reordering. Defaults to 4 times `concurrency`.
+
+        Returns
+        -------
+        iterator of tuple
+            (input, CompletedChildProcess) pairs, for the final attempt of each input. If the iterator is closed
+            early, the processes still running are killed.
+        """
+        concurrency = concurrency or os.cpu_count() or 1
+        if concurrency < 1 or retries < 0:
+            raise ValueError("concurrency must be positive and retries must not be negative")
+        window = (reorder_window or 4 * concurrency) if ordered else None
+
+        builder = copy.copy(self)
+        if not stdin:
+            if not any("{input}" in arg for arg in self.args):
+                builder.args = list(self.args) + ["{input}"]
+            if builder.stdin == ChildProcessIO.PIPE:
+                # Nothing would write to or close the pipe, so the processes read /dev/null, as with xargs
+                builder.stdin = ChildProcessIO.NULL
+        template = builder.freeze(*(["input"] if any("{input}" in arg for arg in builder.args) else []))
+        return self._map(template, enumerate(inputs), concurrency, window, stdin, retries, timeout)
+
+    @staticmethod
+    def _map(template, inputs, concurrency, window, stdin, retries, timeout):
+        running = {}
+        finished = {}
+        next_index = 0
+        inputs_started = 0
+        exhausted = False
+
+        def start(index, item, attempt):
+            if stdin:
+                process = template.spawn(stdin=item)
+                process._feed_input_in_background()
+            else:
+                process = template.spawn(input=item)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            running[process] = [index, item, attempt, deadline, {"stdout": [], "stderr": []}]
+            group.add(process)
+
+        with ProcessGroup() as group:
+            try:
+                while True:
+                    while not exhausted and len(running) < concurrency:
+                        if window is not None and inputs_started - next_index >= window:
+                            break
+                        try:
+                            index, item = next(inputs)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        inputs_started = index + 1
+                        start(index, item, 0)
+                    if not running:
+                        break
+
+                    deadlines = [entry[3] for entry in running.values() if entry[3] is not None]
+                    wait = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+                    for event in group.poll(wait):
+                        entry = running[event.process]
+                        if event.type == ProcessEventType.CHUNK:
+                            entry[4][event.stream].append(event.data)
+                        elif event.type == ProcessEventType.EXITED:
+                            del running[event.process]
+                            index, item, attempt, _, chunks = entry
+                            if event.data != 0 and attempt < retries:
+                                start(index, item, attempt + 1)
+                                continue
+                            result = CompletedChildProcess(
+                                event.process.args, event.data,
+                                b"".join(chunks["stdout"]) if event.process._stdout_readable else None,
+                                b"".join(chunks["stderr"]) if event.process._stderr_readable else None)
+                            if window is None:
+                                yield item, result
+                            else:
+                                finished[index] = (item, result)
+                    while next_index in finished:
+                        yield finished.pop(next_index)
+                        next_index += 1
+
+                    now = time.monotonic()
+                    for process, entry in running.items():
+                        if entry[3] is not None and entry[3] <= now:
+                            process.terminate(force=True)
+                            entry[3] = None
+            finally:
+                for process in running:
+                    process.terminate(force=True)
+
+    def spawn_remote(self, scheduler):
+        """Create a child process from the current ChildProcessBuilder attributes through whichever Agent of an
+        AgentScheduler has the most free capacity.
+
+        The arguments, stdin, stdout, and stderr are used as for a local process, except that output cannot be
+        captured by TailCapture or SpillCapture, and stdin cannot be inherited. Only the environment variables and
+        working directory which differ from this process's are forwarded - the agent's own apply otherwise. The
+        engine, pipe size, and resource controls are not applied remotely.
+
+        Returns
+        -------
+        RemoteChildProcess
+            The spawned RemoteChildProcess
+        """
+        return scheduler.spawn(self)
+
+    async def spawn_async(self):
+        """Create a child process from the current ChildProcessBuilder attributes, managed by the running event loop.
+
+        Returns
+        -------
+        AsyncChildProcess
+            The spawned AsyncChildProcess
+        """
+        process = self._spawn(AsyncChildProcess)
+        await process._attach()
+        return process
+
+    def freeze(self, *slots):
+        """Compile the current ChildProcessBuilder attributes into an immutable ChildProcessTemplate, which can spawn
+        the same command many times over with minimal work per spawn.
+
+        Parameters
+        ----------
+        slots: str
+            Names of parameters which may be substituted into the arguments when spawning. Each `{name}`
+            placeholder for one of these names in an argument is replaced by the corresponding keyword argument of
+            ChildProcessTemplate.spawn. Braces which do not enclose a slot name are left alone.
+
+        Returns
+        -------
+        ChildProcessTemplate
+            The compiled template
+        """
+        return ChildProcessTemplate(self, slots)
+
+    def _configuration_key(self):
+        """Return a hashable summary of the attributes of the builder, identifying file-like values by identity."""
+        def identify(value):
+            return value if isinstance(value, (str, bytes, Enum)) else id(value)
+
+        return (tuple(self.args), tuple(sorted(self.env.items())), self.cwd, identify(self.stdin),
+                identify(self.stdout), identify(self.stderr), self.engine, self.pipe_size,
+                tuple(sorted(self.rlimits.items())), self.cpu_affinity, self.nice, self.ionice, id(self.cgroup))
+
+    def _controls(self):
+        if not self.rlimits and self.cpu_affinity is None and self.nice is None and self.ionice is None \
+                and self.cgroup is None:
+            return None
+        return _ProcessControls(dict(self.rlimits), self.cpu_affinity, self.nice, self.ionice, self.cgroup)
+
+    def _copy_controls(self, other):
+        """Adopt the resource controls of another ChildProcessBuilder, or reset them if `other` is None."""
+        self.rlimits = dict(other.rlimits) if other else None
+        self.cpu_affinity = other.cpu_affinity if other else None
+        self.nice = other.nice if other else None
+        self.ionice = other.ionice if other else None
+        self.cgroup = other.cgroup if other else None
+
+    def _spawn(self, process_class):
+        process = process_class(self.args, self.env, self.cwd, self.stdin, self.stdout, self.stderr, self.engine,
+                                controls=self._controls())
+        if self.pipe_size is not None:
+            process.set_pipe_size(self.pipe_size)
+        return process
 
     @property
     def args(self) -> List[str]:
@@ -346,7 +2609,9 @@ class ChildProcessBuilder():
         ChildProcessIO.PIPE (default) - open a parent-accessible writeable pipe to the stdin fd
         ChildProcessIO.INHERIT - use the parent process's standard input fd
         ChildProcessIO.NULL - provide null input (EOF)
-        A Python string - Open a PIPE to the stdin fd, and write the contents of the string upon creation
+        A Python string or bytes - Open a PIPE to the stdin fd, and write the contents upon creation. Whatever does
+            not fit in the pipe is written by ChildProcess.communicate, or before anything else is written to stdin
+        A SharedInput - read the payload from its start, from memory shared with every other process using it
         A file-like object - the contents read from the object will be provided to the process as input
 
         It is the client's responsibility to make sure that standard input is used in a safe manner.
@@ -359,15 +2624,17 @@ class ChildProcessBuilder():
             value = ChildProcessIO.PIPE
         if isinstance(value, io.BufferedReader):
             self._stdin = value.raw
-        elif isinstance(value, str) or isinstance(value, io.IOBase):
+        elif isinstance(value, (str, bytes, SharedInput)) or isinstance(value, io.IOBase):
             self._stdin = value
         elif value in ChildProcessIO:
             if value == ChildProcessIO.STDOUT:
                 raise ValueError("Cannot pipe a process's output to its own input")
+            elif value in (ChildProcessIO.CAPTURE_TAIL, ChildProcessIO.CAPTURE_SPILL):
+                raise ValueError("Only output can be captured")
             else:
                 self._stdin = value
         else:
-            raise TypeError("Input can be redirected from a string, a file-like object, or a ChildProcessIO special value")
+            raise TypeError("Input can be redirected from a string, bytes, a SharedInput, a file-like object, or a ChildProcessIO special value")
 
     @property
     def stdout(self):
@@ -377,6 +2644,10 @@ class ChildProcessBuilder():
         ChildProcessIO.PIPE (default) - open a parent-accessible readable pipe to the stdout fd
         ChildProcessIO.INHERIT - use the parent process's standard output fd
         ChildProcessIO.NULL - ignore output
+        ChildProcessIO.CAPTURE_TAIL - drain the output in the background, retaining only its last 64 KiB
+        A TailCapture - drain the output in the background, retaining only its tail, up to the given limits
+        ChildProcessIO.CAPTURE_SPILL - drain the output in the background, spilling it to a file beyond 1 MiB
+        A SpillCapture - drain the output in the background, spilling it to a file beyond the given limit
         A file-like object - the contents output by the process will be written to the object
 
         It is the client's responsibility to make sure that standard output is used in a safe manner.
@@ -387,10 +2658,10 @@ class ChildProcessBuilder():
     def stdout(self, value):
         if value is None:
             value = ChildProcessIO.PIPE
-        if isinstance(value, io.IOBase) or value in ChildProcessIO:
+        if isinstance(value, (io.IOBase, TailCapture, SpillCapture)) or value in ChildProcessIO:
             self._stdout = value
         else:
-            raise TypeError("Output can be redirected to a file-like object, or a ChildProcessIO special value")
+            raise TypeError("Output can be redirected to a file-like object, a TailCapture, a SpillCapture, or a ChildProcessIO special value")
 
     @property
     def stderr(self):
@@ -400,6 +2671,10 @@ class ChildProcessBuilder():
         ChildProcessIO.PIPE (default) - open a parent-accessible readable pipe to the stderr fd
         ChildProcessIO.INHERIT - use the parent process's standard error output fd
         ChildProcessIO.NULL - ignore error output
+        ChildProcessIO.CAPTURE_TAIL - drain the error output in the background, retaining only its last 64 KiB
+        A TailCapture - drain the error output in the background, retaining only its tail, up to the given limits
+        ChildProcessIO.CAPTURE_SPILL - drain the error output in the background, spilling it to a file beyond 1 MiB
+        A SpillCapture - drain the error output in the background, spilling it to a file beyond the given limit
         A file-like object - the contents output by the process to stderr will be written to the object
 
         It is the client's responsibility to make sure that standard error output is used in a safe manner.
@@ -410,70 +2685,697 @@ class ChildProcessBuilder():
     def stderr(self, value):
         if value is None:
             value = ChildProcessIO.PIPE
-        if isinstance(value, io.IOBase) or value in ChildProcessIO:
+        if isinstance(value, (io.IOBase, TailCapture, SpillCapture)) or value in ChildProcessIO:
             self._stderr = value
         else:
-            raise TypeError("Error output can be redirected to a file-like object, or a ChildProcessIO special value")
+            raise TypeError("Error output can be redirected to a file-like object, a TailCapture, a SpillCapture, or a ChildProcessIO special value")
 
-class PipelineBuilder():
-    """A convenience wrapper for ChildProcessBuilder to construct a pipeline of processes with each's output piped to the next's input.
+    @property
+    def pipe_size(self):
+        """The size in bytes of the kernel buffers of the pipes opened to the child process, or None for the system
+        default. See ChildProcess.set_pipe_size."""
+        return self._pipe_size
 
-    The parameters env, cwd, and stderr are shared by all processes in the pipeline.
+    @pipe_size.setter
+    def pipe_size(self, value):
+        if value is not None and (not isinstance(value, int) or value < 1):
+            raise ValueError("The pipe size must be a positive integer")
+        self._pipe_size = value
 
-    stdin describes the input proved to the first process, and stdout describes the output behavior of the last process."""
-    def __init__(self, commands, env=None, cwd=None, stdin=None, stdout=None, stderr=None):
-        if env is None:
-            env = dict(os.environ)
-        if cwd is None:
-            cwd = os.getcwd()
-        if stdin is None:
-            stdin = ChildProcessIO.PIPE
-        if stdout is None:
-            stdout = ChildProcessIO.PIPE
-        if stderr is None:
-            stderr = ChildProcessIO.PIPE
+    @property
+    def engine(self):
+        """The mechanism with which the child process will be created, as a SpawnEngine value.
+
+        The default, SpawnEngine.AUTO, uses `os.posix_spawn` whenever the requested working directory and standard
+        streams can be expressed with it, which makes spawning from a parent with a large memory footprint much
+        cheaper, and falls back to `subprocess.Popen` otherwise. The engine which was actually used is recorded in
+        ChildProcess.spawn_engine.
+
+        Unlike Popen, posix_spawn does not close inheritable file descriptors other than the standard streams."""
+        return self._engine
+
+    @engine.setter
+    def engine(self, value):
+        if value is None:
+            value = SpawnEngine.AUTO
+        if value in SpawnEngine:
+            self._engine = value
+        else:
+            raise TypeError("The spawn engine must be a SpawnEngine value")
+
+    @property
+    def rlimits(self) -> Dict[int, Tuple[int, int]]:
+        """Resource limits applied to the child process before it executes, as a mapping from a `resource.RLIMIT_*`
+        constant to a `(soft, hard)` pair of limits.
+
+        A single limit may be provided in place of a pair, in which case it is used as both the soft and the hard
+        limit. For example, `{resource.RLIMIT_AS: 2 ** 30, resource.RLIMIT_NOFILE: 256, resource.RLIMIT_CPU: 60}`.
+        The default is to inherit the limits of the parent process.
+
+        Any resource control prevents the use of SpawnEngine.POSIX_SPAWN."""
+        return self._rlimits
+
+    @rlimits.setter
+    def rlimits(self, value):
+        if value is None:
+            value = {}
+        if not isinstance(value, dict):
+            raise TypeError("Resource limits must be a dictionary")
+        limits = {}
+        for limit, pair in value.items():
+            if isinstance(pair, int):
+                pair = (pair, pair)
+            if not isinstance(limit, int) or len(pair) != 2:
+                raise TypeError("Resource limits must map resource.RLIMIT_* constants to (soft, hard) pairs")
+            limits[limit] = tuple(pair)
+        self._rlimits = limits
+
+    @property
+    def cpu_affinity(self):
+        """The set of CPUs on which the child process may run, or None (the default) to inherit the parent's."""
+        return self._cpu_affinity
+
+    @cpu_affinity.setter
+    def cpu_affinity(self, value):
+        if value is not None:
+            if not hasattr(os, "sched_setaffinity"):
+                raise OSError("No platform support for setting CPU affinity")
+            value = frozenset(int(cpu) for cpu in value)
+            if not value:
+                raise ValueError("At least one CPU must be allowed")
+        self._cpu_affinity = value
+
+    @property
+    def nice(self):
+        """The increment to the niceness of the child process, or None (the default) to inherit the parent's.
+
+        Positive values lower the child's CPU scheduling priority."""
+        return self._nice
+
+    @nice.setter
+    def nice(self, value):
+        if value is not None and not isinstance(value, int):
+            raise TypeError("The niceness increment must be an integer")
+        self._nice = value
+
+    @property
+    def ionice(self):
+        """The I/O scheduling priority of the child process, as a `(IOPriorityClass, level)` pair, or None (the
+        default) to inherit the parent's.
+
+        The level ranges from 0 (highest) to 7 (lowest), and is ignored for IOPriorityClass.IDLE. A class alone may
+        be provided, in which case the level is 4."""
+        return self._ionice
+
+    @ionice.setter
+    def ionice(self, value):
+        if isinstance(value, IOPriorityClass):
+            value = (value, 4)
+        if value is not None:
+            if len(value) != 2 or value[0] not in IOPriorityClass or not 0 <= value[1] <= 7:
+                raise ValueError("The I/O priority must be an IOPriorityClass and a level from 0 to 7")
+            value = tuple(value)
+        self._ionice = value
+
+    @property
+    def cgroup(self):
+        """The cgroup v2 in which the child process is placed, as a ControlGroup, or None (the default) to remain in
+        the parent's cgroup.
+
+        May be provided as a path, which is equivalent to a ControlGroup without limits."""
+        return self._cgroup
+
+    @cgroup.setter
+    def cgroup(self, value):
+        if isinstance(value, str):
+            value = ControlGroup(value)
+        if value is not None and not isinstance(value, ControlGroup):
+            raise TypeError("The cgroup must be a ControlGroup or a path")
+        self._cgroup = value
+
+class ChildProcessTemplate():
+    """An immutable, precompiled form of a ChildProcessBuilder, for spawning the same command shape at a high rate.
+
+    Should not be instantiated directly - instead, use ChildProcessBuilder.freeze() to get an instance.
+
+    The arguments are tokenized once with their parameter slots located, the environment is captured once in an
+    immutable mapping shared by every spawn, and the executable is resolved through PATH once. The resolved
+    executable is revalidated at most every `revalidate_interval` seconds, and resolved again if it has been
+    replaced or removed. The environment, including PATH, is fixed when the template is frozen."""
+    revalidate_interval = 1.0
+
+    def __init__(self, builder, slots):
+        self._args = tuple(builder.args)
+        self._env = MappingProxyType(dict(builder.env))
+        self._cwd = builder.cwd
+        self._stdin = builder.stdin
+        self._stdout = builder.stdout
+        self._stderr = builder.stderr
+        self._engine = builder.engine
+        self._pipe_size = builder.pipe_size
+        self._controls = builder._controls()
+
+        slots = set(slots)
+        self._slots = []
+        if slots:
+            # Each token is split once into its literal text and slot names, alternately, so that substituted values
+            # are never scanned for slots themselves
+            pattern = re.compile(r"\{(" + "|".join(re.escape(name) for name in slots) + r")\}")
+            for index, token in enumerate(self._args):
+                parts = pattern.split(token)
+                if len(parts) > 1:
+                    self._slots.append((index, parts, parts[1::2]))
+        self._slot_names = frozenset(slots)
+        unused = slots.difference(name for _, _, names in self._slots for name in names)
+        if unused:
+            raise ValueError("Slots do not appear in the arguments: {}".format(", ".join(sorted(unused))))
+
+        self._executable = None
+        self._resolve_executable()
+
+    def _resolve_executable(self):
+        if not self._args or (self._slots and self._slots[0][0] == 0):
+            # The executable depends on the parameters
+            self._executable = None
+            return
+        path = self._args[0]
+        if os.sep not in path:
+            path = shutil.which(path, path=self._env.get("PATH", os.defpath))
+        try:
+            status = os.stat(path) if path else None
+        except OSError:
+            status = None
+        self._executable = path if status else None
+        self._identity = (status.st_ino, status.st_dev, status.st_mtime_ns) if status else None
+        self._validated_at = time.monotonic()
+
+    def _current_executable(self):
+        if self._executable is not None and time.monotonic() - self._validated_at > self.revalidate_interval:
+            try:
+                status = os.stat(self._executable)
+                unchanged = (status.st_ino, status.st_dev, status.st_mtime_ns) == self._identity
+            except OSError:
+                unchanged = False
+            if unchanged:
+                self._validated_at = time.monotonic()
+            else:
+                self._resolve_executable()
+        return self._executable
+
+    @property
+    def args(self):
+        """The arguments of the template, with slot placeholders unsubstituted. Read-only."""
+        return self._args
+
+    @property
+    def env(self):
+        """The immutable environment variable definitions shared by every spawned process. Read-only."""
+        return self._env
+
+    @property
+    def cwd(self):
+        """The working directory of every spawned process. Read-only."""
+        return self._cwd
+
+    @property
+    def executable(self):
+        """The resolved path of the executable, or None if it could not be resolved ahead of time. Read-only."""
+        return self._executable
+
+    def spawn(self, stdin=None, **params):
+        """Create a child process from the template, substituting `params` into its slots.
+
+        Parameters
+        ----------
+        stdin: optional
+            Overrides the template's standard input (see ChildProcessBuilder.stdin) for this process only.
+        params: str
+            A value for every slot of the template. Values are converted to strings.
+
+        Returns
+        -------
+        ChildProcess
+            The spawned ChildProcess
+        """
+        if params.keys() - self._slot_names:
+            raise TypeError("Unknown slots: {}".format(", ".join(sorted(params.keys() - self._slot_names))))
+        args = list(self._args)
+        for index, parts, names in self._slots:
+            try:
+                values = [str(params[name]) for name in names]
+            except KeyError as error:
+                raise TypeError("Missing value for slot '{}'".format(error.args[0])) from None
+            token = parts[:]
+            token[1::2] = values
+            args[index] = "".join(token)
+        if stdin is None:
+            stdin = self._stdin
+        elif isinstance(stdin, io.BufferedReader):
+            stdin = stdin.raw
+
+        process = ChildProcess(args, self._env, self._cwd, stdin, self._stdout, self._stderr, self._engine,
+                               self._current_executable(), self._controls)
+        if self._pipe_size is not None:
+            process.set_pipe_size(self._pipe_size)
+        return process
+
+class PipelineStageStats():
+    """Resource usage of one process of a finished Pipeline.
+
+    Attributes:
+    index - The position of the process in the pipeline
+    args - The arguments of the process
+    exit_code - The exit code of the process
+    wall_time - Seconds from the creation of the process until its exit was recorded
+    cpu_time - Seconds of user and system CPU time consumed by the process, or None if unavailable
+    bytes_read - Bytes read by the process through read system calls (mostly its input from the previous stage),
+        or None if unavailable
+    bytes_written - Bytes written by the process through write system calls (mostly its output to the next
+        stage), or None if unavailable
+    max_rss - Peak resident set size of the process in bytes, or None if unavailable
+    context_switches - Voluntary and involuntary context switches of the process, or None if unavailable"""
+    def __init__(self, index, process):
+        self.index = index
+        self.args = process.args
+        self.exit_code = process.exit_code
+        self.wall_time = process._exit_monotonic - process._spawn_monotonic
+        rusage = process._rusage
+        self.cpu_time = rusage.ru_utime + rusage.ru_stime if rusage else None
+        self.max_rss = rusage.ru_maxrss * 1024 if rusage else None
+        self.context_switches = rusage.ru_nvcsw + rusage.ru_nivcsw if rusage else None
+        counters = process._io_counters or {}
+        self.bytes_read = counters.get("rchar")
+        self.bytes_written = counters.get("wchar")
+
+    def __repr__(self):
+        return "PipelineStageStats(index={}, exit_code={}, wall_time={:.3f}, cpu_time={}, bytes_read={}, " \
+            "bytes_written={})".format(self.index, self.exit_code, self.wall_time, self.cpu_time, self.bytes_read,
+                                       self.bytes_written)
+
+class Pipeline(Sequence):
+    """The processes of a pipeline, in order, as created by PipelineBuilder.spawn_all().
+
+    Behaves as a list of ChildProcess instances, and additionally allows the pipeline to be waited on and
+    inspected as a whole. The pipeline's TransformStages are not among its items, but are part of its status: it
+    is only finished once they have finished too, and a stage whose callable raised counts as a failure."""
+    def __init__(self, processes, transforms=()):
+        self._processes = list(processes)
+        # (index of the process fed by the stage, stage) pairs
+        self._transforms = list(transforms)
+
+    def __getitem__(self, index):
+        return self._processes[index]
+
+    def __len__(self):
+        return len(self._processes)
+
+    def __repr__(self):
+        return "Pipeline({!r})".format([process.args for process in self._processes])
+
+    def wait_for_finish(self, timeout=None):
+        """Block until every process of the pipeline finishes. May optionally wait up to a maximum length of time
+
+        All processes are waited on together, so `timeout` applies to the pipeline as a whole. If it expires,
+        raise a `subprocess.TimeoutExpired` exception. It is safe to catch this exception and retry.
+
+        Parameters
+        ----------
+        timeout: int, optional
+            Amount of time in seconds to wait for the pipeline to finish.
+
+        Returns
+        -------
+        Pipeline
+            The pipeline on which it was called, in order to enable 'fluent programming'
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        finished = _wait_until(lambda: all(process.is_finished() for process in self._processes), self._processes,
+                               deadline)
+        for _, stage in self._transforms:
+            if finished:
+                finished = stage.wait_for_finish(None if deadline is None else max(0, deadline - time.monotonic()))
+        if not finished:
+            raise subprocess.TimeoutExpired([process.args for process in self._processes], timeout)
+        for process in self._processes:
+            # Make sure that every exit has been fully recorded
+            process.wait_for_finish()
+        return self
+
+    def is_finished(self):
+        """Return true if every process and TransformStage of the pipeline has finished, and false otherwise"""
+        return all(process.is_finished() for process in self._processes) and \
+            all(stage.is_finished() for _, stage in self._transforms)
+
+    @property
+    def transforms(self):
+        """The TransformStages of the pipeline, in order. Read-only."""
+        return [stage for _, stage in self._transforms]
+
+    @property
+    def exit_codes(self):
+        """The exit code of every process of the pipeline in order, like bash's PIPESTATUS, with None for
+        processes which are still running. Read-only."""
+        return [process.exit_code for process in self._processes]
+
+    @property
+    def exit_code(self):
+        """The exit code of the pipeline with bash's `pipefail` semantics: the exit code of the last process to
+        fail, or 0 if every process succeeded. A TransformStage whose callable raised counts as failing with 1, in
+        its position in the pipeline. None if any process or stage is still running. Read-only."""
+        codes = self.exit_codes
+        if None in codes or not all(stage.is_finished() for _, stage in self._transforms):
+            return None
+        for index, stage in reversed(self._transforms):
+            codes.insert(index, 0 if stage.exception is None else 1)
+        return next((code for code in reversed(codes) if code != 0), 0)
+
+    @property
+    def failed_stages(self):
+        """The indices of the processes which exited with a nonzero exit code. Read-only."""
+        return [index for index, code in enumerate(self.exit_codes) if code]
+
+    def stage_stats(self):
+        """Return the resource usage of each process of the pipeline, which must have finished.
+
+        Returns
+        -------
+        list
+            A PipelineStageStats for each process, in order
+        """
+        if not self.is_finished():
+            raise RuntimeError("The pipeline has not finished")
+        self.wait_for_finish()
+        return [PipelineStageStats(index, process) for index, process in enumerate(self._processes)]
+
+    def total_stats(self):
+        """Return the resource usage of the whole pipeline, which must have finished, as a dictionary.
+
+        Contains the `wall_time` of the pipeline (from the first creation to the last exit), the summed `cpu_time`,
+        `bytes_read`, `bytes_written`, and `context_switches` of its processes, and the largest `max_rss` among
+        them. Values which are unavailable for any process are None."""
+        stats = self.stage_stats()
+
+        def total(values, combine=sum):
+            values = list(values)
+            return None if None in values else combine(values)
+
+        first_spawn = min(process._spawn_monotonic for process in self._processes)
+        last_exit = max(process._exit_monotonic for process in self._processes)
+        return {
+            "wall_time": last_exit - first_spawn,
+            "cpu_time": total(stage.cpu_time for stage in stats),
+            "bytes_read": total(stage.bytes_read for stage in stats),
+            "bytes_written": total(stage.bytes_written for stage in stats),
+            "context_switches": total(stage.context_switches for stage in stats),
+            "max_rss": total((stage.max_rss for stage in stats), max),
+        }
+
+    def bottleneck(self):
+        """Return the index of the process which consumed the most CPU time, which must have finished.
+
+        In a pipeline which is not limited by its input or output, this is the stage which limits its throughput."""
+        stats = self.stage_stats()
+        return max(stats, key=lambda stage: stage.cpu_time or 0).index
+
+class TransformStage():
+    """A pipeline stage which runs a Python callable in the parent process on the output of the previous stage, and
+    feeds what it returns to the next stage.
+
+    Can be supplied among PipelineBuilder.commands, between two commands. The stage is pumped by the reactor thread
+    with large reads and batched writes, so it costs no process, interpreter startup, or thread of its own. As the
+    callable runs on the reactor thread, it should be quick and must not block.
+
+    In line mode, the callable is given each record without its delimiter, and returns a record, None to drop the
+    record, or an iterable (such as a generator) of records, each of which is delimited again. In chunk mode, it is
+    given the output in chunks of whatever size is read, and returns bytes, None, or an iterable of bytes.
+
+    If the callable raises an exception, or returns anything other than bytes-like objects, the stage stops and
+    closes its input and output, the exception is available as `exception`, and the Pipeline counts the stage as
+    failed. The other statistics describe the most recent pipeline the stage was spawned in."""
+    def __init__(self, function, lines=True, delimiter=b"\n", read_size=262144, max_buffered=1024 * 1024):
+        """
+        Parameters
+        ----------
+        function: callable
+            The transformation, called with a bytes object for each record or chunk.
+        lines: bool, optional
+            Whether the callable is given delimited records, rather than chunks.
+        delimiter: bytes, optional
+            The record delimiter in line mode.
+        read_size: int, optional
+            The maximum number of bytes read from the previous stage at once.
+        max_buffered: int, optional
+            The maximum number of bytes of output held before the stage stops reading its input."""
+        if not callable(function):
+            raise TypeError("The transformation must be callable")
+        self._function = function
+        self._delimiter = delimiter if lines else None
+        self._read_size = read_size
+        self._max_buffered = max_buffered
+        self._reset()
+
+    def _reset(self):
+        self._bytes_read = 0
+        self._bytes_written = 0
+        self._records = 0
+        self._busy_time = 0.0
+        self._exception = None
+        self._started = time.monotonic()
+        self._finished_at = None
+        self._finished = threading.Event()
+
+    def _apply(self, records, size):
+        """Transform records read from the previous stage, returning the output, or None if the callable failed."""
+        self._bytes_read += size
+        output = []
+        started = time.perf_counter()
+        try:
+            for record in records:
+                result = self._function(record)
+                if result is None:
+                    continue
+                if isinstance(result, (bytes, bytearray, memoryview)):
+                    output.append(result)
+                elif isinstance(result, str):
+                    raise TypeError("Transformations must return bytes, not str")
+                else:
+                    for item in result:
+                        if not isinstance(item, (bytes, bytearray, memoryview)):
+                            raise TypeError("Transformations must return bytes or an iterable of bytes")
+                        output.append(item)
+        except Exception as error:
+            self._exception = error
+            return None
+        finally:
+            self._busy_time += time.perf_counter() - started
+        self._records += len(records)
+        return output
+
+    def _written(self, count):
+        self._bytes_written += count
+
+    def _spawn(self, source_fd, pipe_size):
+        """Start transforming the output readable from `source_fd`, returning the file to feed the next stage from."""
+        self._reset()
+        read_fd, write_fd = os.pipe()
+        if pipe_size is not None:
+            _set_pipe_size(write_fd, pipe_size)
+        pump = _RecordPump([source_fd], write_fd, self._delimiter, self._max_buffered, self, self._read_size)
+        pump.start()
+        return open(read_fd, "rb", buffering=0)
+
+    @property
+    def bytes_read(self):
+        """The number of bytes read from the previous stage. Read-only."""
+        return self._bytes_read
+
+    @property
+    def bytes_written(self):
+        """The number of bytes written to the next stage. Read-only."""
+        return self._bytes_written
+
+    @property
+    def records(self):
+        """The number of records (or chunks) given to the callable. Read-only."""
+        return self._records
+
+    @property
+    def busy_time(self):
+        """The number of seconds spent in the callable. Read-only."""
+        return self._busy_time
+
+    @property
+    def throughput(self):
+        """The number of bytes read per second, from when the stage was spawned until it finished (or until now).
+        Read-only."""
+        end = time.monotonic() if self._finished_at is None else self._finished_at
+        return self._bytes_read / max(end - self._started, 1e-9)
+
+    @property
+    def exception(self):
+        """The exception raised by the callable, if any. Read-only."""
+        return self._exception
+
+    def is_finished(self):
+        """Return whether the stage has forwarded all of its input, or stopped."""
+        return self._finished.is_set()
+
+    def wait_for_finish(self, timeout=None):
+        """Wait until the stage has finished, returning whether it has."""
+        return self._finished.wait(timeout)
+
+class PipelineBuilder():
+    """A convenience wrapper for ChildProcessBuilder to construct a pipeline of processes with each's output piped to the next's input.
+
+    The parameters env, cwd, and stderr are shared by all processes in the pipeline.
+
+    stdin describes the input proved to the first process, and stdout describes the output behavior of the last process.
+
+    pipe_size, if provided, is the size in bytes of the kernel buffers of every pipe in the pipeline."""
+    def __init__(self, commands, env=None, cwd=None, stdin=None, stdout=None, stderr=None, pipe_size=None):
+        if env is None:
+            env = dict(os.environ)
+        if cwd is None:
+            cwd = os.getcwd()
+        if stdin is None:
+            stdin = ChildProcessIO.PIPE
+        if stdout is None:
+            stdout = ChildProcessIO.PIPE
+        if stderr is None:
+            stderr = ChildProcessIO.PIPE
         self.commands = commands
         self.env = env
         self.cwd = cwd
         self.stdin = stdin
         self.stdout = stdout
         self.stderr = stderr
+        self.pipe_size = pipe_size
 
     def spawn_all(self):
         """Create the processes for the pipeline.
 
+        Returns
+        -------
+        Pipeline
+            The created processes in order
+        """
+        transforms = []
+        return Pipeline(self._spawn_stages(ChildProcess, transforms), transforms)
+
+    async def spawn_all_async(self):
+        """Create the processes for the pipeline, managed by the running event loop.
+
+        Only the stdout of the last process is accessible, as the output of each other process is consumed by the
+        next process in the pipeline.
+
         Returns
         -------
         list
-            A list of the created processes in order
+            A list of the created AsyncChildProcess instances in order
+        """
+        res = self._spawn_stages(AsyncChildProcess)
+        for proc in res:
+            await proc._attach(stdout=proc is res[-1])
+        return res
+
+    def transfer(self, source=None, destination=None, timeout=None):
+        """Create the processes for the pipeline, feed the first from `source`, and copy the output of the last to
+        `destination`, without copying the data through user space where the kernel supports it.
+
+        See ChildProcess.transfer. Requires stdin (if `source` is provided) and stdout (if `destination` is
+        provided) to be ChildProcessIO.PIPE. Blocks until all of the processes have finished.
+
+        Parameters
+        ----------
+        source: file-like object or int, optional
+            The file, socket, or pipe (or its file descriptor) from which to read input.
+        destination: file-like object or int, optional
+            The file, socket, or pipe (or its file descriptor) to which output is written.
+        timeout: int, optional
+            Amount of time in seconds to allow for the transfer.
+
+        Returns
+        -------
+        tuple
+            The finished Pipeline, the number of bytes written to the first process, and the number of bytes read
+            from the last
         """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        procs = self.spawn_all()
+        feeds = [(source, procs[0].stdin)] if source is not None else []
+        drains = [(procs[-1].stdout, destination)] if destination is not None else []
+        try:
+            fed, drained = _transfer(feeds, drains, deadline)
+            procs.wait_for_finish(None if deadline is None else max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            for proc in procs:
+                proc.terminate(force=True)
+            raise subprocess.TimeoutExpired(self.commands, timeout) from None
+        return procs, (fed[0] if fed else 0), (drained[0] if drained else 0)
+
+    def _spawn_stages(self, process_class, transforms=None):
+        """Create the processes of the pipeline, returning them in a list. Each TransformStage is appended to
+        `transforms`, if given, along with the index of the process it feeds."""
+        if isinstance(self.commands[0], TransformStage) or isinstance(self.commands[-1], TransformStage):
+            raise ValueError("Python stages must be between two commands")
         res = []
         next_input = self.stdin
-        builder = ChildProcessBuilder([], env=self.env, cwd=self.cwd, stderr=self.stderr)
+        transformed = None
+        builder = ChildProcessBuilder([], env=self.env, cwd=self.cwd, stderr=self.stderr, pipe_size=self.pipe_size)
 
         for command in self.commands[:-1]:
-            builder.args = command
+            if isinstance(command, TransformStage):
+                # The stage takes over the output of the previous one, and feeds the next through a new pipe
+                source_fd = os.dup(next_input.fileno())
+                next_input.close()
+                next_input = transformed = command._spawn(source_fd, self.pipe_size)
+                if transforms is not None:
+                    transforms.append((len(res), command))
+                continue
+            self._configure_stage(builder, command)
             builder.stdin = next_input
 
-            proc = builder.spawn()
+            proc = builder._spawn(process_class)
             res.append(proc)
-            next_input = proc.stdout
+            if transformed is not None:
+                # The process holds its own copy of the pipe
+                transformed.close()
+                transformed = None
+            next_input = proc._popen.stdout
 
-        builder.args = self.commands[-1]
+        self._configure_stage(builder, self.commands[-1])
         builder.stdin = next_input
         builder.stdout = self.stdout
 
-        proc = builder.spawn()
+        proc = builder._spawn(process_class)
         res.append(proc)
+        if transformed is not None:
+            transformed.close()
 
         return res
 
+    @staticmethod
+    def _configure_stage(builder, command):
+        if isinstance(command, ChildProcessBuilder):
+            builder.args = command.args
+            builder._copy_controls(command)
+        else:
+            builder.args = command
+            builder._copy_controls(None)
+
     @property
     def commands(self):
         """The commands for the processes in the pipeline to execute.
 
         Commands may be provided as a list where each will be provided to the 'args' parameter of the ChildProcessBuilder,
-        or as a string separated by pipe characters."""
+        or as a string separated by pipe characters.
+
+        A command in a list may also be a ChildProcessBuilder, in which case its args and its resource controls
+        (rlimits, cpu_affinity, nice, ionice, and cgroup) are used for that stage. Its other attributes are
+        ignored in favor of the pipeline's.
+
+        A TransformStage may also be placed between two commands in a list, to transform the output of one before
+        it is fed to the other, within the parent process. It is not part of the created Pipeline."""
         return self._commands
 
     @commands.setter
@@ -487,3 +3389,2394 @@ class PipelineBuilder():
             self._commands = value
         else:
             raise TypeError("The commands should be supplied as a list or as a string with pipe characters")
+
+
+_SPLICE_F_NONBLOCK = 2
+
+def _find_tee():
+    """Return the C library's tee(2), which Python does not expose, or None."""
+    if not hasattr(os, "splice"):
+        return None
+    try:
+        tee = ctypes.CDLL(None, use_errno=True).tee
+    except (OSError, AttributeError):
+        return None
+    tee.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint)
+    tee.restype = ctypes.c_ssize_t
+    return tee
+
+_tee = _find_tee()
+
+def _tee_pipe(src_fd, dst_fd, count):
+    """Duplicate up to `count` bytes from the head of one pipe into another, without consuming them."""
+    copied = _tee(src_fd, dst_fd, count, _SPLICE_F_NONBLOCK)
+    if copied < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return copied
+
+class _Pump():
+    """Moves data between pipes on the reactor thread, tracking which of its file descriptors it waits on."""
+    def __init__(self):
+        self._watched = {}
+        self.transferred = 0
+
+    def _watch(self, wanted):
+        """Wait for exactly the readiness events in `wanted`, a mapping of file descriptors to selector events."""
+        for fd, events in list(self._watched.items()):
+            if wanted.get(fd) != events:
+                _reactor.unregister(fd)
+                del self._watched[fd]
+        for fd, events in wanted.items():
+            if fd not in self._watched:
+                _reactor.register(fd, events, self._on_ready)
+                self._watched[fd] = events
+
+    def _on_ready(self, fd, mask):
+        self._pump()
+
+    def start(self):
+        _reactor.call_soon(self._pump)
+
+class _TeePump(_Pump):
+    """Copies everything from one pipe into several, at the pace of the slowest.
+
+    With tee(2), every branch is given the data at the head of the source pipe without it passing through user
+    space, and the data is consumed from the source once every branch has it. A branch which has received more than
+    another waits until the other catches up, so the data buffered is bounded by the source pipe. Without tee(2),
+    one chunk at a time is read and written to every branch."""
+    def __init__(self, source_fd, branch_fds, chunk_size=65536):
+        super().__init__()
+        self._source = source_fd
+        self._branches = list(branch_fds)
+        self._ahead = [0] * len(self._branches)
+        self._chunk_size = chunk_size
+        self._chunk = None
+        self._eof = False
+        self._sink = os.open(os.devnull, os.O_WRONLY | os.O_CLOEXEC) if _tee is not None else None
+        for fd in [source_fd] + self._branches:
+            os.set_blocking(fd, False)
+
+    def close(self):
+        """Close every file descriptor of a pump which was never started."""
+        for fd in [self._source, self._sink] + self._branches:
+            if fd is not None:
+                os.close(fd)
+
+    def _drop(self, index):
+        """Stop copying to a branch whose reader has gone away."""
+        os.close(self._branches[index])
+        self._branches[index] = None
+
+    def _pump(self):
+        if _tee is not None:
+            wanted = self._tee()
+        else:
+            wanted = self._copy()
+        if wanted is None or all(fd is None for fd in self._branches):
+            self._finish()
+        else:
+            self._watch(wanted)
+
+    def _tee(self):
+        wanted = {}
+        progressed = True
+        while progressed:
+            progressed = False
+            wanted.clear()
+            available = _pipe_bytes_available(self._source)
+            if not available:
+                if self._eof_reached():
+                    return None
+                wanted[self._source] = selectors.EVENT_READ
+                return wanted
+            for index, fd in enumerate(self._branches):
+                if fd is None or self._ahead[index]:
+                    continue
+                try:
+                    self._ahead[index] = _tee_pipe(self._source, fd, available)
+                    progressed = True
+                except BlockingIOError:
+                    wanted[fd] = selectors.EVENT_WRITE
+                except BrokenPipeError:
+                    self._drop(index)
+            live = [ahead for ahead, fd in zip(self._ahead, self._branches) if fd is not None]
+            consumed = min(live) if live else available
+            remaining = consumed
+            while remaining:
+                remaining -= os.splice(self._source, self._sink, remaining)
+            if consumed:
+                self._ahead = [ahead - consumed for ahead in self._ahead]
+                self.transferred += consumed
+                progressed = True
+        return wanted
+
+    def _eof_reached(self):
+        """Return whether the empty source pipe has been closed by its writer."""
+        # poll rather than select, which cannot handle descriptors above FD_SETSIZE
+        poller = select.poll()
+        poller.register(self._source, select.POLLIN)
+        return bool(poller.poll(0)) and not _pipe_bytes_available(self._source)
+
+    def _copy(self):
+        while True:
+            if self._chunk is None:
+                try:
+                    data = os.read(self._source, self._chunk_size)
+                except BlockingIOError:
+                    return {self._source: selectors.EVENT_READ}
+                if not data:
+                    return None
+                self._chunk = [memoryview(data) if fd is not None else None for fd in self._branches]
+                self.transferred += len(data)
+
+            wanted = {}
+            for index, fd in enumerate(self._branches):
+                rest = self._chunk[index]
+                if fd is None or not rest:
+                    continue
+                try:
+                    self._chunk[index] = rest[os.write(fd, rest):]
+                except BlockingIOError:
+                    pass
+                except BrokenPipeError:
+                    self._drop(index)
+                    continue
+                if self._chunk[index]:
+                    wanted[fd] = selectors.EVENT_WRITE
+            if wanted:
+                return wanted
+            self._chunk = None
+
+    def _finish(self):
+        self._watch({})
+        for index, fd in enumerate(self._branches):
+            if fd is not None:
+                self._drop(index)
+        os.close(self._source)
+        if self._sink is not None:
+            os.close(self._sink)
+
+class _RecordPump(_Pump):
+    """Forwards whole records from one or more pipes into another, optionally transforming them.
+
+    Records from different sources are never interleaved: they are forwarded as they complete, in whichever order
+    the sources produce them, and a source's unterminated last record is terminated when the source closes. Without
+    a delimiter, arbitrary chunks are forwarded instead. Sources are not read while more than `max_buffered` bytes
+    are waiting to be written, so a slow consumer holds back the producers."""
+    def __init__(self, source_fds, destination_fd, delimiter=b"\n", max_buffered=1024 * 1024, transform=None,
+                 read_size=65536):
+        super().__init__()
+        self._sources = list(source_fds)
+        self._splitters = {fd: _RecordSplitter(delimiter) if delimiter else None for fd in self._sources}
+        self._delimiter = delimiter or b""
+        self._destination = destination_fd
+        self._max_buffered = max_buffered
+        self._transform = transform
+        self._read_size = read_size
+        self._pending = deque()
+        self._buffered = 0
+        for fd in self._sources + [destination_fd]:
+            os.set_blocking(fd, False)
+
+    def _pump(self):
+        progressed = True
+        while progressed and self._destination is not None:
+            progressed = self._write()
+            for fd in list(self._sources):
+                if self._buffered >= self._max_buffered or self._destination is None:
+                    break
+                try:
+                    data = os.read(fd, self._read_size)
+                except BlockingIOError:
+                    continue
+                progressed = True
+                splitter = self._splitters[fd]
+                if not data:
+                    self._sources.remove(fd)
+                    os.close(fd)
+                    records = [splitter.remainder()] if splitter and splitter.pending else []
+                elif splitter is not None:
+                    records = splitter.feed(data)
+                else:
+                    records = [data]
+                if self._transform is not None:
+                    records = self._transform._apply(records, len(data))
+                    if records is None:
+                        self._finish()
+                        return
+                if records:
+                    data = self._delimiter.join(records) + self._delimiter
+                    self._pending.append(data)
+                    self._buffered += len(data)
+
+        if self._destination is None or (not self._sources and not self._pending):
+            self._finish()
+            return
+        wanted = {}
+        if self._pending:
+            wanted[self._destination] = selectors.EVENT_WRITE
+        if self._buffered < self._max_buffered:
+            for fd in self._sources:
+                wanted[fd] = selectors.EVENT_READ
+        self._watch(wanted)
+
+    def _write(self):
+        """Write as much pending output as the destination accepts, returning whether any was written."""
+        if not self._pending:
+            return False
+        try:
+            written = os.writev(self._destination, list(itertools.islice(self._pending, _IOV_MAX)))
+        except BlockingIOError:
+            return False
+        except BrokenPipeError:
+            # Nobody reads the output any longer, so neither are the sources read
+            self._pending.clear()
+            self._buffered = 0
+            for fd in self._sources:
+                os.close(fd)
+            self._sources.clear()
+            return False
+        self._buffered -= written
+        self.transferred += written
+        if self._transform is not None:
+            self._transform._written(written)
+        while written:
+            if len(self._pending[0]) <= written:
+                written -= len(self._pending.popleft())
+            else:
+                self._pending[0] = memoryview(self._pending[0])[written:]
+                written = 0
+        return True
+
+    def close(self):
+        """Close every file descriptor of a pump which was never started."""
+        for fd in self._sources + [self._destination]:
+            os.close(fd)
+
+    def _finish(self):
+        self._watch({})
+        for fd in self._sources:
+            os.close(fd)
+        self._sources.clear()
+        if self._destination is not None:
+            os.close(self._destination)
+            self._destination = None
+        if self._transform is not None:
+            self._transform._finished_at = time.monotonic()
+            self._transform._finished.set()
+
+class PipelineGraph():
+    """A directed acyclic graph of processes, each of whose output may feed several processes, and whose input may
+    be merged from several processes.
+
+    Nodes are added from ChildProcessBuilders and connected with edges. A node's stdin is replaced by its incoming
+    edges, if any, and its stdout by its outgoing edges, if any; its other attributes are its builder's.
+
+    An edge between a node with one output and a node with one input is a plain pipe. The output of a node with
+    several outgoing edges is copied to all of them by the reactor thread, with tee(2) and splice(2) where
+    available, so that it does not pass through user space. The inputs of a node with several incoming edges are
+    merged by the reactor thread, forwarding whole delimiter-terminated records so that no record is interleaved
+    with another. Every copy proceeds at the pace of its slowest reader, so the data buffered stays bounded."""
+    def __init__(self, delimiter=b"\n", pipe_size=None, max_buffered=1024 * 1024):
+        """
+        Parameters
+        ----------
+        delimiter: bytes, optional
+            The delimiter of the records which merged inputs are aligned to, or None to merge arbitrary chunks.
+        pipe_size: int, optional
+            The size in bytes of the kernel buffers of every pipe between nodes.
+        max_buffered: int, optional
+            The maximum number of bytes which a merge holds before it stops reading its sources."""
+        self._delimiter = delimiter
+        self._pipe_size = pipe_size
+        self._max_buffered = max_buffered
+        self._nodes = []
+        self._edges = []
+
+    def add(self, builder):
+        """Add a node running the command of a ChildProcessBuilder, returning the node's index."""
+        if not isinstance(builder, ChildProcessBuilder):
+            raise TypeError("Nodes must be ChildProcessBuilders")
+        self._nodes.append(builder)
+        return len(self._nodes) - 1
+
+    def connect(self, source, destination):
+        """Feed the output of the node `source` to the input of the node `destination`."""
+        for node in (source, destination):
+            if not 0 <= node < len(self._nodes):
+                raise IndexError("No such node: {}".format(node))
+        if source == destination or (source, destination) in self._edges:
+            raise ValueError("Nodes can only be connected once, and not to themselves")
+        if self._reaches(destination, source):
+            raise ValueError("Connecting node {} to node {} would create a cycle".format(source, destination))
+        self._edges.append((source, destination))
+
+    def _reaches(self, start, target):
+        pending, seen = [start], set()
+        while pending:
+            node = pending.pop()
+            if node == target:
+                return True
+            if node not in seen:
+                seen.add(node)
+                pending.extend(b for a, b in self._edges if a == node)
+        return False
+
+    def _pipe(self):
+        read_fd, write_fd = os.pipe()
+        if self._pipe_size is not None:
+            _set_pipe_size(write_fd, self._pipe_size)
+        return read_fd, write_fd
+
+    def spawn(self):
+        """Create the processes of the graph, and start copying between them.
+
+        Returns
+        -------
+        Pipeline
+            The created processes, in the order in which their nodes were added
+        """
+        outgoing = [[] for _ in self._nodes]
+        incoming = [[] for _ in self._nodes]
+        for edge in self._edges:
+            outgoing[edge[0]].append(edge)
+            incoming[edge[1]].append(edge)
+
+        # Descriptors not yet owned by a file object or a pump, which are closed if anything fails
+        loose = set()
+
+        def pipe():
+            fds = self._pipe()
+            loose.update(fds)
+            return fds
+
+        child_ends = []
+        stdins, stdouts = {}, {}
+        pumps = []
+        processes = []
+        try:
+            pipes = {edge: pipe() for edge in self._edges}
+            for node in range(len(self._nodes)):
+                if len(outgoing[node]) == 1:
+                    stdouts[node] = pipes[outgoing[node][0]][1]
+                elif outgoing[node]:
+                    read_fd, stdouts[node] = pipe()
+                    branches = [pipes[edge][1] for edge in outgoing[node]]
+                    pumps.append(_TeePump(read_fd, branches))
+                    loose.difference_update([read_fd] + branches)
+                if len(incoming[node]) == 1:
+                    stdins[node] = pipes[incoming[node][0]][0]
+                elif incoming[node]:
+                    stdins[node], write_fd = pipe()
+                    sources = [pipes[edge][0] for edge in incoming[node]]
+                    pumps.append(_RecordPump(sources, write_fd, self._delimiter, self._max_buffered))
+                    loose.difference_update(sources + [write_fd])
+            for ends, mode in ((stdins, "rb"), (stdouts, "wb")):
+                for node, fd in ends.items():
+                    ends[node] = open(fd, mode, buffering=0)
+                    loose.discard(fd)
+                    child_ends.append(ends[node])
+
+            for node, builder in enumerate(self._nodes):
+                builder = copy.copy(builder)
+                if node in stdins:
+                    builder.stdin = stdins[node]
+                if node in stdouts:
+                    builder.stdout = stdouts[node]
+                processes.append(builder.spawn())
+        except BaseException:
+            for fd in loose:
+                os.close(fd)
+            for pump in pumps:
+                pump.close()
+            for process in processes:
+                process.terminate(force=True)
+                process.wait_for_finish()
+                for stream in (process._popen.stdin, process._popen.stdout, process._popen.stderr):
+                    if stream is not None:
+                        stream.close()
+            raise
+        finally:
+            # The processes hold their own copies of their ends of the pipes
+            for end in child_ends:
+                end.close()
+        for pump in pumps:
+            pump.start()
+        return Pipeline(processes)
+
+
+class _RecordSplitter():
+    """Incrementally split a byte stream into delimited records."""
+    def __init__(self, delimiter=b"\n"):
+        if not delimiter:
+            raise ValueError("The record delimiter must be a non-empty bytes object")
+        self._delimiter = delimiter
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Append `data` to the buffered stream and return the list of records it completed."""
+        buf = self._buffer
+        scan_from = max(0, len(buf) - len(self._delimiter) + 1)
+        buf += data
+
+        records = []
+        begin = 0
+        end = buf.find(self._delimiter, scan_from)
+        while end >= 0:
+            records.append(bytes(buf[begin:end]))
+            begin = end + len(self._delimiter)
+            end = buf.find(self._delimiter, begin)
+        if begin:
+            del buf[:begin]
+        return records
+
+    @property
+    def pending(self):
+        """The number of trailing bytes not yet terminated by the delimiter. Read-only."""
+        return len(self._buffer)
+
+    def remainder(self):
+        """Return and clear any trailing bytes not terminated by the delimiter."""
+        rest = bytes(self._buffer)
+        self._buffer.clear()
+        return rest
+
+class _PoolWorker():
+    def __init__(self, process, delimiter):
+        self.process = process
+        self.fd = process.stdout.fileno()
+        self.in_flight = deque()
+        self.splitter = _RecordSplitter(delimiter)
+
+class ChildProcessPool():
+    """A pool of persistent worker processes, all spawned from the same ChildProcessBuilder.
+
+    Tasks are delimited records (lines, by default) written to a worker's standard input. Each worker must answer
+    every task with exactly one delimited record on its standard output, in the order in which it received them.
+    New tasks are always given to the least-loaded worker which has capacity, and results are yielded as soon as
+    any worker produces them. Workers which exit are transparently respawned, and their unanswered tasks are
+    dispatched again.
+
+    May be used with Python's `with` statement - upon the exit of the block, all workers will be terminated."""
+    def __init__(self, builder, size=None, max_in_flight=1, delimiter=b"\n", max_task_retries=3):
+        """Spawn the workers of the pool.
+
+        Parameters
+        ----------
+        builder: ChildProcessBuilder
+            The builder used to spawn (and respawn) each worker. Its stdin and stdout must be ChildProcessIO.PIPE.
+            A piped stderr is inherited instead, since nothing would read it.
+        size: int, optional
+            The number of workers. Defaults to the number of CPUs.
+        max_in_flight: int, optional
+            The maximum number of tasks which may be dispatched to one worker before it has answered them.
+        delimiter: bytes, optional
+            The delimiter terminating each task and each result. Defaults to a newline.
+        max_task_retries: int, optional
+            How many times a task is dispatched again after its worker exited without answering it, before
+            giving up with a RuntimeError."""
+        if builder.stdin != ChildProcessIO.PIPE or builder.stdout != ChildProcessIO.PIPE:
+            raise ValueError("Pool workers must have both stdin and stdout set to ChildProcessIO.PIPE")
+        if size is None:
+            size = os.cpu_count() or 1
+        if size < 1 or max_in_flight < 1:
+            raise ValueError("A pool needs at least one worker, and each worker must accept at least one task")
+        if builder.stderr == ChildProcessIO.PIPE:
+            builder = copy.copy(builder)
+            builder.stderr = ChildProcessIO.INHERIT
+        self._builder = builder
+        self._max_in_flight = max_in_flight
+        self._delimiter = delimiter
+        self._max_task_retries = max_task_retries
+        self._respawn_count = 0
+        self._workers = [self._spawn_worker() for _ in range(size)]
+
+    @property
+    def workers(self):
+        """The ChildProcess instances currently serving as workers. Read-only."""
+        return [worker.process for worker in self._workers]
+
+    @property
+    def respawn_count(self):
+        """The number of times a worker has been respawned after exiting. Read-only."""
+        return self._respawn_count
+
+    def _spawn_worker(self):
+        return _PoolWorker(self._builder.spawn(), self._delimiter)
+
+    def _encode(self, task):
+        if isinstance(task, str):
+            task = task.encode()
+        if not task.endswith(self._delimiter):
+            task += self._delimiter
+        return task
+
+    def _respawn(self, index, selector, pending):
+        """Replace a worker which has exited, queueing its unanswered tasks to be dispatched again."""
+        worker = self._workers[index]
+        selector.unregister(worker.fd)
+        if not worker.process.is_finished():
+            worker.process.terminate(force=True)
+        worker.process.wait_for_finish()
+
+        for retries, entry in reversed(worker.in_flight):
+            if retries >= self._max_task_retries:
+                raise RuntimeError("Task {!r} was abandoned by {} workers".format(entry[1], retries + 1))
+            pending.appendleft((retries + 1, entry))
+
+        replacement = self._spawn_worker()
+        self._workers[index] = replacement
+        self._respawn_count += 1
+        selector.register(replacement.fd, selectors.EVENT_READ, index)
+
+    def _reset(self):
+        """Replace the workers which still have tasks in flight, whose results would otherwise be attributed to the
+        tasks of a later call."""
+        for index, worker in enumerate(self._workers):
+            if worker.in_flight or worker.splitter.remainder():
+                if not worker.process.is_finished():
+                    worker.process.terminate(force=True)
+                worker.process.wait_for_finish()
+                self._workers[index] = self._spawn_worker()
+
+    def _dispatch(self, pending, selector):
+        while pending:
+            candidates = [i for i, w in enumerate(self._workers) if len(w.in_flight) < self._max_in_flight]
+            if not candidates:
+                return
+            index = min(candidates, key=lambda i: len(self._workers[i].in_flight))
+            worker = self._workers[index]
+            retries, entry = pending.popleft()
+            worker.in_flight.append((retries, entry))
+            try:
+                worker.process.stdin.write(self._encode(entry[1]))
+                worker.process.stdin.flush()
+            except BrokenPipeError:
+                self._respawn(index, selector, pending)
+
+    def imap_unordered(self, tasks):
+        """Dispatch each of `tasks` to the workers, yielding `(task, result)` pairs in order of completion.
+
+        Tasks may be strings or bytes, and need not include the trailing delimiter. Results are bytes, without it.
+
+        Parameters
+        ----------
+        tasks: iterable
+            The tasks to dispatch. Consumed lazily, as workers become available."""
+        for (_, task), result in self._run(enumerate(tasks)):
+            yield task, result
+
+    def map(self, tasks):
+        """Dispatch each of `tasks` to the workers, and return the list of their results in the order of `tasks`."""
+        tasks = list(tasks)
+        results = [None] * len(tasks)
+        for (position, _), result in self._run(enumerate(tasks)):
+            results[position] = result
+        return results
+
+    def _run(self, entries):
+        """Dispatch `(key, task)` entries, yielding `((key, task), result)` as results arrive."""
+        pending = deque()
+        try:
+            with selectors.DefaultSelector() as selector:
+                for index, worker in enumerate(self._workers):
+                    selector.register(worker.fd, selectors.EVENT_READ, index)
+
+                while True:
+                    capacity = sum(self._max_in_flight - len(w.in_flight) for w in self._workers)
+                    while len(pending) < capacity:
+                        try:
+                            pending.append((0, next(entries)))
+                        except StopIteration:
+                            break
+                    self._dispatch(pending, selector)
+
+                    if not pending and not any(w.in_flight for w in self._workers):
+                        return
+
+                    for key, _ in selector.select():
+                        index = key.data
+                        worker = self._workers[index]
+                        data = os.read(worker.fd, 65536)
+                        if not data:
+                            self._respawn(index, selector, pending)
+                            continue
+                        for result in worker.splitter.feed(data):
+                            _, entry = worker.in_flight.popleft()
+                            yield entry, result
+        finally:
+            # The caller may have stopped early, or a task may have failed
+            self._reset()
+
+    def close(self):
+        """Close the input of all workers, terminate them, and wait for them to exit."""
+        for worker in self._workers:
+            try:
+                worker.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            if not worker.process.is_finished():
+                worker.process.terminate()
+        for worker in self._workers:
+            worker.process.wait_for_finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class _StandbyEntry():
+    def __init__(self, template):
+        self.template = template
+        self.ready = deque()
+
+class StandbyCache():
+    """A cache of already-started child processes, kept ready to be handed out without paying their startup cost.
+
+    Processes are cached per configuration: each distinct ChildProcessBuilder configuration (or each
+    ChildProcessTemplate) which has been requested keeps up to `size` standby processes. Acquiring a process is a
+    dequeue from those which are ready, after which a background thread spawns a replacement. Standby processes
+    which have been idle for longer than `ttl` seconds are terminated, as are those of the least recently used
+    configuration once there are more than `max_configurations`.
+
+    May be used with Python's `with` statement - upon the exit of the block, all standby processes are terminated."""
+    def __init__(self, size=1, ttl=60.0, max_configurations=16):
+        """
+        Parameters
+        ----------
+        size: int, optional
+            The number of standby processes to keep ready for each configuration.
+        ttl: float, optional
+            The number of seconds after which an idle standby process is terminated, or None to keep it forever.
+        max_configurations: int, optional
+            The maximum number of configurations for which standby processes are kept."""
+        if size < 1 or max_configurations < 1:
+            raise ValueError("The cache must hold at least one process of at least one configuration")
+        self._size = size
+        self._ttl = ttl
+        self._max_configurations = max_configurations
+        self._entries = OrderedDict()
+        self._wanted = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._stats = {"hits": 0, "misses": 0, "spawned": 0, "expired": 0, "evicted": 0}
+        self._thread = threading.Thread(target=self._run, name="childprocess-standby", daemon=True)
+        self._thread.start()
+
+    def _entry(self, configuration):
+        """Return the key and entry for a builder or template, creating the entry if needed. Requires the lock."""
+        if isinstance(configuration, ChildProcessTemplate):
+            key = id(configuration)
+        else:
+            key = configuration._configuration_key()
+        entry = self._entries.get(key)
+        if entry is None:
+            template = configuration if isinstance(configuration, ChildProcessTemplate) else configuration.freeze()
+            entry = self._entries[key] = _StandbyEntry(template)
+            while len(self._entries) > self._max_configurations:
+                _, evicted = self._entries.popitem(last=False)
+                self._stats["evicted"] += len(evicted.ready)
+                self._discard_all(evicted.ready)
+        else:
+            self._entries.move_to_end(key)
+        return key, entry
+
+    def _replenish(self, key):
+        self._wanted.append(key)
+        self._condition.notify()
+
+    def prewarm(self, configuration):
+        """Start filling the cache for a ChildProcessBuilder or ChildProcessTemplate, without acquiring a process."""
+        with self._condition:
+            self._check_open()
+            key, _ = self._entry(configuration)
+            self._replenish(key)
+
+    def acquire(self, configuration):
+        """Return a running process for a ChildProcessBuilder or ChildProcessTemplate, from the cache if one is ready.
+
+        A process from the cache is handed over to the caller, and a replacement is spawned in the background. If
+        no process is ready, one is spawned immediately. Lookups for a ChildProcessTemplate are cheaper than for a
+        ChildProcessBuilder, whose whole configuration must be compared.
+
+        Returns
+        -------
+        ChildProcess
+            A process which is not shared with anybody else
+        """
+        with self._condition:
+            self._check_open()
+            key, entry = self._entry(configuration)
+            process = None
+            while entry.ready and process is None:
+                _, candidate = entry.ready.popleft()
+                if candidate.is_finished():
+                    self._discard(candidate)
+                else:
+                    process = candidate
+            self._stats["hits" if process else "misses"] += 1
+            self._replenish(key)
+            template = entry.template
+        return process or template.spawn()
+
+    def ready_count(self, configuration):
+        """Return the number of standby processes ready for a ChildProcessBuilder or ChildProcessTemplate."""
+        with self._condition:
+            key = id(configuration) if isinstance(configuration, ChildProcessTemplate) \
+                else configuration._configuration_key()
+            entry = self._entries.get(key)
+            return len(entry.ready) if entry else 0
+
+    def stats(self):
+        """Return a dictionary of the cache's `hits` and `misses`, and the number of standby processes which were
+        `spawned`, `expired` after their ttl, and `evicted` along with their configuration."""
+        with self._condition:
+            return dict(self._stats)
+
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError("The standby cache is closed")
+
+    @staticmethod
+    def _discard(process):
+        if not process.is_finished():
+            process.terminate(force=True)
+        for stream in (process._popen.stdin, process._popen.stdout, process._popen.stderr):
+            if stream is not None:
+                stream.close()
+
+    def _discard_all(self, ready):
+        for _, process in ready:
+            self._discard(process)
+        ready.clear()
+
+    def _expire(self):
+        """Terminate the standby processes which have outlived the ttl, returning the time until the next expiry."""
+        if self._ttl is None:
+            return None
+        now = time.monotonic()
+        next_expiry = None
+        for entry in self._entries.values():
+            while entry.ready and now - entry.ready[0][0] >= self._ttl:
+                _, process = entry.ready.popleft()
+                self._discard(process)
+                self._stats["expired"] += 1
+            if entry.ready:
+                expiry = entry.ready[0][0] + self._ttl - now
+                next_expiry = expiry if next_expiry is None else min(next_expiry, expiry)
+        return next_expiry
+
+    def _next_work(self):
+        """Wait for a configuration which needs another standby process. Requires the lock."""
+        while not self._closed:
+            timeout = self._expire()
+            while self._wanted:
+                key = self._wanted.popleft()
+                entry = self._entries.get(key)
+                if entry is not None and len(entry.ready) < self._size:
+                    return key, entry.template
+            self._condition.wait(timeout)
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                work = self._next_work()
+            if work is None:
+                return
+            key, template = work
+            try:
+                process = template.spawn()
+            except Exception:
+                traceback.print_exc()
+                continue
+
+            with self._condition:
+                entry = self._entries.get(key)
+                if self._closed or entry is None or entry.template is not template:
+                    self._discard(process)
+                    continue
+                entry.ready.append((time.monotonic(), process))
+                self._stats["spawned"] += 1
+                if len(entry.ready) < self._size:
+                    self._wanted.append(key)
+
+    def close(self):
+        """Stop replenishing the cache, and terminate all standby processes."""
+        with self._condition:
+            self._closed = True
+            for entry in self._entries.values():
+                self._discard_all(entry.ready)
+            self._entries.clear()
+            self._condition.notify()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class FrameFormat(Enum):
+    """The framing of the messages exchanged by a FramedChannel.
+
+    Values:
+    JSON_LINES - Each message is a JSON object on a line of its own, carrying its request ID in an "id" member
+    LENGTH_PREFIXED - Each message is a big-endian 32-bit payload length and a big-endian 32-bit request ID,
+        followed by the payload bytes"""
+    JSON_LINES = 1
+    LENGTH_PREFIXED = 2
+
+_FRAME_HEADER = struct.Struct(">II")
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (ValueError, OSError):
+    _IOV_MAX = 1024
+
+class FramedChannel():
+    """A request/response channel over the stdin and stdout pipes of a child process.
+
+    Each request is tagged with a request ID, which the child process must copy into its response, so that any number
+    of requests may be in flight at once and responses may arrive in any order. Requests are queued and written by the
+    reactor thread, which batches all those queued at the time into a single `writev`, and responses are read and
+    dispatched on the reactor thread as well.
+
+    May be used with Python's `with` statement - upon the exit of the block, the channel is closed."""
+    def __init__(self, process, format=FrameFormat.JSON_LINES):
+        """
+        Parameters
+        ----------
+        process: ChildProcess
+            The process to communicate with, which must have been created with piped stdin and stdout. Neither
+            stream should be used directly while the channel is open.
+        format: FrameFormat, optional
+            The framing of the messages."""
+        if not isinstance(format, FrameFormat):
+            raise TypeError("format must be a FrameFormat")
+        self._process = process
+        self._format = format
+        self._input = process.stdin
+        self._write_fd = self._input.fileno()
+        self._read_fd = process.stdout.fileno()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._in_flight = {}
+        self._outgoing = deque()
+        self._writing = False
+        self._write_registered = False
+        self._closing = False
+        self._error = None
+        self._buffer = bytearray()
+        os.set_blocking(self._write_fd, False)
+        os.set_blocking(self._read_fd, False)
+        _reactor.register(self._read_fd, selectors.EVENT_READ, self._on_readable)
+
+    @property
+    def process(self):
+        """The process at the other end of the channel. Read-only."""
+        return self._process
+
+    @property
+    def in_flight(self):
+        """The number of requests awaiting a response. Read-only."""
+        with self._lock:
+            return len(self._in_flight)
+
+    def request(self, message):
+        """Send a request without waiting for its response.
+
+        Parameters
+        ----------
+        message: dict or bytes
+            The request: a JSON-serialisable dictionary, to which an "id" member is added, for
+            FrameFormat.JSON_LINES, or the payload bytes for FrameFormat.LENGTH_PREFIXED.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            A future for the response: the decoded JSON object for FrameFormat.JSON_LINES, or the payload bytes for
+            FrameFormat.LENGTH_PREFIXED. If the channel fails before the response arrives, the future is given the
+            exception - EOFError if the process closed its output, or ValueError if it sent a malformed response or
+            one without a known request ID.
+        """
+        if self._format == FrameFormat.JSON_LINES:
+            if not isinstance(message, dict):
+                raise TypeError("JSON messages must be dictionaries")
+        elif not isinstance(message, (bytes, bytearray, memoryview)):
+            raise TypeError("Length-prefixed messages must be bytes-like")
+
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            if self._closing:
+                raise RuntimeError("The channel is closed")
+            request_id = self._next_id
+            self._next_id = (request_id + 1) & 0xFFFFFFFF
+            if self._format == FrameFormat.JSON_LINES:
+                line = json.dumps(dict(message, id=request_id), separators=(",", ":"))
+                self._outgoing.append((line + "\n").encode("utf-8"))
+            else:
+                # The header and payload are written as separate vectors, so that the payload is not copied
+                self._outgoing.append(_FRAME_HEADER.pack(len(message), request_id))
+                self._outgoing.append(message)
+            self._in_flight[request_id] = future
+            start = not self._writing
+            self._writing = True
+        if start:
+            _reactor.call_soon(self._flush)
+        return future
+
+    def call(self, message, timeout=None):
+        """Send a request and wait for its response, which is returned as described by `request`.
+
+        Parameters
+        ----------
+        message: dict or bytes
+            The request, as described by `request`.
+        timeout: float, optional
+            The maximum number of seconds to wait for the response, after which subprocess.TimeoutExpired is
+            raised and the response is discarded should it arrive later."""
+        future = self.request(message)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise subprocess.TimeoutExpired(self._process.args, timeout) from None
+
+    async def call_async(self, message):
+        """Send a request and wait for its response in an asyncio event loop, returning it as described by
+        `request`."""
+        return await asyncio.wrap_future(self.request(message))
+
+    def _flush(self, fd=None, mask=None):
+        """Write as many queued frames as the pipe accepts, then wait for it to become writeable if any remain."""
+        with self._lock:
+            vectors = list(itertools.islice(self._outgoing, _IOV_MAX))
+        try:
+            written = os.writev(self._write_fd, vectors) if vectors else 0
+        except BlockingIOError:
+            written = 0
+        except OSError as error:
+            self._fail(error)
+            return
+
+        with self._lock:
+            outgoing = self._outgoing
+            while written:
+                if len(outgoing[0]) <= written:
+                    written -= len(outgoing.popleft())
+                else:
+                    outgoing[0] = memoryview(outgoing[0])[written:]
+                    written = 0
+            remaining = bool(outgoing)
+            if not remaining:
+                self._writing = False
+        if remaining and not self._write_registered:
+            _reactor.register(self._write_fd, selectors.EVENT_WRITE, self._flush)
+            self._write_registered = True
+        elif not remaining:
+            self._stop_writing()
+
+    def _stop_writing(self):
+        if self._write_registered:
+            _reactor.unregister(self._write_fd)
+            self._write_registered = False
+        if self._closing and not self._input.closed:
+            self._input.close()
+
+    def _on_readable(self, fd, mask):
+        try:
+            data = os.read(fd, 262144)
+        except BlockingIOError:
+            return
+        if not data:
+            _reactor.unregister(fd)
+            self._fail(EOFError("The child process closed its output"))
+            return
+
+        self._buffer += data
+        try:
+            responses = self._decode()
+        except ValueError as error:
+            _reactor.unregister(fd)
+            self._fail(error)
+            return
+        for request_id, response in responses:
+            with self._lock:
+                future = self._in_flight.pop(request_id, None)
+            if future is None:
+                # The waiting caller could never be found, so the whole channel fails rather than let it hang
+                _reactor.unregister(fd)
+                self._fail(ValueError("Received a response for an unknown request ID: {!r}".format(request_id)))
+                return
+            if future.set_running_or_notify_cancel():
+                future.set_result(response)
+
+    def _decode(self):
+        """Remove and return the complete responses in the read buffer, as (request ID, response) tuples."""
+        buf = self._buffer
+        responses = []
+        begin = 0
+        if self._format == FrameFormat.JSON_LINES:
+            end = buf.find(b"\n")
+            while end >= 0:
+                response = json.loads(buf[begin:end])
+                responses.append((response.get("id") if isinstance(response, dict) else None, response))
+                begin = end + 1
+                end = buf.find(b"\n", begin)
+        else:
+            header_size = _FRAME_HEADER.size
+            while len(buf) - begin >= header_size:
+                length, request_id = _FRAME_HEADER.unpack_from(buf, begin)
+                if len(buf) - begin - header_size < length:
+                    break
+                responses.append((request_id, bytes(buf[begin + header_size:begin + header_size + length])))
+                begin += header_size + length
+        if begin:
+            del buf[:begin]
+        return responses
+
+    def _fail(self, error):
+        """Fail all requests in flight, and any made later, with `error`."""
+        with self._lock:
+            if self._error is None:
+                self._error = error
+            in_flight, self._in_flight = self._in_flight, {}
+            self._outgoing.clear()
+            self._writing = False
+        for future in in_flight.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+        self._stop_writing()
+
+    def close(self):
+        """Stop accepting requests, and close the process's stdin once those already queued have been written.
+
+        Responses to requests in flight are still delivered until the process closes its output."""
+        with self._lock:
+            self._closing = True
+            writing = self._writing
+        if not writing:
+            _reactor.call_soon(self._stop_writing)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class ProcessEventType(Enum):
+    """The kind of a ProcessEvent."""
+    CHUNK = 1
+    """A chunk of output was read."""
+    LINE = 2
+    """A line of output was read. The final line of a stream is delivered even if it is not terminated."""
+    EOF = 3
+    """An output stream was closed."""
+    EXITED = 4
+    """The process exited. Delivered after the EOF events of all of the process's streams in the group."""
+
+class ProcessEvent():
+    """An event delivered by a ProcessGroup.
+
+    Attributes:
+    process - The process the event originated from
+    type - The ProcessEventType of the event
+    stream - "stdout" or "stderr", or None for ProcessEventType.EXITED
+    data - The output, without its newline, for ProcessEventType.CHUNK and ProcessEventType.LINE, the exit code for
+        ProcessEventType.EXITED, or None"""
+    def __init__(self, process, type, stream=None, data=None):
+        self.process = process
+        self.type = type
+        self.stream = stream
+        self.data = data
+
+    def __repr__(self):
+        return "ProcessEvent(pid={}, type={}, stream={}, data={!r})".format(self.process.pid, self.type.name,
+                                                                            self.stream, self.data)
+
+class _GroupStream():
+    def __init__(self, process, name, read_size, lines):
+        self.process = process
+        self.name = name
+        self.file = process._output_stream(name)
+        self.fd = self.file.fileno()
+        self.read_size = read_size
+        self.splitter = _RecordSplitter() if lines else None
+        self.paused = False
+        self.open = True
+
+class ProcessGroup():
+    """Multiplexes the output of many child processes onto a single selector, run by the thread which polls the
+    group, as one stream of ProcessEvents tagged with their originating process.
+
+    Output is only read while the group is polled, and at most one read is made from each ready pipe per poll, so a
+    consumer which falls behind makes the processes block on their full pipes. Individual streams may also be
+    paused and resumed.
+
+    Iterating over the group yields events until every process has exited and been removed from it.
+
+    May be used with Python's `with` statement - upon the exit of the block, the group is closed."""
+    def __init__(self, read_size=65536, lines=False):
+        """
+        Parameters
+        ----------
+        read_size: int, optional
+            The default maximum number of bytes to read from a pipe at once.
+        lines: bool, optional
+            If true, output is delivered as ProcessEventType.LINE events, otherwise as ProcessEventType.CHUNK
+            events."""
+        self._read_size = read_size
+        self._lines = lines
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._exits = deque()
+        self._members = {}
+        self._exited = set()
+        self._events = deque()
+
+    def __len__(self):
+        return len(self._members)
+
+    def add(self, process, streams=None, read_size=None):
+        """Add a process to the group.
+
+        An exit event is delivered for the process once it has exited and all of its streams in the group have been
+        closed, after which the process is removed from the group.
+
+        Parameters
+        ----------
+        process: ChildProcess
+            The process to add. Its streams in the group should not be read by anything else.
+        streams: list of str, optional
+            The names of the streams to read - "stdout" and/or "stderr". Defaults to whichever of them are pipes.
+        read_size: int, optional
+            The maximum number of bytes to read from the process's pipes at once, instead of the group's default.
+        """
+        if process in self._members:
+            raise ValueError("The process is already in the group")
+        if streams is None:
+            streams = [name for name, readable in (("stdout", process._stdout_readable),
+                                                   ("stderr", process._stderr_readable)) if readable]
+        members = {}
+        for name in streams:
+            stream = _GroupStream(process, name, read_size or self._read_size, self._lines)
+            os.set_blocking(stream.fd, False)
+            members[name] = stream
+        for stream in members.values():
+            self._selector.register(stream.fd, selectors.EVENT_READ, stream)
+        self._members[process] = members
+        process.add_exit_callback(self._on_exit)
+
+    def _on_exit(self, process):
+        with self._lock:
+            # Once closed, the wakeup pipe's descriptor may already have been reused
+            if self._closed:
+                return
+            self._exits.append(process)
+            try:
+                os.write(self._wakeup_write, b"\0")
+            except (BlockingIOError, OSError):
+                pass
+
+    def _stream(self, process, name):
+        try:
+            return self._members[process][name]
+        except KeyError:
+            raise ValueError("The {} of the process is not in the group".format(name)) from None
+
+    def pause(self, process, stream="stdout"):
+        """Stop reading a stream of a process, so that the process blocks once the pipe is full."""
+        member = self._stream(process, stream)
+        if member.open and not member.paused:
+            self._selector.unregister(member.fd)
+            member.paused = True
+
+    def resume(self, process, stream="stdout"):
+        """Resume reading a stream paused by `pause`."""
+        member = self._stream(process, stream)
+        if member.open and member.paused:
+            self._selector.register(member.fd, selectors.EVENT_READ, member)
+            member.paused = False
+
+    def poll(self, timeout=None):
+        """Wait for events, and return them in a list.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            The maximum number of seconds to wait, after which an empty list is returned. If None, waits until there
+            is an event, or until the group is empty.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._events and self._members:
+            self._collect_exits()
+            if self._events:
+                break
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not all(process._watched for process in self._members):
+                # Processes without a pidfd report their exit only when polled
+                remaining = 0.01 if remaining is None else min(remaining, 0.01)
+            ready = self._selector.select(remaining)
+            for key, mask in ready:
+                if key.data is None:
+                    try:
+                        while os.read(self._wakeup_read, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._read(key.data)
+            if not ready and remaining == 0:
+                break
+        events = list(self._events)
+        self._events.clear()
+        return events
+
+    def __iter__(self):
+        while self._members:
+            yield from self.poll()
+
+    def _read(self, stream):
+        try:
+            data = os.read(stream.fd, stream.read_size)
+        except BlockingIOError:
+            return
+        process = stream.process
+        if data:
+            if stream.splitter is None:
+                self._events.append(ProcessEvent(process, ProcessEventType.CHUNK, stream.name, data))
+            else:
+                for line in stream.splitter.feed(data):
+                    self._events.append(ProcessEvent(process, ProcessEventType.LINE, stream.name, line))
+            return
+
+        if not stream.paused:
+            self._selector.unregister(stream.fd)
+        stream.file.close()
+        stream.open = False
+        if stream.splitter is not None:
+            rest = stream.splitter.remainder()
+            if rest:
+                self._events.append(ProcessEvent(process, ProcessEventType.LINE, stream.name, rest))
+        self._events.append(ProcessEvent(process, ProcessEventType.EOF, stream.name))
+        self._finish(process)
+
+    def _collect_exits(self):
+        for process in list(self._members):
+            if not process._watched and process not in self._exited:
+                # Records the exit, which calls _on_exit
+                process.is_finished()
+        with self._lock:
+            exits, self._exits = self._exits, deque()
+        for process in exits:
+            self._exited.add(process)
+            self._finish(process)
+
+    def _finish(self, process):
+        """Deliver the exit event of a process and remove it from the group, if it has exited and its streams are
+        closed."""
+        if process in self._exited and not any(stream.open for stream in self._members[process].values()):
+            self._exited.discard(process)
+            del self._members[process]
+            self._events.append(ProcessEvent(process, ProcessEventType.EXITED, data=process.exit_code))
+
+    def close(self):
+        """Stop watching all processes, and release the group's selector."""
+        with self._lock:
+            self._closed = True
+        for streams in self._members.values():
+            for stream in streams.values():
+                if stream.open and not stream.paused:
+                    self._selector.unregister(stream.fd)
+        self._members.clear()
+        self._selector.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+_CACHE_RECORD = struct.Struct(">iqq")
+
+class CommandCache():
+    """A cache of the results of deterministic commands, so that running one again with the same inputs returns the
+    stored result without creating a process.
+
+    Results are keyed on a SHA-256 digest of the arguments, the environment (or a chosen subset of it), the working
+    directory, the stdin bytes, every other attribute of the builder which affects execution, and the path, size,
+    modification time and content digest of any declared input files. They are kept in a size-bounded in-memory
+    tier and, if a directory is given, a size-bounded on-disk tier shared between processes, each evicting the least
+    recently used results first.
+
+    Only the output captured by ChildProcessIO.PIPE is stored and returned on a hit. Commands whose stdin is not a
+    pipe, /dev/null, a string or bytes, or whose output goes to a file, cannot be cached."""
+    def __init__(self, directory=None, max_memory_bytes=64 * 1024 * 1024, max_disk_bytes=1024 * 1024 * 1024,
+                 cache_failures=False):
+        """
+        Parameters
+        ----------
+        directory: str, optional
+            The directory of the on-disk tier, created if necessary. If None, results are only kept in memory.
+        max_memory_bytes: int, optional
+            The maximum total size of the output held in memory.
+        max_disk_bytes: int, optional
+            The maximum total size of the on-disk tier.
+        cache_failures: bool, optional
+            Whether results with non-zero exit codes are cached."""
+        self._directory = directory
+        self._max_memory_bytes = max_memory_bytes
+        self._max_disk_bytes = max_disk_bytes
+        self._cache_failures = cache_failures
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._file_digests = {}
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        self._disk_bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    def _file_digest(self, path):
+        """Return the content digest of a file, recomputed only when its identity, size or mtime change."""
+        status = os.stat(path)
+        identity = (status.st_ino, status.st_dev, status.st_size, status.st_mtime_ns)
+        with self._lock:
+            cached = self._file_digests.get(path)
+        if cached and cached[0] == identity:
+            return cached[1]
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+        with self._lock:
+            self._file_digests[path] = (identity, digest.hexdigest())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _describe(builder):
+        """Return a JSON-serialisable description of every attribute of `builder` which affects execution, except
+        the environment, working directory, and stdin bytes."""
+        if not isinstance(builder.stdin, (str, bytes)) and builder.stdin not in (ChildProcessIO.PIPE,
+                                                                                  ChildProcessIO.NULL):
+            raise ValueError("Only commands whose stdin is a pipe, /dev/null, a string or bytes can be cached")
+        for output in (builder.stdout, builder.stderr):
+            if not isinstance(output, ChildProcessIO):
+                raise ValueError("Only commands whose output is a ChildProcessIO value can be cached")
+        cgroup = builder.cgroup
+        return [list(builder.args), str(builder.stdout), str(builder.stderr), str(builder.engine), builder.pipe_size,
+                sorted(builder.rlimits.items()), sorted(builder.cpu_affinity or ()), builder.nice,
+                builder.ionice and [str(builder.ionice[0]), builder.ionice[1]],
+                cgroup and [cgroup.path, cgroup.cpu_max, cgroup.memory_max]]
+
+    def key(self, builder, input=None, input_files=(), env_keys=None):
+        """Return the cache key of running `builder` with `input`, as a hexadecimal digest.
+
+        Parameters are as for `run`."""
+        if isinstance(input, str):
+            input = input.encode()
+        elif input is not None and not isinstance(input, (bytes, bytearray, memoryview)):
+            raise TypeError("Cached commands only accept string or bytes-like input")
+        env = builder.env
+        if env_keys is not None:
+            env = {name: env[name] for name in env_keys if name in env}
+        cwd = builder.cwd or os.getcwd()
+        files = [(path, self._file_digest(os.path.join(cwd, path))) for path in input_files]
+        description = json.dumps([self._describe(builder), sorted(env.items()), cwd, files]).encode()
+
+        digest = hashlib.sha256(description)
+        # Input given to the builder is written before `input`, and each is length-prefixed to keep them apart
+        stdin = builder.stdin.encode() if isinstance(builder.stdin, str) else builder.stdin
+        for data in (stdin, input):
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                digest.update(struct.pack(">q", len(data)))
+                digest.update(data)
+            else:
+                digest.update(struct.pack(">q", -1))
+        return digest.hexdigest()
+
+    def run(self, builder, input=None, timeout=None, input_files=(), env_keys=None):
+        """Return the result of running `builder` as ChildProcessBuilder.run() would, from the cache if possible.
+
+        Parameters
+        ----------
+        builder: ChildProcessBuilder
+            The command to run.
+        input: optional
+            Input for the process, as a string or bytes-like object.
+        timeout: int, optional
+            Amount of time in seconds to wait for the process to finish, if it is run.
+        input_files: list of str, optional
+            Paths, relative to the builder's working directory, of files which the output of the command depends on.
+        env_keys: list of str, optional
+            The names of the environment variables which the output of the command depends on. Defaults to the whole
+            environment.
+
+        Returns
+        -------
+        CompletedChildProcess
+            The exit code and captured output of the process
+        """
+        key = self.key(builder, input, input_files, env_keys)
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return CompletedChildProcess(builder.args, *result)
+        result = self._load(key)
+        if result is not None:
+            with self._lock:
+                self._stats["disk_hits"] += 1
+                self._remember(key, result)
+            return CompletedChildProcess(builder.args, *result)
+
+        with self._lock:
+            self._stats["misses"] += 1
+        completed = builder.run(input, timeout)
+        if completed.exit_code == 0 or self._cache_failures:
+            result = (completed.exit_code, completed.stdout, completed.stderr)
+            with self._lock:
+                self._remember(key, result)
+            self._store(key, result)
+        return completed
+
+    @staticmethod
+    def _size(result):
+        return len(result[1] or b"") + len(result[2] or b"")
+
+    def _remember(self, key, result):
+        """Add a result to the memory tier, evicting the least recently used. Requires the lock."""
+        size = self._size(result)
+        if size > self._max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= self._size(self._memory.pop(key))
+        self._memory[key] = result
+        self._memory_bytes += size
+        while self._memory_bytes > self._max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= self._size(evicted)
+            self._stats["evictions"] += 1
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + ".result")
+
+    def _load(self, key):
+        if self._directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                exit_code, stdout_length, stderr_length = _CACHE_RECORD.unpack(file.read(_CACHE_RECORD.size))
+                stdout = file.read(stdout_length) if stdout_length >= 0 else None
+                stderr = file.read(stderr_length) if stderr_length >= 0 else None
+            # The modification time orders the on-disk tier for eviction
+            os.utime(path)
+        except (OSError, struct.error):
+            return None
+        return exit_code, stdout, stderr
+
+    def _store(self, key, result):
+        if self._directory is None:
+            return
+        exit_code, stdout, stderr = result
+        header = _CACHE_RECORD.pack(exit_code, -1 if stdout is None else len(stdout),
+                                    -1 if stderr is None else len(stderr))
+        path = self._path(key)
+        temporary = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(temporary, "wb") as file:
+            file.write(header)
+            file.write(stdout or b"")
+            file.write(stderr or b"")
+        try:
+            replaced = os.stat(path).st_size
+        except OSError:
+            replaced = 0
+        os.replace(temporary, path)
+        with self._lock:
+            self._disk_bytes += len(header) + self._size(result) - replaced
+            full = self._disk_bytes > self._max_disk_bytes
+        if full:
+            self._evict_disk()
+
+    def _disk_entries(self):
+        """Return the (mtime, size, path) of every result of the on-disk tier."""
+        entries = []
+        with os.scandir(self._directory) as directory:
+            for entry in directory:
+                if entry.name.endswith(".result"):
+                    try:
+                        status = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((status.st_mtime_ns, status.st_size, entry.path))
+        return entries
+
+    def _evict_disk(self):
+        """Remove the least recently used results of the on-disk tier until it fits its maximum size.
+
+        The running size of the tier only triggers this, since other processes sharing the directory also change
+        it, so the directory is scanned for the true size and order."""
+        entries = sorted(self._disk_entries())
+        total = sum(size for _, size, _ in entries)
+        evictions = 0
+        for _, size, path in entries:
+            if total <= self._max_disk_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            evictions += 1
+        with self._lock:
+            self._disk_bytes = total
+            self._stats["evictions"] += evictions
+
+    def stats(self):
+        """Return a dictionary of the cache's `memory_hits`, `disk_hits`, `misses`, `evictions`, and `hit_rate`."""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """Remove all results from both tiers."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if self._directory is not None:
+            with os.scandir(self._directory) as directory:
+                for entry in directory:
+                    if entry.name.endswith(".result"):
+                        os.unlink(entry.path)
+            with self._lock:
+                self._disk_bytes = 0
+
+
+class LoadGovernor():
+    """Suspends registered low-priority child processes while the system is under pressure, and resumes them once
+    the pressure has eased.
+
+    The pressure is the share of time in which tasks were stalled on the CPU, from Linux pressure stall
+    information, falling back to the one-minute load average per CPU (as a percentage) where that is unavailable,
+    or the value of any callable supplied instead. Each evaluation suspends one more process (lowest priority first)
+    while the pressure is at or above `high`, and resumes one (highest priority first) once it is at or below `low`.
+
+    Processes are suspended with SIGTSTP. If the kernel does not report a process as stopped by the next
+    evaluation, because it catches or ignores SIGTSTP, it is stopped with SIGSTOP instead.
+
+    Evaluations happen every `interval` seconds on a background thread once start() is called, or whenever tick()
+    is called. May be used with Python's `with` statement - the governor is started, and upon the exit of the
+    block, it is closed."""
+    def __init__(self, high=40.0, low=10.0, interval=1.0, pressure=None, resource="cpu"):
+        """
+        Parameters
+        ----------
+        high: float, optional
+            The pressure at or above which processes are suspended.
+        low: float, optional
+            The pressure at or below which processes are resumed. Must not exceed `high`.
+        interval: float, optional
+            The number of seconds between evaluations on the background thread.
+        pressure: callable, optional
+            A function returning the current pressure, replacing the system measurement.
+        resource: str, optional
+            The resource whose pressure stall information is measured - "cpu", "memory", or "io"."""
+        if low > high:
+            raise ValueError("The low threshold must not exceed the high threshold")
+        self._high = high
+        self._low = low
+        self._interval = interval
+        self._pressure = pressure
+        self._resource = resource
+        self._lock = threading.Lock()
+        self._priorities = {}
+        self._order = 0
+        self._suspended = []
+        self._unverified = []
+        self._stats = {"suspensions": 0, "resumptions": 0, "escalations": 0}
+        # The suspended time of the processes which are no longer governed
+        self._retired_time = 0.0
+        self._closed = threading.Event()
+        self._thread = None
+
+    def pressure(self):
+        """Return the current pressure, as used by the governor."""
+        if self._pressure is not None:
+            return self._pressure()
+        value = read_pressure(self._resource)
+        if value is None:
+            value = os.getloadavg()[0] / (os.cpu_count() or 1) * 100
+        return value
+
+    def register(self, process, priority=0):
+        """Allow the governor to suspend a process. Processes with lower priorities are suspended first, and those
+        registered earlier before those registered later with the same priority."""
+        with self._lock:
+            self._priorities[process] = (priority, self._order)
+            self._order += 1
+
+    def unregister(self, process):
+        """Stop governing a process, resuming it if the governor suspended it."""
+        with self._lock:
+            if self._priorities.pop(process, None) is None:
+                return
+            if process in self._suspended:
+                self._resume(process)
+            self._retired_time += process.suspended_time
+
+    @property
+    def suspended(self):
+        """The processes currently suspended by the governor, in the order in which they were suspended.
+        Read-only."""
+        with self._lock:
+            return list(self._suspended)
+
+    def stats(self):
+        """Return a dictionary of the number of `suspensions`, `resumptions`, and `escalations` to SIGSTOP, and the
+        total `suspended_time` in seconds of every process governed, including those which have since been
+        unregistered or have finished."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["suspended_time"] = self._retired_time + sum(process.suspended_time
+                                                               for process in self._priorities)
+        return stats
+
+    def tick(self):
+        """Evaluate the pressure once, suspending or resuming a process as needed, and return the pressure."""
+        pressure = self.pressure()
+        with self._lock:
+            for process in [process for process in self._priorities if process.is_finished()]:
+                del self._priorities[process]
+                if process in self._suspended:
+                    self._suspended.remove(process)
+                self._retired_time += process.suspended_time
+
+            for process in self._unverified:
+                if process in self._suspended and not process.is_stopped(verify=True):
+                    process.stop(force=True)
+                    self._stats["escalations"] += 1
+            self._unverified = []
+
+            if pressure >= self._high:
+                candidates = sorted((rank, process) for process, rank in self._priorities.items()
+                                    if process not in self._suspended)
+                if candidates:
+                    process = candidates[0][1]
+                    process.stop()
+                    self._suspended.append(process)
+                    self._unverified.append(process)
+                    self._stats["suspensions"] += 1
+            elif pressure <= self._low and self._suspended:
+                self._resume(max(self._suspended, key=self._priorities.get))
+        return pressure
+
+    def _resume(self, process):
+        """Resume a suspended process. Requires the lock."""
+        self._suspended.remove(process)
+        if not process.is_finished():
+            process.start()
+        self._stats["resumptions"] += 1
+
+    def _run(self):
+        while not self._closed.wait(self._interval):
+            try:
+                self.tick()
+            except Exception:
+                traceback.print_exc()
+
+    def start(self):
+        """Start evaluating the pressure on a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="childprocess-governor", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stop evaluating the pressure, and resume every process suspended by the governor."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            for process in list(self._suspended):
+                self._resume(process)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+_REMOTE_STDIN = 0
+_REMOTE_STDOUT = 1
+_REMOTE_STDERR = 2
+_REMOTE_CONTROL = 3
+
+def _send_frame(sock, lock, channel, payload=b""):
+    """Send a frame of the agent protocol: a FrameFormat.LENGTH_PREFIXED frame whose ID is the channel."""
+    with lock:
+        sock.sendall(_FRAME_HEADER.pack(len(payload), channel))
+        if payload:
+            sock.sendall(payload)
+
+def _send_control(sock, lock, message):
+    _send_frame(sock, lock, _REMOTE_CONTROL, json.dumps(message).encode())
+
+def _authenticate(sock, stream, lock, secret):
+    """Answer the agent's challenge: an HMAC-SHA256 of its nonce, keyed by the shared secret. Raises
+    PermissionError if the agent rejects the answer, before any request is sent."""
+    channel, payload = _receive_frame(stream)
+    challenge = json.loads(payload) if channel == _REMOTE_CONTROL else {}
+    if challenge.get("type") != "challenge":
+        raise ConnectionError("The agent closed the connection")
+    digest = hmac.new(_agent_key(secret), bytes.fromhex(challenge["nonce"]), hashlib.sha256).hexdigest()
+    _send_control(sock, lock, {"type": "auth", "digest": digest})
+    channel, payload = _receive_frame(stream)
+    result = json.loads(payload) if channel == _REMOTE_CONTROL else {}
+    if result.get("type") == "error":
+        raise PermissionError(result.get("errno") or errno.EACCES, result.get("message", "Authentication failed"))
+    if result.get("type") != "authenticated":
+        raise ConnectionError("The agent closed the connection")
+
+def _agent_key(secret):
+    if secret is None:
+        return b""
+    if isinstance(secret, str):
+        return secret.encode()
+    if isinstance(secret, bytes):
+        return secret
+    raise TypeError("The agent's secret must be a string or bytes")
+
+def _receive_frame(stream):
+    """Return the channel and payload of the next frame from a buffered socket stream, or (None, None) at its end."""
+    header = stream.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+        return None, None
+    length, channel = _FRAME_HEADER.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None, None
+    return channel, payload
+
+class _AgentHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.agent._serve(self.request)
+
+class _AgentServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Agent():
+    """A server which creates child processes on behalf of remote clients, such as an AgentScheduler.
+
+    Each connection carries one process: the client sends a spawn request, then the process's input, while the
+    agent sends back its output and finally its exit code and resource usage. Everything is multiplexed over the
+    connection as length-prefixed frames (see FrameFormat.LENGTH_PREFIXED) whose ID is the channel - 0 for stdin,
+    1 for stdout, 2 for stderr, and 3 for JSON control messages. An empty frame ends a stream. Clients may also ask
+    for the agent's status: its number of slots, and of processes running.
+
+    Agents run whatever their clients ask, so every connection starts with a challenge: the agent sends a random
+    nonce, and the client must answer with its HMAC-SHA256 keyed by the agent's secret. An agent without a secret
+    may only listen on a loopback address. The secret authenticates clients, but the connection is neither
+    encrypted nor protected against tampering, so agents on other hosts should be reached over a trusted network.
+
+    May be run with `python childprocess.py agent`, or within a Python process with start() - the agent runs on a
+    background thread until close() is called. May be used with Python's `with` statement, which starts the agent
+    and closes it upon the exit of the block."""
+    def __init__(self, host="127.0.0.1", port=0, slots=None, secret=None):
+        """
+        Parameters
+        ----------
+        host: str, optional
+            The address to listen on.
+        port: int, optional
+            The port to listen on, or 0 for any free port.
+        slots: int, optional
+            The number of processes the agent is meant to run at once, as reported to schedulers. Defaults to the
+            number of CPUs.
+        secret: str or bytes, optional
+            The secret shared with clients. Required unless the agent listens on a loopback address."""
+        self._slots = slots or os.cpu_count() or 1
+        self._running = 0
+        self._lock = threading.Lock()
+        self._key = _agent_key(secret)
+        self._server = _AgentServer((host, port), _AgentHandler)
+        self._server.agent = self
+        if not self._key and not ipaddress.ip_address(self._server.server_address[0]).is_loopback:
+            self._server.server_close()
+            raise ValueError("An agent which listens on a non-loopback address requires a secret")
+        self._thread = None
+
+    @property
+    def address(self):
+        """The (host, port) on which the agent listens. Read-only."""
+        return self._server.server_address[:2]
+
+    @property
+    def running(self):
+        """The number of processes currently running through the agent. Read-only."""
+        with self._lock:
+            return self._running
+
+    def serve_forever(self):
+        """Serve clients until close() is called."""
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve clients on a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, name="childprocess-agent", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop accepting clients. Processes which are already running continue."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _serve(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = sock.makefile("rb")
+        lock = threading.Lock()
+        nonce = os.urandom(32)
+        _send_control(sock, lock, {"type": "challenge", "nonce": nonce.hex()})
+        channel, payload = _receive_frame(stream)
+        answer = json.loads(payload) if channel == _REMOTE_CONTROL else {}
+        expected = hmac.new(self._key, nonce, hashlib.sha256).hexdigest()
+        if answer.get("type") != "auth" or not hmac.compare_digest(str(answer.get("digest")), expected):
+            _send_control(sock, lock, {"type": "error", "message": "Authentication failed", "errno": errno.EACCES})
+            return
+        _send_control(sock, lock, {"type": "authenticated"})
+        channel, payload = _receive_frame(stream)
+        if channel != _REMOTE_CONTROL:
+            return
+        request = json.loads(payload)
+        if request.get("type") == "status":
+            _send_control(sock, lock, {"type": "status", "slots": self._slots, "running": self.running})
+            return
+
+        try:
+            # The client only sends the variables it changed, which apply over the agent's own environment
+            env = dict(os.environ)
+            env.update(request.get("env") or {})
+            for name in request.get("unset") or ():
+                env.pop(name, None)
+            stderr = ChildProcessIO.STDOUT if request.get("stderr") == "stdout" else ChildProcessIO.PIPE
+            process = ChildProcessBuilder(request["args"], env=env, cwd=request.get("cwd"),
+                                          stdin=ChildProcessIO.PIPE, stdout=ChildProcessIO.PIPE,
+                                          stderr=stderr).spawn()
+        except (OSError, ValueError, TypeError, KeyError) as error:
+            _send_control(sock, lock, {"type": "error", "message": getattr(error, "strerror", None) or str(error),
+                                       "errno": getattr(error, "errno", None)})
+            return
+
+        with self._lock:
+            self._running += 1
+        try:
+            _send_control(sock, lock, {"type": "spawned", "pid": process.pid})
+            threading.Thread(target=self._receive_input, args=(stream, process), daemon=True).start()
+            channels = {"stdout": _REMOTE_STDOUT, "stderr": _REMOTE_STDERR}
+            with ProcessGroup() as group:
+                group.add(process)
+                for event in group:
+                    if event.type == ProcessEventType.CHUNK:
+                        _send_frame(sock, lock, channels[event.stream], event.data)
+                    elif event.type == ProcessEventType.EOF:
+                        _send_frame(sock, lock, channels[event.stream])
+                    elif event.type == ProcessEventType.EXITED:
+                        rusage = process.rusage
+                        usage = {"utime": rusage.ru_utime, "stime": rusage.ru_stime,
+                                 "maxrss": rusage.ru_maxrss * 1024} if rusage else None
+                        _send_control(sock, lock, {"type": "exit", "exit_code": event.data, "rusage": usage})
+        except OSError:
+            # The client has gone away, so nobody is left to collect the process
+            if not process.is_finished():
+                process.terminate(force=True)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    @staticmethod
+    def _receive_input(stream, process):
+        stdin = process.stdin
+        while True:
+            try:
+                channel, payload = _receive_frame(stream)
+            except OSError:
+                channel = None
+            if channel is None:
+                if not process.is_finished():
+                    process.terminate(force=True)
+                return
+            try:
+                if channel == _REMOTE_STDIN and payload:
+                    stdin.write(payload)
+                    stdin.flush()
+                elif channel == _REMOTE_STDIN:
+                    stdin.close()
+                elif channel == _REMOTE_CONTROL:
+                    message = json.loads(payload)
+                    if message.get("type") == "signal" and not process.is_finished():
+                        process.kill(message["signal"])
+            except (OSError, ValueError):
+                # The process no longer reads its input
+                pass
+
+class RemoteChildProcess():
+    """A child process created by an Agent, which may be on another host, offering the core of the ChildProcess
+    interface.
+
+    Should not be instantiated directly - instead, use ChildProcessBuilder.spawn_remote() or
+    AgentScheduler.spawn(). Piped streams are local pipes, fed to and from the agent by two background threads.
+
+    Only the environment variables which differ from this process's environment are sent, and the working
+    directory only if it differs from this process's - otherwise the agent's own apply. An agent which cannot be
+    reached raises ConnectionError, while an agent which fails to create the process raises the OSError it reported.
+
+    If the connection to the agent is lost before the process exits, its status queries raise ConnectionError."""
+    def __init__(self, address, args, env, cwd, stdin, stdout, stderr, secret=None):
+        for value in (stdout, stderr):
+            if isinstance(value, (TailCapture, SpillCapture)) or value in (ChildProcessIO.CAPTURE_TAIL,
+                                                                          ChildProcessIO.CAPTURE_SPILL):
+                raise ValueError("Output of remote processes cannot be captured")
+        if stdin == ChildProcessIO.INHERIT or isinstance(stdin, SharedInput):
+            raise ValueError("Remote processes cannot inherit or share input")
+
+        self._address = tuple(address)
+        self._args = list(args)
+        self._exit_code = None
+        self._rusage = None
+        self._error = None
+        self._exited = threading.Event()
+        self._exit_callbacks = []
+        self._callback_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        environ = os.environ
+        request = {"type": "spawn", "args": self._args,
+                   "env": {name: value for name, value in env.items() if environ.get(name) != value},
+                   "unset": [name for name in environ if name not in env],
+                   "cwd": None if cwd is None or cwd == os.getcwd() else os.fspath(cwd),
+                   "stderr": "stdout" if stderr == ChildProcessIO.STDOUT else None}
+        try:
+            self._socket = socket.create_connection(self._address)
+        except OSError as error:
+            raise ConnectionError("The agent at {}:{} cannot be reached: {}".format(*self._address, error)) from error
+        try:
+            try:
+                self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._stream = self._socket.makefile("rb")
+                _authenticate(self._socket, self._stream, self._send_lock, secret)
+                _send_control(self._socket, self._send_lock, request)
+                channel, payload = _receive_frame(self._stream)
+            except PermissionError:
+                raise
+            except OSError as error:
+                raise ConnectionError("The connection to the agent at {}:{} failed: {}".format(*self._address,
+                                                                                            error)) from error
+            reply = json.loads(payload) if channel == _REMOTE_CONTROL else {}
+            if reply.get("type") == "error":
+                raise OSError(reply["errno"], reply["message"]) if reply.get("errno") else OSError(reply["message"])
+            if reply.get("type") != "spawned":
+                raise ConnectionError("The agent at {}:{} closed the connection".format(*self._address))
+        except BaseException:
+            self._socket.close()
+            raise
+        self._pid = reply["pid"]
+
+        self._outputs = {}
+        self._stdout = self._make_output(_REMOTE_STDOUT, stdout, sys.stdout)
+        self._stderr = None if stderr == ChildProcessIO.STDOUT else self._make_output(_REMOTE_STDERR, stderr,
+                                                                                       sys.stderr)
+        self._stdin = None
+        if stdin == ChildProcessIO.PIPE:
+            read_fd, write_fd = os.pipe()
+            self._stdin = open(write_fd, "wb")
+            source = read_fd
+        elif stdin == ChildProcessIO.NULL:
+            source = b""
+        elif isinstance(stdin, io.IOBase):
+            source = os.dup(stdin.fileno())
+        else:
+            source = stdin.encode() if isinstance(stdin, str) else bytes(stdin)
+        threading.Thread(target=self._send_input, args=(source,), name="childprocess-remote-input",
+                         daemon=True).start()
+        threading.Thread(target=self._receive, name="childprocess-remote-output", daemon=True).start()
+
+    def _make_output(self, channel, value, inherited):
+        """Choose where the output of a channel goes, returning the readable local pipe for ChildProcessIO.PIPE."""
+        if value == ChildProcessIO.PIPE:
+            read_fd, write_fd = os.pipe()
+            self._outputs[channel] = (write_fd, True)
+            return open(read_fd, "rb")
+        if value == ChildProcessIO.INHERIT:
+            self._outputs[channel] = (inherited.fileno(), False)
+        elif isinstance(value, io.IOBase):
+            self._outputs[channel] = (value.fileno(), False)
+        else:
+            self._outputs[channel] = (None, False)
+        return None
+
+    def _send_input(self, source):
+        try:
+            if isinstance(source, bytes):
+                for offset in range(0, len(source), 65536):
+                    _send_frame(self._socket, self._send_lock, _REMOTE_STDIN, source[offset:offset + 65536])
+            else:
+                data = os.read(source, 65536)
+                while data:
+                    _send_frame(self._socket, self._send_lock, _REMOTE_STDIN, data)
+                    data = os.read(source, 65536)
+            _send_frame(self._socket, self._send_lock, _REMOTE_STDIN)
+        except OSError:
+            pass
+        finally:
+            if isinstance(source, int):
+                os.close(source)
+
+    def _close_output(self, channel):
+        fd, owned = self._outputs.pop(channel, (None, False))
+        if owned:
+            os.close(fd)
+
+    def _receive(self):
+        try:
+            while True:
+                channel, payload = _receive_frame(self._stream)
+                if channel is None:
+                    break
+                if channel == _REMOTE_CONTROL:
+                    message = json.loads(payload)
+                    if message.get("type") == "exit":
+                        self._rusage = message.get("rusage")
+                        self._exit_code = message["exit_code"]
+                        break
+                elif not payload:
+                    self._close_output(channel)
+                elif channel in self._outputs and self._outputs[channel][0] is not None:
+                    view = memoryview(payload)
+                    try:
+                        while view:
+                            view = view[os.write(self._outputs[channel][0], view):]
+                    except BrokenPipeError:
+                        # Nobody reads this output any longer
+                        self._close_output(channel)
+                        self._outputs[channel] = (None, False)
+        except (OSError, ValueError):
+            pass
+        finally:
+            for channel in list(self._outputs):
+                self._close_output(channel)
+            if self._exit_code is None:
+                self._error = ConnectionError("Lost the connection to the agent at {}:{}".format(*self._address))
+            self._socket.close()
+            with self._callback_lock:
+                self._exited.set()
+                callbacks, self._exit_callbacks = self._exit_callbacks, None
+            for callback in callbacks:
+                try:
+                    callback(self)
+                except Exception:
+                    traceback.print_exc()
+
+    @property
+    def address(self):
+        """The (host, port) of the agent running the process. Read-only."""
+        return self._address
+
+    @property
+    def pid(self):
+        """The process ID of the process on the agent's host. Read-only."""
+        return self._pid
+
+    @property
+    def args(self):
+        """The argument array provided upon the process's creation. Read-only."""
+        return self._args
+
+    @property
+    def stdin(self):
+        """The input stream for the process, if it was created by ChildProcessIO.PIPE.
+
+        Attempts to access an inaccessible stream result in a RuntimeError."""
+        if self._stdin is None:
+            raise RuntimeError("The process's stdin pipe is inaccessible")
+        return self._stdin
+
+    @property
+    def stdout(self):
+        """The output stream for the process, if it was created by ChildProcessIO.PIPE.
+
+        Attempts to access an inaccessible stream result in a RuntimeError."""
+        if self._stdout is None:
+            raise RuntimeError("The process's stdout pipe is inaccessible")
+        return self._stdout
+
+    @property
+    def stderr(self):
+        """The error output stream for the process, if it was created by ChildProcessIO.PIPE.
+
+        Attempts to access an inaccessible stream result in a RuntimeError."""
+        if self._stderr is None:
+            raise RuntimeError("The process's stderr pipe is inaccessible")
+        return self._stderr
+
+    @property
+    def exit_code(self):
+        """The exit code of the process, or None if it has not exited. Read-only."""
+        if self._exited.is_set() and self._error is not None:
+            raise self._error
+        return self._exit_code
+
+    @property
+    def rusage(self):
+        """The resource usage reported by the agent once the process has exited, as a dictionary of user and system
+        CPU time in seconds (`utime`, `stime`) and peak resident set size in bytes (`maxrss`), or None. Read-only."""
+        return self._rusage
+
+    def add_exit_callback(self, callback):
+        """Register `callback` to be called with this process as its argument once the process has exited, or the
+        connection to its agent has been lost.
+
+        Callbacks run on a background thread, and must not block. If the process has already exited, `callback` is
+        called immediately."""
+        with self._callback_lock:
+            if not self._exited.is_set():
+                self._exit_callbacks.append(callback)
+                return
+        callback(self)
+
+    def is_finished(self):
+        """Return true if the process has exited, and false otherwise"""
+        return self.exit_code is not None
+
+    def is_running(self):
+        """Return true if the process is executing, and false otherwise"""
+        return not self.is_finished()
+
+    def wait_for_finish(self, timeout=None):
+        """Block until the process finishes, or raise `subprocess.TimeoutExpired` after `timeout` seconds.
+
+        Returns the process."""
+        if not self._exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self._args, timeout)
+        self.exit_code
+        return self
+
+    def kill(self, signal):
+        """Send a signal to the process."""
+        try:
+            _send_control(self._socket, self._send_lock, {"type": "signal", "signal": int(signal)})
+        except OSError:
+            pass
+
+    def terminate(self, force=False):
+        """Request that the process terminate execution, immediately and unignorably if `force` is true."""
+        self.kill(signal.SIGKILL if force else signal.SIGTERM)
+
+    def communicate(self, input=None, timeout=None):
+        """Send input to the process, read its piped output until the end, and wait for it to exit.
+
+        Parameters
+        ----------
+        input: str or bytes, optional
+            Input for the process, if its stdin was created by ChildProcessIO.PIPE. Its stdin is closed afterwards.
+        timeout: int, optional
+            Amount of time in seconds to wait, after which `subprocess.TimeoutExpired` is raised.
+
+        Returns
+        -------
+        tuple
+            The output and error output of the process, each None if the stream is not piped
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        output = {}
+
+        def read(name, stream):
+            output[name] = stream.read()
+
+        threads = [threading.Thread(target=read, args=(name, stream), daemon=True)
+                   for name, stream in (("stdout", self._stdout), ("stderr", self._stderr)) if stream is not None]
+        if self._stdin is not None and not self._stdin.closed:
+            data = input.encode() if isinstance(input, str) else input
+
+            def write():
+                try:
+                    if data:
+                        self._stdin.write(data)
+                    self._stdin.close()
+                except BrokenPipeError:
+                    pass
+            threads.append(threading.Thread(target=write, daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                raise subprocess.TimeoutExpired(self._args, timeout)
+        self.wait_for_finish(None if deadline is None else max(0, deadline - time.monotonic()))
+        return output.get("stdout"), output.get("stderr")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for stream in (self._stdin, self._stdout, self._stderr):
+            if stream is not None:
+                stream.close()
+        self.wait_for_finish()
+
+class AgentScheduler():
+    """Places child processes on a set of Agents, choosing the agent with the most free capacity.
+
+    The capacity of each agent is its number of slots less the processes running through it, as last reported by
+    the agent, adjusted for the processes placed and finished since. Reports are refreshed at most every
+    `refresh_interval` seconds, and agents which cannot be reached are skipped until the next refresh."""
+    def __init__(self, addresses, refresh_interval=1.0, secret=None):
+        """
+        Parameters
+        ----------
+        addresses: list of tuple
+            The (host, port) of each agent.
+        refresh_interval: float, optional
+            The number of seconds for which reported capacities are trusted.
+        secret: str or bytes, optional
+            The secret shared with the agents."""
+        if not addresses:
+            raise ValueError("At least one agent must be supplied")
+        self._addresses = [tuple(address) for address in addresses]
+        self._refresh_interval = refresh_interval
+        self._secret = secret
+        self._lock = threading.Lock()
+        self._free = {}
+        self._refreshed_at = None
+
+    def _query(self, address, timeout=5.0):
+        """Return the status reported by the agent at `address`, or None if it cannot be reached."""
+        lock = threading.Lock()
+        try:
+            with socket.create_connection(address, timeout) as sock, sock.makefile("rb") as stream:
+                _authenticate(sock, stream, lock, self._secret)
+                _send_control(sock, lock, {"type": "status"})
+                channel, payload = _receive_frame(stream)
+        except OSError:
+            return None
+        reply = json.loads(payload) if channel == _REMOTE_CONTROL else {}
+        return reply if reply.get("type") == "status" else None
+
+    def status(self):
+        """Return a dictionary of the status reported by each agent - its `slots` and the processes `running` - or
+        None for agents which cannot be reached."""
+        return {address: self._query(address) for address in self._addresses}
+
+    def _refresh(self):
+        """Query every agent for its free capacity, without holding the lock while the agents are queried."""
+        with self._lock:
+            addresses = list(self._addresses)
+        free = {}
+        for address in addresses:
+            status = self._query(address)
+            if status is not None:
+                free[address] = status["slots"] - status["running"]
+        with self._lock:
+            self._free = free
+            self._refreshed_at = time.monotonic()
+
+    def choose(self):
+        """Return the address of the agent with the most free capacity, counting a process as placed on it."""
+        with self._lock:
+            stale = self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self._refresh_interval
+        if stale:
+            self._refresh()
+        with self._lock:
+            if not self._free:
+                raise ConnectionError("None of the agents can be reached")
+            # Ties go to the agent listed first
+            address = max(self._free, key=lambda address: (self._free[address], -self._addresses.index(address)))
+            self._free[address] -= 1
+            return address
+
+    def _release(self, address):
+        with self._lock:
+            if address in self._free:
+                self._free[address] += 1
+
+    def _finished(self, process):
+        self._release(process.address)
+
+    def spawn(self, builder):
+        """Create a child process from the attributes of a ChildProcessBuilder on the agent with the most free
+        capacity.
+
+        Returns
+        -------
+        RemoteChildProcess
+            The spawned RemoteChildProcess
+        """
+        address = self.choose()
+        try:
+            process = RemoteChildProcess(address, builder.args, builder.env, builder.cwd, builder.stdin,
+                                         builder.stdout, builder.stderr, self._secret)
+        except ConnectionError:
+            # Skip the agent until the next refresh
+            with self._lock:
+                self._free.pop(address, None)
+            raise
+        except BaseException:
+            # The agent is healthy, it merely failed to create this process
+            self._release(address)
+            raise
+        process.add_exit_callback(self._finished)
+        return process
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="childprocess")
+    commands = parser.add_subparsers(dest="command", required=True)
+    agent_parser = commands.add_parser("agent", help="run an agent which creates child processes for remote clients")
+    agent_parser.add_argument("--host", default="127.0.0.1", help="the address to listen on (default: 127.0.0.1)")
+    agent_parser.add_argument("--port", type=int, default=0, help="the port to listen on (default: any free port)")
+    agent_parser.add_argument("--slots", type=int, help="the number of processes to advertise (default: CPU count)")
+    agent_parser.add_argument("--secret", default=os.environ.get("CHILDPROCESS_AGENT_SECRET"),
+                              help="the secret shared with clients, required unless listening on a loopback "
+                                   "address (default: $CHILDPROCESS_AGENT_SECRET)")
+    arguments = parser.parse_args(argv)
+
+    try:
+        agent = Agent(arguments.host, arguments.port, arguments.slots, arguments.secret)
+    except ValueError as error:
+        parser.error(str(error))
+    print("listening on {}:{}".format(*agent.address), flush=True)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
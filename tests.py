@@ -2,9 +2,47 @@
 assorted unit tests for childprocess
 """
 
+import asyncio
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from childprocess import ChildProcessBuilder as CPB
 from childprocess import PipelineBuilder as PB
+from childprocess import ChildProcessIO
+from childprocess import ChildProcess
+from childprocess import ChildProcessPool
+from childprocess import Agent
+from childprocess import AgentScheduler
+from childprocess import RemoteChildProcess
+from childprocess import CommandCache
+from childprocess import FrameFormat
+from childprocess import FramedChannel
+from childprocess import IOPriorityClass
+from childprocess import LoadGovernor
+from childprocess import SharedInput
+from childprocess import SpawnEngine
+from childprocess import SpillCapture
+from childprocess import StandbyCache
+from childprocess import Table
+from childprocess import TransformStage
+from childprocess import TailCapture
+from childprocess import MetricsRegistry
+from childprocess import ProcessEventType
+from childprocess import PipelineGraph
+from childprocess import ProcessGroup
+from childprocess import metrics
+from childprocess import wait_for_any
 
 class TestChildprocess(unittest.TestCase):
 
@@ -56,6 +94,729 @@ class TestChildprocess(unittest.TestCase):
         self.assertFalse(sleeper.is_running())
         self.assertFalse(sleeper.is_stopped())
 
+    def test_pool_map(self):
+        squarer = CPB(["sh", "-c", "while read x; do echo $((x * x)); done"])
+        with ChildProcessPool(squarer, size=3, max_in_flight=2) as pool:
+            self.assertEqual([b'1', b'4', b'9', b'16', b'25'], pool.map(["1", "2", "3", "4", "5"]))
+            results = dict(pool.imap_unordered([b'6', b'7']))
+            self.assertEqual({b'6': b'36', b'7': b'49'}, results)
+
+            unordered = pool.imap_unordered(str(x) for x in range(100))
+            next(unordered)
+            unordered.close()
+            self.assertEqual([b'64', b'81'], pool.map(["8", "9"]))
+
+    def test_pool_respawn(self):
+        one_shot = CPB(["sh", "-c", "read x; echo $x"])
+        with ChildProcessPool(one_shot, size=2) as pool:
+            self.assertEqual([b'a', b'b', b'c', b'd'], pool.map(["a", "b", "c", "d"]))
+            self.assertGreaterEqual(pool.respawn_count, 2)
+
+    def test_async_spawn(self):
+        async def run():
+            cp = await CPB("echo foo").spawn_async()
+            self.assertEqual(b'foo\n', await cp.stdout.readline())
+            await cp.wait_for_finish(timeout=5)
+            self.assertTrue(cp.is_finished())
+            self.assertEqual(0, cp.exit_code)
+
+            sleeper = await CPB("sleep 10").spawn_async()
+            with self.assertRaises(subprocess.TimeoutExpired):
+                await sleeper.wait_for_finish(timeout=0.1)
+            sleeper.terminate()
+            await sleeper.wait_for_finish(timeout=5)
+            self.assertTrue(sleeper.is_finished())
+        asyncio.run(run())
+
+    def test_async_pipeline(self):
+        async def run():
+            procs = await PB("tr a-z A-Z | wc -c").spawn_all_async()
+            procs[0].stdin.write(b'abc')
+            procs[0].stdin.close()
+            self.assertEqual(b'3', (await procs[-1].stdout.read()).strip())
+            with self.assertRaises(RuntimeError):
+                procs[0].stdout
+            for proc in procs:
+                await proc.wait_for_finish(timeout=5)
+        asyncio.run(run())
+
+    def test_exit_callback(self):
+        exited = threading.Event()
+        cp = CPB("sh -c 'exit 3'").spawn()
+        cp.add_exit_callback(lambda proc: exited.set())
+        self.assertTrue(exited.wait(timeout=5))
+        self.assertEqual(3, cp.exit_code)
+        self.assertIsNotNone(cp.exit_time)
+
+    def test_wait_for_any(self):
+        slow = CPB("sleep 10").spawn()
+        fast = CPB("sleep 0.1").spawn()
+        self.assertEqual([], wait_for_any([slow, fast], timeout=0.01))
+        self.assertEqual([fast], wait_for_any([slow, fast], timeout=5))
+        slow.terminate()
+        slow.wait_for_finish(timeout=5)
+
+    def test_spawn_engine(self):
+        cp = CPB("echo foo").spawn()
+        self.assertEqual(SpawnEngine.POSIX_SPAWN, cp.spawn_engine)
+        self.assertEqual(b'foo', cp.wait_for_finish().stdout.readline().strip())
+        self.assertEqual(0, cp.exit_code)
+
+        cp = CPB("ls", cwd="./examples").spawn()
+        self.assertEqual(SpawnEngine.POPEN, cp.spawn_engine)
+
+        cp = CPB("sh -c 'echo bar >&2'", stderr=ChildProcessIO.STDOUT, engine=SpawnEngine.POSIX_SPAWN).spawn()
+        self.assertEqual(b'bar', cp.stdout.readline().strip())
+        with self.assertRaises(ValueError):
+            CPB("ls", cwd="./examples", engine=SpawnEngine.POSIX_SPAWN).spawn()
+        with self.assertRaises(FileNotFoundError):
+            CPB("no-such-command", engine=SpawnEngine.POSIX_SPAWN).spawn()
+
+        # Signals ignored by Python, such as SIGPIPE, are restored to their defaults in the child
+        for engine in (SpawnEngine.POSIX_SPAWN, SpawnEngine.POPEN):
+            cp = CPB(["grep", "SigIgn", "/proc/self/status"], engine=engine).spawn()
+            self.assertEqual(0, int(cp.stdout.read().split()[1], 16) & (1 << signal.SIGPIPE - 1))
+
+    def test_communicate(self):
+        data = b'x' * (1 << 20) + b'\n'
+        cp = CPB("cat", stdin=data).spawn()
+        self.assertEqual((data, b''), cp.communicate(timeout=10))
+        self.assertEqual(0, cp.exit_code)
+
+        cp = CPB("tr a-z A-Z").spawn()
+        self.assertEqual(b'FOOBAR', cp.communicate(input=iter([b'foo', 'bar']))[0])
+
+        cp = CPB("sh -c 'sleep 0.2; echo late'").spawn()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            cp.communicate(timeout=0.01)
+        self.assertEqual(b'late\n', cp.stdout.read())
+
+    def test_run(self):
+        result = CPB("sh -c 'cat; echo err >&2; exit 2'").run(input=b'abc')
+        self.assertEqual(2, result.exit_code)
+        self.assertEqual(b'abc', result.stdout)
+        self.assertEqual(b'err\n', result.stderr)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            CPB("sleep 10").run(timeout=0.1)
+
+    def test_capture_tail(self):
+        # Far more output than fits in a pipe buffer, none of which is read by the parent
+        cp = CPB("seq 100000", stderr=ChildProcessIO.CAPTURE_TAIL,
+                 stdout=TailCapture(max_bytes=1024, max_lines=3)).spawn()
+        cp.wait_for_finish(timeout=10)
+        self.assertEqual(b'99998\n99999\n100000\n', cp.stdout_tail)
+        self.assertEqual(b'', cp.stderr_tail)
+        with self.assertRaises(RuntimeError):
+            cp.stdout
+
+        cp = CPB("seq 100000", stdout=TailCapture(max_bytes=10)).spawn()
+        cp.wait_for_finish(timeout=10)
+        self.assertEqual(b'99\n100000\n', cp.stdout_tail)
+
+    def test_transfer(self):
+        with tempfile.TemporaryFile() as source, tempfile.TemporaryFile() as destination:
+            data = b'foo bar\n' * 100000
+            source.write(data)
+            source.seek(0)
+            cp = CPB("cat", pipe_size=1 << 20).spawn()
+            self.assertEqual((len(data), len(data)), cp.transfer(source, destination, timeout=10))
+            destination.seek(0)
+            self.assertEqual(data, destination.read())
+
+            source.seek(0)
+            destination.seek(0)
+            destination.truncate()
+            procs, written, read = PB("tr a-z A-Z | wc -c", pipe_size=1 << 16).transfer(source, destination, timeout=10)
+            self.assertEqual(len(data), written)
+            destination.seek(0)
+            self.assertEqual(str(len(data)).encode(), destination.read().strip())
+            self.assertTrue(all(proc.is_finished() for proc in procs))
+
+    def test_iter_lines(self):
+        cp = CPB("seq 100000").spawn()
+        lines = [int(line) for line in cp.iter_lines(copy=False)]
+        self.assertEqual(list(range(1, 100001)), lines)
+
+        cp = CPB(["printf", "a,bb,%s", "c" * 100000]).spawn()
+        records = list(cp.iter_records(b',', encoding="ascii", block_size=16))
+        self.assertEqual(['a', 'bb', 'c' * 100000], records)
+
+    def test_iter_chunks(self):
+        cp = CPB(["printf", r"h\xc3\xa9llo"]).spawn()
+        self.assertEqual('héllo', ''.join(cp.iter_chunks(size=2, encoding="utf-8")))
+
+        buffer = bytearray(16)
+        cp = CPB("echo foo").spawn()
+        self.assertEqual(4, cp.readinto(buffer))
+        self.assertEqual(b'foo\n', buffer[:4])
+        self.assertEqual(0, cp.readinto(buffer))
+
+    def test_template(self):
+        template = CPB("echo {greeting}, {name}! {literal}", env={"PATH": os.environ["PATH"]}).freeze("greeting", "name")
+        self.assertTrue(template.executable.endswith("echo"))
+        cp = template.spawn(greeting="hello", name=42)
+        self.assertEqual(b'hello, 42! {literal}', cp.stdout.readline().strip())
+        cp = template.spawn(greeting="{name}", name="{greeting}")
+        self.assertEqual(b'{name}, {greeting}! {literal}', cp.stdout.readline().strip())
+        with self.assertRaises(TypeError):
+            template.spawn(greeting="hello")
+        with self.assertRaises(TypeError):
+            template.env["FOO"] = "bar"
+
+        cat = CPB("cat").freeze()
+        self.assertEqual(b'foo', cat.spawn(stdin="foo").communicate()[0])
+
+    def test_pipeline_status(self):
+        procs = PB("sh -c 'echo foo; exit 3' | cat | wc -c").spawn_all()
+        self.assertEqual(b'4', procs[-1].stdout.readline().strip())
+        procs.wait_for_finish(timeout=5)
+        self.assertEqual([3, 0, 0], procs.exit_codes)
+        self.assertEqual(3, procs.exit_code)
+        self.assertEqual([0], procs.failed_stages)
+
+        stats = procs.stage_stats()
+        self.assertEqual(3, len(stats))
+        self.assertEqual(4, stats[1].bytes_written)
+        self.assertTrue(all(stage.cpu_time is not None and stage.wall_time >= 0 for stage in stats))
+
+        sleepers = PB("sleep 10 | sleep 0").spawn_all()
+        with self.assertRaises(subprocess.TimeoutExpired):
+            sleepers.wait_for_finish(timeout=0.1)
+        sleepers[0].terminate()
+        self.assertEqual(-15, sleepers.wait_for_finish(timeout=5).exit_code)
+
+    def test_rusage(self):
+        spawned = metrics.counter("childprocess_spawns_total").value
+        cp = CPB(["sh", "-c", "i=0; while [ $i -lt 20000 ]; do i=$((i + 1)); done"]).spawn().wait_for_finish(timeout=10)
+        self.assertGreater(cp.rusage.ru_utime + cp.rusage.ru_stime, 0)
+        self.assertGreater(cp.rusage.ru_maxrss, 0)
+        self.assertGreaterEqual(cp.lifetime, 0)
+        self.assertLessEqual(cp.spawn_time, cp.exit_time)
+        self.assertEqual(spawned + 1, metrics.counter("childprocess_spawns_total").value)
+        self.assertIn("childprocess_lifetime_seconds_count", metrics.to_prometheus())
+
+        procs = PB("echo foo | cat").spawn_all().wait_for_finish(timeout=5)
+        totals = procs.total_stats()
+        self.assertGreater(totals["max_rss"], 0)
+        self.assertGreaterEqual(totals["wall_time"], max(stage.wall_time for stage in procs.stage_stats()))
+
+    def test_metrics_registry(self):
+        registry = MetricsRegistry()
+        registry.counter("runs").inc(2)
+        histogram = registry.histogram("sizes", buckets=[1, 10])
+        for value in (0.5, 5, 50):
+            histogram.observe(value)
+        snapshot = registry.snapshot()
+        self.assertEqual(2, snapshot["runs"])
+        self.assertEqual([(1, 1), (10, 2), (float("inf"), 3)], snapshot["sizes"]["buckets"])
+        self.assertIn('sizes_bucket{le="+Inf"} 3', registry.to_prometheus())
+        with self.assertRaises(TypeError):
+            registry.counter("sizes")
+
+    def test_resource_controls(self):
+        builder = CPB(["sh", "-c", "ulimit -n; nice; ionice; grep Cpus_allowed_list /proc/self/status"])
+        builder.rlimits = {resource.RLIMIT_NOFILE: 64}
+        builder.nice = 5
+        builder.ionice = IOPriorityClass.IDLE
+        builder.cpu_affinity = [0]
+        for engine in (SpawnEngine.AUTO, SpawnEngine.POPEN):
+            builder.engine = engine
+            cp = builder.spawn()
+            self.assertEqual(SpawnEngine.POPEN, cp.spawn_engine)
+            output = cp.communicate(timeout=5)[0].split(b'\n')
+            self.assertEqual(b'64', output[0])
+            self.assertEqual(os.nice(0) + 5, int(output[1]))
+            self.assertEqual(b'idle', output[2])
+            self.assertTrue(output[3].endswith(b'\t0'))
+        builder.engine = SpawnEngine.POSIX_SPAWN
+        with self.assertRaises(ValueError):
+            builder.spawn()
+
+    def test_pipeline_stage_controls(self):
+        limited = CPB(["sh", "-c", "cat >/dev/null; ulimit -n"])
+        limited.rlimits = {resource.RLIMIT_NOFILE: 32}
+        procs = PB(["echo foo", limited, "cat"]).spawn_all()
+        self.assertEqual(b'32', procs[-1].stdout.readline().strip())
+
+    def wait_for_standby(self, cache, builder, count):
+        deadline = time.monotonic() + 5
+        while cache.ready_count(builder) != count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(count, cache.ready_count(builder))
+
+    def test_standby_cache(self):
+        with StandbyCache(size=2) as cache:
+            cat = CPB("cat")
+            first = cache.acquire(cat)
+            self.wait_for_standby(cache, CPB("cat"), 2)
+            second = cache.acquire(CPB("cat"))
+            self.assertTrue(second.is_running())
+            self.assertNotEqual(first.pid, second.pid)
+            self.assertEqual(b'foo', second.communicate(input=b'foo', timeout=5)[0])
+            self.assertEqual(1, cache.stats()["hits"])
+            self.assertEqual(1, cache.stats()["misses"])
+            first.terminate()
+
+    def test_standby_expiry(self):
+        with StandbyCache(size=1, ttl=0.2, max_configurations=1) as cache:
+            template = CPB("cat").freeze()
+            cache.prewarm(template)
+            self.wait_for_standby(cache, template, 1)
+            cache.prewarm(CPB("sleep 10"))
+            self.assertEqual(1, cache.stats()["evicted"])
+            self.wait_for_standby(cache, CPB("sleep 10"), 1)
+            self.wait_for_standby(cache, CPB("sleep 10"), 0)
+            self.assertGreaterEqual(cache.stats()["expired"], 1)
+
+    def test_framed_channel(self):
+        process = CPB("cat", stdin=ChildProcessIO.PIPE, stdout=ChildProcessIO.PIPE).spawn()
+        with FramedChannel(process) as channel:
+            futures = [channel.request({"value": i}) for i in range(1000)]
+            self.assertEqual(list(range(1000)), [future.result(5)["value"] for future in futures])
+            self.assertEqual({"value": "x", "id": 1000}, channel.call({"value": "x"}, timeout=5))
+
+            async def call():
+                return await asyncio.gather(*(channel.call_async({"value": i}) for i in range(10)))
+            self.assertEqual(list(range(10)), [response["value"] for response in asyncio.run(call())])
+        self.assertTrue(process.wait_for_finish(5))
+
+    def test_framed_channel_binary(self):
+        process = CPB("cat", stdin=ChildProcessIO.PIPE, stdout=ChildProcessIO.PIPE).spawn()
+        channel = FramedChannel(process, FrameFormat.LENGTH_PREFIXED)
+        payloads = [bytes([i % 256]) * i for i in range(0, 5000, 7)]
+        futures = [channel.request(payload) for payload in payloads]
+        self.assertEqual(payloads, [future.result(5) for future in futures])
+        channel.close()
+        self.assertTrue(process.wait_for_finish(5))
+
+        process = CPB(["sh", "-c", "read request"], stdin=ChildProcessIO.PIPE, stdout=ChildProcessIO.PIPE).spawn()
+        self.assertRaises(EOFError, FramedChannel(process).call, {}, 5)
+
+        process = CPB(["sh", "-c", "read request; echo '{\"id\": 7}'; sleep 10"], stdin=ChildProcessIO.PIPE,
+                      stdout=ChildProcessIO.PIPE).spawn()
+        self.assertRaises(ValueError, FramedChannel(process).call, {}, 5)
+        process.terminate()
+
+    def test_process_group(self):
+        processes = [CPB(["sh", "-c", "echo out{0}; echo err{0} >&2; printf last; exit {0}".format(i)],
+                         stdout=ChildProcessIO.PIPE, stderr=ChildProcessIO.PIPE).spawn() for i in range(50)]
+        lines = {}
+        with ProcessGroup(lines=True) as group:
+            for process in processes:
+                group.add(process)
+            for event in group:
+                if event.type == ProcessEventType.LINE:
+                    lines.setdefault((event.process, event.stream), []).append(event.data)
+                elif event.type == ProcessEventType.EXITED:
+                    self.assertEqual(processes.index(event.process), event.data)
+                    self.assertIn((event.process, "stderr"), lines)
+            self.assertEqual(0, len(group))
+        for i, process in enumerate(processes):
+            self.assertEqual([b"out%d" % i, b"last"], lines[process, "stdout"])
+            self.assertEqual([b"err%d" % i], lines[process, "stderr"])
+
+    def test_process_group_pause(self):
+        process = CPB(["sh", "-c", "echo a; echo b >&2"], stdout=ChildProcessIO.PIPE,
+                      stderr=ChildProcessIO.PIPE).spawn()
+        with ProcessGroup(read_size=1) as group:
+            group.add(process)
+            group.pause(process, "stdout")
+            events = []
+            while not any(event.type == ProcessEventType.EOF for event in events):
+                events += group.poll(5)
+            self.assertEqual({"stderr"}, {event.stream for event in events})
+            self.assertEqual([], group.poll(0.05))
+            group.resume(process, "stdout")
+            chunks = [event.data for event in group if event.type == ProcessEventType.CHUNK]
+            self.assertEqual([b"a", b"\n"], chunks)
+
+    def test_process_group_unwatched(self):
+        # Without a pidfd, the group polls for the exit
+        with unittest.mock.patch.object(ChildProcess, "_watch", return_value=False):
+            process = CPB("echo foo", stdout=ChildProcessIO.PIPE).spawn()
+        with ProcessGroup() as group:
+            group.add(process)
+            events = list(group)
+        self.assertEqual(ProcessEventType.EXITED, events[-1].type)
+
+        # A process which exits after its group was closed must not write to the group's old wakeup descriptor
+        process = CPB("sh -c 'read x'", stdin=ChildProcessIO.PIPE, stdout=ChildProcessIO.PIPE).spawn()
+        group = ProcessGroup()
+        group.add(process)
+        group.close()
+        read_fd, write_fd = os.pipe()
+        try:
+            process.stdin.close()
+            process.wait_for_finish(5)
+            os.set_blocking(read_fd, False)
+            self.assertRaises(BlockingIOError, os.read, read_fd, 1)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_map(self):
+        builder = CPB(["sh", "-c", "sleep 0.0$(($1 % 3)); echo $(($1 * 2))", "sh"], stdout=ChildProcessIO.PIPE)
+        results = list(builder.map(range(40), concurrency=8))
+        self.assertEqual(list(range(40)), [item for item, _ in results])
+        self.assertEqual([b"%d\n" % (i * 2) for i in range(40)], [result.stdout for _, result in results])
+
+        unordered = builder.map(range(40), concurrency=8, ordered=False)
+        self.assertEqual(set(range(40)), {item for item, _ in unordered})
+
+        reader = CPB(["sh", "-c", "read x; echo $1", "-"], stdout=ChildProcessIO.PIPE)
+        self.assertEqual([b"a\n"], [result.stdout for _, result in reader.map(["a"], timeout=5)])
+
+        upper = CPB("tr a-z A-Z", stdout=ChildProcessIO.PIPE)
+        self.assertEqual([b"FOO", b"BAR"], [result.stdout for _, result in upper.map(["foo", b"bar"], stdin=True)])
+
+    def test_map_retries_and_timeout(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Fails on the first attempt for each input, succeeds on the second
+            builder = CPB(["sh", "-c", "[ -e {input} ] || { touch {input}; exit 3; }"], cwd=directory)
+            results = dict(builder.map(["a", "b", "c"], retries=1))
+            self.assertEqual([0, 0, 0], [results[name].exit_code for name in "abc"])
+            self.assertEqual(3, dict(builder.map(["d"]))["d"].exit_code)
+
+        results = list(CPB("sleep").map([0, 10], timeout=0.2, retries=1))
+        self.assertEqual([0, -9], [result.exit_code for _, result in results])
+
+    def test_command_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "input.txt"), "w") as file:
+                file.write("one")
+            builder = CPB(["sh", "-c", "cat input.txt; cat; echo run >> runs.log"], cwd=directory,
+                          stdout=ChildProcessIO.PIPE)
+            cache = CommandCache(os.path.join(directory, "cache"))
+
+            self.assertEqual(b"one-", cache.run(builder, "-", input_files=["input.txt"]).stdout)
+            self.assertEqual(b"one-", cache.run(builder, "-", input_files=["input.txt"]).stdout)
+            self.assertEqual(b"one+", cache.run(builder, "+", input_files=["input.txt"]).stdout)
+            with open(os.path.join(directory, "input.txt"), "w") as file:
+                file.write("two")
+            self.assertEqual(b"two-", cache.run(builder, "-", input_files=["input.txt"]).stdout)
+
+            # A new cache shares the on-disk tier
+            disk = CommandCache(os.path.join(directory, "cache"))
+            self.assertEqual(b"two-", disk.run(builder, "-", input_files=["input.txt"]).stdout)
+            with open(os.path.join(directory, "runs.log")) as file:
+                self.assertEqual(3, len(file.readlines()))
+            self.assertEqual({"memory_hits": 1, "disk_hits": 0, "misses": 3, "evictions": 0, "hit_rate": 0.25},
+                             cache.stats())
+            self.assertEqual(1, disk.stats()["disk_hits"])
+
+    def test_command_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = CommandCache(directory, max_memory_bytes=10, max_disk_bytes=40)
+            builder = CPB("cat", stdout=ChildProcessIO.PIPE)
+            for text in ["aaaaaaaa", "bbbbbbbb", "cccccccc"]:
+                cache.run(builder, text)
+            self.assertEqual(1, len(os.listdir(directory)))
+            self.assertEqual(b"cccccccc", cache.run(builder, "cccccccc").stdout)
+            self.assertEqual(1, cache.stats()["memory_hits"])
+            self.assertGreaterEqual(cache.stats()["evictions"], 4)
+
+        # Input and resource controls given to the builder are part of the key
+        cache = CommandCache()
+        self.assertEqual(b"one", cache.run(CPB("cat", stdin=b"one")).stdout)
+        self.assertEqual(b"two", cache.run(CPB("cat", stdin=b"two")).stdout)
+        limited = CPB("sh -c 'ulimit -n'")
+        limited.rlimits = {resource.RLIMIT_NOFILE: 32}
+        self.assertNotEqual(cache.key(limited), cache.key(CPB("sh -c 'ulimit -n'")))
+        with self.assertRaises(ValueError):
+            cache.run(CPB("cat", stdin=ChildProcessIO.INHERIT))
+
+    def test_spill_capture(self):
+        builder = CPB(["seq", "200000"], stdout=SpillCapture(memory_limit=4096), stderr=ChildProcessIO.CAPTURE_SPILL)
+        process = builder.spawn()
+        self.assertTrue(process.wait_for_finish(5))
+        with process.stdout_capture as output:
+            self.assertTrue(output.spilled)
+            expected = b"".join(b"%d\n" % i for i in range(1, 200001))
+            self.assertEqual(len(expected), len(output))
+            self.assertEqual(expected.find(b"\n123456\n"), output.find(b"\n123456\n"))
+            self.assertEqual(b"1\n2\n", output[:4].tobytes())
+            lines = output.iter_lines()
+            self.assertEqual([b"1", b"2"], [next(lines), next(lines)])
+            self.assertEqual(200000, sum(1 for _ in output.iter_lines()))
+            self.assertEqual(expected, output.tobytes())
+        with process.stderr_capture as errors:
+            self.assertFalse(errors.spilled)
+            self.assertEqual(0, len(errors))
+        self.assertRaises(RuntimeError, lambda: process.stdout_tail)
+
+        process = CPB(["sh", "-c", "printf 'a\\nb'"], stdout=ChildProcessIO.CAPTURE_SPILL).spawn()
+        self.assertTrue(process.wait_for_finish(5))
+        self.assertEqual([b"a\n", b"b"], list(process.stdout_capture.iter_lines(keepends=True)))
+
+    def test_shared_input(self):
+        payload = b"".join(b"%d\n" % i for i in range(100000))
+        with SharedInput(payload) as shared:
+            self.assertEqual(len(payload), shared.size)
+            self.assertRaises(OSError, os.write, shared.fileno(), b"x")
+            builder = CPB("wc -l", stdin=shared, stdout=ChildProcessIO.PIPE)
+            processes = [builder.spawn() for _ in range(4)]
+            processes.append(CPB("head -n 2", stdin=shared, stdout=ChildProcessIO.PIPE).spawn())
+            outputs = [process.communicate(timeout=5)[0] for process in processes]
+            self.assertEqual([b"100000\n"] * 4 + [b"0\n1\n"], outputs)
+            with shared.mmap() as mapping:
+                self.assertEqual(payload[-7:], mapping[-7:])
+            self.assertRaises(RuntimeError, lambda: processes[0].stdin)
+
+        # A failure while writing the payload is reported as itself
+        with unittest.mock.patch("os.write", side_effect=OSError(28, "No space left on device")):
+            self.assertRaises(OSError, SharedInput, payload)
+
+    def test_pipeline_graph_fan_out(self):
+        graph = PipelineGraph(pipe_size=65536)
+        source = graph.add(CPB("seq 200000"))
+        count = graph.add(CPB("wc -l", stdout=ChildProcessIO.PIPE))
+        tail = graph.add(CPB("tail -n 1", stdout=ChildProcessIO.PIPE))
+        head = graph.add(CPB("head -n 1", stdout=ChildProcessIO.PIPE))
+        for branch in (count, tail, head):
+            graph.connect(source, branch)
+        self.assertRaises(ValueError, graph.connect, tail, source)
+
+        processes = graph.spawn()
+        self.assertEqual(b"200000\n", processes[count].stdout.read())
+        self.assertEqual(b"200000\n", processes[tail].stdout.read())
+        self.assertEqual(b"1\n", processes[head].stdout.read())
+        self.assertTrue(processes.wait_for_finish(5))
+
+    def test_pipeline_graph_fan_in(self):
+        graph = PipelineGraph()
+        sink = graph.add(CPB("sort -n", stdout=ChildProcessIO.PIPE))
+        for command in ("seq 1 3 30000", "seq 2 3 30000", "printf 3"):
+            graph.connect(graph.add(CPB(command)), sink)
+        processes = graph.spawn()
+        expected = sorted([i for i in range(1, 30001) if i % 3 != 0] + [3])
+        self.assertEqual(b"".join(b"%d\n" % i for i in expected), processes[sink].stdout.read())
+        self.assertTrue(processes.wait_for_finish(5))
+
+        # Nothing is leaked when a node cannot be spawned
+        graph = PipelineGraph()
+        source = graph.add(CPB("seq 10"))
+        for command in ("cat", "no-such-command"):
+            graph.connect(source, graph.add(CPB(command)))
+        open_fds = len(os.listdir("/proc/self/fd"))
+        self.assertRaises(FileNotFoundError, graph.spawn)
+        self.assertEqual(open_fds, len(os.listdir("/proc/self/fd")))
+
+    def test_transform_stage(self):
+        def split_even(line):
+            number = int(line)
+            if number % 2 == 0:
+                yield b"%d" % number
+                yield b"%d" % -number
+
+        even = TransformStage(split_even)
+        upper = TransformStage(bytes.upper, lines=False)
+        pipeline = PB(["seq 100000", even, "tail -n 2", upper, "tr 0 o"]).spawn_all()
+        self.assertEqual(3, len(pipeline))
+        self.assertEqual(b"1ooooo\n-1ooooo\n", pipeline[-1].stdout.read())
+        self.assertTrue(pipeline.wait_for_finish(5))
+        self.assertTrue(even.wait_for_finish(5))
+        self.assertEqual(100000, even.records)
+        self.assertEqual(len(b"".join(b"%d\n" % i for i in range(1, 100001))), even.bytes_read)
+        self.assertGreater(even.throughput, 0)
+        self.assertIsNone(even.exception)
+
+        failing = TransformStage(int)
+        pipeline = PB(["echo x", failing, "cat"]).spawn_all()
+        self.assertEqual(b"", pipeline[-1].stdout.read())
+        self.assertTrue(failing.wait_for_finish(5))
+        self.assertIsInstance(failing.exception, ValueError)
+        self.assertEqual([0, 0], pipeline.wait_for_finish(5).exit_codes)
+        self.assertEqual(1, pipeline.exit_code)
+        self.assertEqual([failing], pipeline.transforms)
+        self.assertRaises(ValueError, PB([even, "cat"]).spawn_all)
+
+        text = TransformStage(bytes.decode)
+        pipeline = PB(["echo x", text, "cat"]).spawn_all()
+        self.assertEqual(1, pipeline.wait_for_finish(5).exit_code)
+        self.assertIsInstance(text.exception, TypeError)
+
+    def wait_for_kernel_state(self, process, stopped):
+        deadline = time.monotonic() + 5
+        while process.is_stopped(verify=True) != stopped and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(stopped, process.is_stopped(verify=True))
+
+    def test_load_governor(self):
+        pressure = [50.0]
+        governor = LoadGovernor(high=40, low=10, pressure=lambda: pressure[0])
+        batch = CPB("sleep 10").spawn()
+        background = CPB("sleep 10").spawn()
+        governor.register(batch, priority=1)
+        governor.register(background, priority=0)
+
+        governor.tick()
+        self.assertEqual([background], governor.suspended)
+        self.wait_for_kernel_state(background, True)
+        governor.tick()
+        self.assertEqual([background, batch], governor.suspended)
+        self.wait_for_kernel_state(batch, True)
+
+        pressure[0] = 20.0
+        governor.tick()
+        self.assertEqual(2, len(governor.suspended))
+        pressure[0] = 5.0
+        governor.tick()
+        self.assertEqual([background], governor.suspended)
+        self.wait_for_kernel_state(batch, False)
+        # Time suspended still counts once a process is no longer governed
+        governor.unregister(batch)
+        governor.close()
+        self.wait_for_kernel_state(background, False)
+        stats = governor.stats()
+        self.assertEqual({"suspensions": 2, "resumptions": 2, "escalations": 0}, {
+            key: value for key, value in stats.items() if key != "suspended_time"})
+        self.assertGreater(background.suspended_time, 0)
+        self.assertGreaterEqual(background.suspended_time, batch.suspended_time)
+        self.assertAlmostEqual(background.suspended_time + batch.suspended_time, stats["suspended_time"])
+        for process in (batch, background):
+            process.terminate()
+
+    def test_load_governor_escalation(self):
+        stubborn = CPB(["sh", "-c", "trap '' TSTP; exec sleep 10"]).spawn()
+        # SIGTSTP is only ignored once the shell has set the trap and exec'd sleep
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with open("/proc/{}/comm".format(stubborn.pid)) as comm:
+                if comm.read().strip() == "sleep":
+                    break
+            time.sleep(0.01)
+        governor = LoadGovernor(pressure=lambda: 100.0)
+        governor.register(stubborn)
+        governor.tick()
+        self.assertTrue(stubborn.is_stopped())
+        time.sleep(0.1)
+        self.assertFalse(stubborn.is_stopped(verify=True))
+        governor.tick()
+        self.wait_for_kernel_state(stubborn, True)
+        self.assertEqual(1, governor.stats()["escalations"])
+        governor.close()
+        self.wait_for_kernel_state(stubborn, False)
+        stubborn.terminate()
+
+    def test_remote_agents(self):
+        with Agent(slots=1) as first, Agent(slots=2) as second:
+            scheduler = AgentScheduler([first.address, second.address])
+            sleepers = [CPB("sleep 10").spawn_remote(scheduler) for _ in range(3)]
+            self.assertEqual([second.address, first.address, second.address],
+                             [process.address for process in sleepers])
+            self.assertEqual({first.address: {"type": "status", "slots": 1, "running": 1},
+                              second.address: {"type": "status", "slots": 2, "running": 2}}, scheduler.status())
+            for process in sleepers:
+                process.terminate()
+                self.assertEqual(-15, process.wait_for_finish(5).exit_code)
+
+            upper = CPB(["sh", "-c", "tr a-z A-Z; echo done >&2; exit 3"]).spawn_remote(scheduler)
+            self.assertEqual((b"HELLO", b"done\n"), upper.communicate(b"hello", timeout=5))
+            self.assertEqual(3, upper.exit_code)
+            self.assertIn("utime", upper.rusage)
+
+            piped = CPB("cat", stdin="x" * 200000).spawn_remote(scheduler)
+            self.assertEqual(200000, len(piped.stdout.read()))
+            self.assertEqual(0, piped.wait_for_finish(5).exit_code)
+
+    def test_agent_secret(self):
+        with self.assertRaises(ValueError):
+            Agent(host="0.0.0.0")
+        with Agent(host="0.0.0.0", secret="hunter2") as agent:
+            address = ("127.0.0.1", agent.address[1])
+            self.assertEqual({address: None}, AgentScheduler([address], secret="wrong").status())
+            with self.assertRaises(PermissionError):
+                RemoteChildProcess(address, ["true"], os.environ, None, ChildProcessIO.NULL,
+                                   ChildProcessIO.NULL, ChildProcessIO.NULL, "wrong")
+
+            scheduler = AgentScheduler([address], secret=b"hunter2")
+            with self.assertRaises(FileNotFoundError):
+                CPB("/nonexistent").spawn_remote(scheduler)
+            self.assertEqual(address, scheduler.choose())
+
+            os.environ["CHILDPROCESS_COORDINATOR"] = "1"
+            try:
+                builder = CPB(["sh", "-c", "echo $CHILDPROCESS_COORDINATOR,$CHILDPROCESS_EXTRA,$(pwd)"], cwd="/")
+                builder.env["CHILDPROCESS_EXTRA"] = "2"
+                del builder.env["CHILDPROCESS_COORDINATOR"]
+                self.assertEqual(b",2,/\n", builder.spawn_remote(scheduler).stdout.read())
+            finally:
+                del os.environ["CHILDPROCESS_COORDINATOR"]
+
+    def test_agent_command(self):
+        agent = CPB([sys.executable, "childprocess.py", "agent", "--slots", "3"]).spawn()
+        try:
+            address = agent.stdout.readline().split()[-1].decode().rsplit(":", 1)
+            scheduler = AgentScheduler([(address[0], int(address[1]))])
+            self.assertEqual(b"remote\n", CPB("echo remote").spawn_remote(scheduler).stdout.read())
+            self.assertEqual(3, scheduler.status()[scheduler.choose()]["slots"])
+        finally:
+            agent.terminate()
+
+    def test_read_table(self):
+        process = CPB(["printf", "pid name cpu\\n1 init 0.5\\n\\n22 sh 12"]).spawn()
+        table = process.read_table([("pid", int), ("name", str), ("cpu", float)], skip_rows=1)
+        self.assertIsInstance(table, Table)
+        self.assertEqual(["pid", "name", "cpu"], table.names)
+        self.assertEqual([(1, "init", 0.5), (22, "sh", 12.0)], list(table.rows()))
+
+        process = CPB(["printf", "  7ab\\n 42cd\\n"]).spawn()
+        table = process.read_table({"size": int, "tag": bytes}, widths=[3, 2])
+        self.assertEqual([7, 42], list(table["size"]))
+        self.assertEqual([b"ab", b"cd"], list(table["tag"]))
+
+        process = CPB(["printf", "1,2\\n3\\n"]).spawn()
+        with self.assertRaises(ValueError):
+            process.read_table({"a": int, "b": int}, delimiter=b",")
+        with self.assertRaises(TypeError):
+            CPB("true").spawn().read_table({"a": list})
+
+    def test_read_table_ragged_rows(self):
+        # The total number of fields matches two rows of two columns, but neither row has two
+        for output, delimiter in (("1,2,3\\n4\\n", b","), ("1 2 3\\n4\\n", None)):
+            for numpy_module in {None, numpy}:
+                with unittest.mock.patch("childprocess.numpy", numpy_module):
+                    process = CPB(["printf", output]).spawn()
+                    with self.assertRaises(ValueError):
+                        process.read_table({"a": int, "b": int}, delimiter=delimiter)
+
+    def test_read_table_blank_rows(self):
+        for numpy_module in {None, numpy}:
+            with unittest.mock.patch("childprocess.numpy", numpy_module):
+                for delimiter in (b",", None):
+                    output = "\\n1{0}2\\n\\n3{0}4\\n\\n".format(delimiter.decode() if delimiter else " ")
+                    table = CPB(["printf", output]).spawn().read_table({"a": int, "b": int}, delimiter=delimiter)
+                    self.assertEqual([(1, 2), (3, 4)], list(table.rows()))
+                table = CPB(["printf", "\\n\\n"]).spawn().read_table({"a": int, "b": int}, delimiter=b",")
+                self.assertEqual(0, len(table))
+
+    @unittest.skipUnless(numpy, "NumPy is not installed")
+    def test_read_table_numpy(self):
+        process = CPB(["printf", "1,init,0.5\\n22,sh,12\\n"]).spawn()
+        table = process.read_table([("pid", int), ("name", str), ("cpu", bytes)], delimiter=b",")
+        self.assertIsInstance(table["pid"], numpy.ndarray)
+        self.assertEqual(numpy.int64, table["pid"].dtype)
+        self.assertEqual([(1, "init", b"0.5"), (22, "sh", b"12")], list(table.rows()))
+
+        process = CPB(["printf", "  7ab\\n 42cd\\n"]).spawn()
+        table = process.read_table({"size": float, "tag": str}, widths=[3, 2])
+        self.assertEqual(numpy.float64, table["size"].dtype)
+        self.assertEqual([(7.0, "ab"), (42.0, "cd")], list(table.rows()))
+
+    def test_iter_tables(self):
+        process = CPB(["sh", "-c", "seq 1000 | sed 's/.*/&,&.5/'"]).spawn()
+        batches = list(process.iter_tables({"n": int, "x": float}, delimiter=b",", batch_rows=300,
+                                           block_size=100))
+        self.assertEqual([300, 300, 300, 100], [len(batch) for batch in batches])
+        self.assertEqual(list(range(1, 1001)), [n for batch in batches for n in batch["n"]])
+        self.assertEqual(1000.5, batches[-1]["x"][-1])
+        self.assertEqual(0, len(CPB("true").spawn().read_table({"n": int})))
+
+        process = CPB(["sh", "-c", "printf 'a%.0s' $(seq 100000); printf ',1\\nb,2\\n'"]).spawn()
+        table = process.read_table([("name", str), ("n", int)], delimiter=b",", block_size=64)
+        self.assertEqual([100000, 1], [len(name) for name in table["name"]])
+        self.assertEqual([1, 2], list(table["n"]))
+
 
 if __name__ == "__main__":
     unittest.main()